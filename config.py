@@ -152,7 +152,7 @@ def get(section, option):
 
 def getint(section, option):
     try:
-        return int(value)
+        return int(get(section, option))
     except:
         return 0
 
@@ -170,7 +170,7 @@ def set(section, option, value):
 
 
 def tb(level=0):
-    log.level(level,
+    log.log(level,
               '''----- start traceback -----
 %s   ----- end traceback -----
 '''
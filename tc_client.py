@@ -18,8 +18,10 @@
 # This is the Phantom client library. Import this module, make an instance
 # of BuddyList, give it your call-back function and your client is running.
 
-import SocksiPy.socks as socks
 import socket
+import select
+import errno
+import struct
 import threading
 import random
 import time
@@ -28,11 +30,56 @@ import os
 import shutil
 import subprocess
 import tempfile
+import tarfile
+import bisect
+import heapq
+import math
 import hashlib
+import hmac
+import re
+import zlib
+import mmap
+import ctypes
+import ctypes.util
+import collections
+import base64
+import json
+import sqlite3
 import logging as log
 import config
 import version
 
+# lzma compression is optional, it is not part of Python 2
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# PyCrypto is only needed for an encrypted chat history
+
+try:
+    from Crypto.Cipher import AES
+    from Crypto.Util import Counter
+except ImportError:
+    AES = None
+
+# fallocate() is not in the os module of Python 2, we call it
+# directly where the C library has it (Linux). Not posix_fallocate(),
+# where the file system cannot allocate that one writes zeros into
+# every block, which takes long for a big file.
+
+try:
+    fallocate = ctypes.CDLL(ctypes.util.find_library('c'),
+                            use_errno=True).fallocate64
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64,
+                          ctypes.c_int64]
+except:
+    fallocate = None
+
 PHANTOM_PORT = 11009  # do NOT change this.
 TOR_CONFIG = 'tor'  # the name of the active section in the .ini file
 STATUS_OFFLINE = 0
@@ -44,6 +91,60 @@ STATUS_XA = 4
 CB_TYPE_CHAT = 1
 CB_TYPE_FILE = 2
 CB_TYPE_OFFLINE_SENT = 3
+CB_TYPE_FILE_RESUME = 4
+
+# changes of the buddy list, so the GUI doesn't have to look for them.
+# The data is the buddy. CB_TYPE_BUDDY_CHANGED is status, name or
+# address (for the address the buddy is found by identity)
+
+CB_TYPE_BUDDY_ADDED = 5
+CB_TYPE_BUDDY_REMOVED = 6
+CB_TYPE_BUDDY_CHANGED = 7
+
+HISTORY_IN = 0
+HISTORY_OUT = 1
+
+SEND_BATCH_SIZE = 65536  # max bytes handed to socket.send() at once
+RECV_SIZE = 65536  # max bytes read with one socket.recv()
+FRAME_HEADER_SIZE = 5  # struct '>BI', see ProtocolMsg.getFrame()
+
+LEGACY_BLOCK_SIZE = 8192  # file transfer block size of old clients
+FILE_DIGESTS = ['blake2b', 'sha256']  # whole file digests, best first
+BLOCK_TIME = 0.5  # seconds of transfer time per block we aim at
+WINDOW_MIN = 4  # the file sender window never gets smaller (blocks)
+RTT_GROWTH_LIMIT = 3  # decrease the window if srtt > this * min_rtt
+SENDER_IDLE_WAIT = 1  # seconds between timeout checks of a waiting sender
+SENDER_TIMEOUT = 600  # restart after this many seconds without filedata_ok
+CAPABILITIES_TIMEOUT = 30  # don't wait longer for the capabilities message
+CHECKPOINT_INTERVAL = 10  # seconds between saves of the transfer state
+RETRANSMIT_TIMEOUT_MIN = 5  # resend unconfirmed blocks after this (seconds)
+TRANSFER_QUANTUM = 262144  # bytes per round and weight, see TransferScheduler
+BULK_COMMANDS = ['filedata', 'filedata_compressed', 'delta_copy']  # sent
+                                   # only when no other messages wait
+TAR_BLOCK = 512  # the tar format pads everything to this size
+COMPRESSION_MIN_SAVING = 0.1  # send blocks uncompressed if they shrink less
+COMPRESSION_SKIP_MAX = 64  # blocks not to try after incompressible ones
+MESSAGE_COMPRESS_MIN = 1024  # don't try to compress shorter chat messages
+LZMA_INPUT_CHUNK = 256  # input bytes fed to lzma at once
+DELTA_BLOCK_MIN = 2048  # smallest block size of delta signatures
+DELTA_MAX_SIGNATURES = 32768  # must fit into one line (12 bytes each)
+DELTA_ROLL_BUDGET = 4194304  # bytes searched byte by byte for moved blocks
+DELTA_WAIT = 60  # seconds to wait for the receiver's signatures
+RECEIVED_FILES_MAX = 1000  # entries in the registry of received files
+WRITE_BUFFER_SIZE = 1048576  # received blocks are written in chunks this big
+PROGRESS_RATE = 10  # max GUI updates per second and transfer
+PROGRESS_RATE_WINDOW = 5  # seconds over which the transfer rate is measured
+CONNECT_TIMEOUT = 180  # give up a SOCKS connect that takes longer (seconds)
+RECENTLY_ACTIVE = 86400  # buddies seen this long ago are connected first
+DORMANT_AFTER = 1209600  # unreachable this long (seconds), try only rarely
+DORMANT_FAILURES = 20  # ...and at least this many failed connects in a row
+REACHABILITY_SAVE_INTERVAL = 300  # seconds between saves of the statistics
+OFFLINE_WINDOW = 16  # offline messages sent without confirmation
+OFFLINE_RECEIVED_MAX = 1000  # ids remembered to drop duplicate offline messages
+BUDDY_LOG_MAX = 200  # changes in buddy-list.log before it is compacted
+HISTORY_WORD_MAX = 64  # longer words are not put into the search index
+HISTORY_KEY_ROUNDS = 100000  # PBKDF2 rounds for the history passphrase
+HISTORY_PASSPHRASE_ENV = 'PHANTOM_HISTORY_PASSPHRASE'  # instead of asking
 
 tor_pid = None
 tor_proc = None
@@ -83,1518 +184,5657 @@ def createTemporaryFile(file_name):
     return (file_name_tmp, file_handle_tmp)
 
 
-# --- ### Client API
+def preallocateFile(handle, size):
 
+    # reserve the space for a file we are going to receive. If it does
+    # not fit on the disk we want to know it now and not when most of
+    # it has been transferred. fallocate() really allocates the
+    # blocks (also the file is not fragmented), where it is not
+    # available the file is only extended (on Windows this allocates
+    # the space too, elsewhere the file might be sparse).
 
-class Buddy(object):
+    handle.flush()
+    if fallocate:
+        if fallocate(handle.fileno(), 0, 0, size) == 0:
+            return
+        error = ctypes.get_errno()
+        if error in (errno.ENOSPC, errno.EFBIG):
+            raise IOError(error, os.strerror(error))
 
-    def __init__(
-        self,
-        address,
-        buddy_list,
-        name='',
-        temporary=False,
-        ):
-        log.warn('(2) initializing buddy %s, temporary=%s' % (address,
-                 temporary))
-        self.bl = buddy_list
-        self.address = address
-        self.name = name
-        self.random1 = os.urandom(32)
-        self.random2 = os.urandom(32)
-        self.conn_out = None
-        self.conn_in = None
-        self.status = STATUS_OFFLINE
-        self.can_send = False
-        self.version = ''
-        self.timer = False
-        self.last_status_time = 0
-        self.count_failed_connects = 0
-        self.active = True
-        self.temporary = temporary
-        self.startTimer()
+        # the file system does not support it
 
-    def connect(self):
-        log.warn('%s.connect()' % self.address)
-        if self.conn_out == None:
-            self.conn_out = OutConnection(self.address + '.onion',
-                    self.bl, self)
-            self.sendPing()
+    handle.truncate(size)
 
-    def disconnect(self):
-        log.warn('%s.disconnect()' % self.address)
-        if self.conn_out != None:
-            self.conn_out.close()
-            self.conn_out = None
-        if self.conn_in != None:
-            self.conn_in.close()
-            self.conn_in = None
-        self.setStatus(STATUS_OFFLINE)
-        self.can_send = False
 
-    def onOutConnectionFail(self):
-        log.warn('%s.onOutConnectionFail()' % self.address)
-        self.count_failed_connects += 1
-        self.startTimer()
+def getFreeSpace(path):
 
-    def onInConnectionFail(self):
-        log.warn('%s.onInConnectionFail()' % self.address)
-        self.resetConnectionFailCounter()
-        self.startTimer()
+    # bytes available on the disk of path, None if we can't tell
 
-    def onOutConnectionSuccess(self):
-        log.warn('%s.onOutConnectionSuccess()' % self.address)
-        self.startTimer()
+    try:
+        if config.isWindows():
+            free = ctypes.c_ulonglong(0)
+            ctypes.windll.kernel32.GetDiskFreeSpaceExW(unicode(path),
+                    ctypes.byref(free), None, None)
+            return free.value
+        stat = os.statvfs(path)
+        return stat.f_bavail * stat.f_frsize
+    except:
+        return None
 
-    def onInConnectionFound(self, connection):
-        log.warn('s.onInConnectionFound()' % self.address)
-        conn_old = self.conn_in
-        if conn_old == connection:
-            log.warn('this connection is already the current conn_in. doing nothing.'
-                     )
-            return
 
-        self.conn_in = connection
-        connection.buddy = self
-        if conn_old:
-            log.warn('closing old connection of %s, %s'
-                     % (self.address, conn_old))
-            log.warn('new connection is %s' % connection)
-            conn_old.buddy = None
-            conn_old.close()
+def ignoreCallback(*args):
 
-    def resetConnectionFailCounter(self):
-        self.count_failed_connects = 0
+    # file transfers that are resumed at startup have no GUI
+    # callback until the GUI has created a window for them
 
-    def setActive(self, active):
-        log.warn('%s.setActive(%s)' % (self.address, active))
-        self.active = active
+    pass
 
-    def setTemporary(self, temporary):
-        log.warn('%s.setTemporary(%s)' % (self.address, temporary))
-        self.temporary = temporary
 
-    def setStatus(self, status):
-        if status != STATUS_OFFLINE or self.status != STATUS_OFFLINE:
-            self.resetConnectionFailCounter()
-        self.status = status
-        self.last_status_time = time.time()
+def getBlockCount(file_size, block_size):
 
-    def addToList(self):
-        log.warn('%s.addToList()' % self.address)
-        self.bl.addBuddy(self)
+    # an empty file is still sent as one (empty) block
 
-    def sendLine(self, line, conn=0):
+    return max(1, (file_size + block_size - 1) / block_size)
 
-        # conn: use outgiong or incoming connection
 
-        if self.conn_out == None:
-            self.connect()
-        if conn == 0:
-            self.conn_out.send(line + '\n')
+class BlockBitmap:
+
+    # one bit for every block of a file transfer
+
+    def __init__(self, count, encoded=None):
+        self.count = count
+        if encoded:
+            self.bits = bytearray(base64.b64decode(encoded))
         else:
-            if self.conn_in:
-                self.conn_in.send(line + '\n')
-            else:
+            self.bits = bytearray((count + 7) / 8)
+        self.first_missing = 0
+        self.set_count = 0
+        for index in range(count):
+            if self.isSet(index):
+                self.set_count += 1
 
-                # FIXME: handle this condition
+    def set(self, index):
 
-                pass
+        # returns False if the bit was already set
 
-    def sendChatMessage(self, text):
+        if self.isSet(index):
+            return False
+        self.bits[index >> 3] |= 1 << (index & 7)
+        self.set_count += 1
+        return True
 
-        # text must be unicode
+    def clear(self, index):
+        if self.isSet(index):
+            self.bits[index >> 3] &= ~(1 << (index & 7))
+            self.set_count -= 1
+            self.first_missing = min(self.first_missing, index)
 
-        if self.can_send:
-            message = ProtocolMsg(self.bl, None, 'message',
-                                  text.encode('UTF-8'))
-            message.send(self)
-        else:
-            self.storeOfflineChatMessage(text)
+    def clearFrom(self, index):
+        for i in range(index, self.count):
+            if self.isSet(i):
+                self.bits[i >> 3] &= ~(1 << (i & 7))
+                self.set_count -= 1
+        self.first_missing = min(self.first_missing, index)
 
-    def getOfflineFileName(self):
-        return os.path.join(config.getDataDir(), self.address
-                            + '_offline.txt')
+    def isSet(self, index):
+        return self.bits[index >> 3] & 1 << (index & 7) != 0
 
-    def storeOfflineChatMessage(self, text):
+    def getFirstMissing(self):
 
-        # text must be unicode
+        # blocks are mostly completed in order, so we remember where
+        # the last search has ended. Returns count if nothing is missing.
 
-        log.warn('storing offline message to %s' % self.address)
-        file = open(self.getOfflineFileName(), 'a')
-        file.write('[delayed] ' + text.encode('UTF-8') + '\n')
-        file.close()
+        while self.first_missing < self.count \
+            and self.isSet(self.first_missing):
+            self.first_missing += 1
+        return self.first_missing
 
-    def getOfflineMessages(self):
+    def isComplete(self):
+        return self.set_count == self.count
 
-        # will return the string as unicode
+    def getMissingRanges(self, first, last):
 
-        try:
-            file = open(self.getOfflineFileName(), 'r')
-            text = file.read().rstrip()
-            file.close()
-            return text.decode('UTF-8')
-        except:
-            return ''
+        # list of (first, last) index pairs (last excluded)
+        # of the missing blocks in the range first..last
 
-    def sendOfflineMessages(self):
+        ranges = []
+        index = first
+        while index < last:
+            if self.isSet(index):
+                index += 1
+                continue
+            begin = index
+            while index < last and not self.isSet(index):
+                index += 1
+            ranges.append((begin, index))
+        return ranges
 
-        # this will be called after the answer to the ping message
+    def getBytes(self, block_size, file_size):
 
-        text = self.getOfflineMessages()
-        if text:
-            os.unlink(self.getOfflineFileName())
-            log.warn('sending offline messages to %s' % self.address)
+        # the number of bytes in the set blocks. Only the last
+        # block can be shorter, so this is never file_size
+        # unless all blocks are set.
 
-            # we send it without checking online status. because we have sent
-            # a pong before, the receiver will have set the status to online.
-            # text is unicode, so we must encode it to UTF-8 again.
+        return min(self.set_count * block_size, file_size)
 
-            message = ProtocolMsg(self.bl, None, 'message',
-                                  text.encode('UTF-8'))
-            message.send(self)
-            self.bl.guiCallback(CB_TYPE_OFFLINE_SENT, self)
-        else:
-            pass
+    def toString(self):
+        return base64.b64encode(str(self.bits))
 
-    def getDisplayNameOrAddress(self):
-        if self.name == '':
-            return self.address
-        else:
-            return self.name
 
-    def getAddressAndDisplayName(self):
-        if self.name == '':
-            return self.address
-        else:
-            return self.address + ' (' + self.name + ')'
+def getTransferStateDir():
+    dir = os.path.join(config.getDataDir(), 'transfers')
+    if not os.path.exists(dir):
+        os.mkdir(dir)
+    return dir
 
-    def sendFile(self, filename, gui_callback):
-        sender = FileSender(self, filename, gui_callback)
-        return sender
 
-    def startTimer(self):
-        if not self.active:
-            log.warn('%s is not active. Will not start a new timer'
-                     % self.address)
-            return
+def writeFileAtomic(file_name, text):
 
-        if self.status == STATUS_OFFLINE:
-            if self.count_failed_connects < 4:
-                t = random.randrange(0, 15000) / 1000.0
-            else:
-                if self.count_failed_connects < 15:
-                    t = random.randrange(30000, 60000) / 1000.0
-                else:
-                    t = random.randrange(300000, 600000) / 1000.0
-            log.warn('%s had %i failed connections. Setting timer to %f seconds'
-                      % (self.address, self.count_failed_connects, t))
-        else:
+    # Written to a temporary file first and then renamed,
+    # we never want to leave a half written file behind.
 
-            # whenever we are connected to someone we use a fixed timer.
-            # otherwise we would create a unique pattern of activity
-            # over time that could be identified at the other side
+    f = open(file_name + '.tmp', 'w')
+    f.write(text)
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    if config.isWindows():
 
-            t = 60
+        # os.rename() can't replace an existing file there
 
-        if self.timer:
-            self.timer.cancel()
-        self.timer = threading.Timer(t, self.onTimer)
-        self.timer.start()
+        MOVEFILE_REPLACE_EXISTING = 1
+        MOVEFILE_WRITE_THROUGH = 8
+        if not ctypes.windll.kernel32.MoveFileExW(unicode(file_name
+                + '.tmp'), unicode(file_name), MOVEFILE_REPLACE_EXISTING
+                | MOVEFILE_WRITE_THROUGH):
+            raise ctypes.WinError()
+    else:
+        os.rename(file_name + '.tmp', file_name)
 
-    def onTimer(self):
-        log.fatal('timer event for %s' % self.address)
-        if not self.active:
-            log.info("%s is not active, onTimer() won't do anything"
-                     % self.address)
-            return
 
-        self.keepAlive()
+def saveTransferState(name, state):
 
-        if self.status != STATUS_OFFLINE and time.time() \
-            - self.last_status_time > config.get('internal',
-                'dead_connection_timeout'):
+    # the state of an unfinished file transfer, so it can be resumed
+    # after a restart.
 
-            # long time without status is indicating a broken link
-            # disconnect to give it a chance to reconnect
+    try:
+        file_name = os.path.join(getTransferStateDir(), name + '.json')
+        writeFileAtomic(file_name, json.dumps(state))
+    except:
+        log.error('could not save transfer state %s' % name)
+        config.tb()
 
-            log.info('%s reveived no status update for a long time. disconnecting'
-                      % self.address)
-            self.disconnect()  # this will trigger outConnectionFail()
 
-        # only restart the timer automatically if we are connected (or handshaking).
-        # else it will be restarted by outConnectionFail() / outConnectionSuccess()
+def deleteTransferState(name):
+    try:
+        file_name = os.path.join(getTransferStateDir(), name + '.json')
+        if os.path.exists(file_name):
+            os.unlink(file_name)
+    except:
+        config.tb()
 
-        if self.status != STATUS_OFFLINE:
-            self.startTimer()
 
-    def keepAlive(self):
-        if self.conn_out == None:
-            self.connect()
-        else:
-            if self.conn_in:
-                self.sendStatus()
-            else:
-                if self.status == STATUS_HANDSHAKE:
-                    self.sendPing()
+def loadTransferStates():
 
-    def sendPing(self):
-        log.warn('%s.sendPing()' % self.address)
+    # returns a list of (name, state)
 
-        # self.random1 = str(random.getrandbits(256))
+    states = []
+    try:
+        dir = getTransferStateDir()
+        for file_name in os.listdir(dir):
+            if not file_name.endswith('.json'):
+                continue
+            try:
+                f = open(os.path.join(dir, file_name))
+                states.append((file_name[:-5], json.load(f)))
+                f.close()
+            except:
+                log.error('broken transfer state %s' % file_name)
+                config.tb()
+    except:
+        config.tb()
+    return states
 
-        ping = ProtocolMsg(self.bl, None, 'ping', (config.get('client',
-                           'own_hostname'), self.random1))
-        ping.send(self)
 
-    def sendStatus(self):
-        if self.conn_out != None:
-            status = ''
-            if self.bl.own_status == STATUS_ONLINE:
-                status = 'available'
-            if self.bl.own_status == STATUS_AWAY:
-                status = 'away'
-            if self.bl.own_status == STATUS_XA:
-                status = 'xa'
-            if status != '':
-                msg = ProtocolMsg(self.bl, None, 'status', status)
-                msg.send(self)
+received_files = None  # see getReceivedFile()
+received_files_lock = threading.Lock()
 
-    def sendAddMe(self):
-        msg = ProtocolMsg(self.bl, None, 'add_me', '')
-        msg.send(self)
 
-    def sendRemoveMe(self):
-        if self.conn_in:
-            msg = ProtocolMsg(self.bl, None, 'remove_me', '')
-            msg.send(self)
+def loadReceivedFiles():
 
-    def sendVersion(self):
-        msg = ProtocolMsg(self.bl, None, 'version', version.VERSION)
-        msg.send(self)
+    # the registry of files we have received and saved, it is used to
+    # find the old version of a file that is sent again (delta sync)
 
-    def getDisplayName(self):
-        if self.name != '':
-            line = '%s (%s)' % (self.address, self.name)
-        else:
-            line = self.address
-        return line
+    global received_files
+    if received_files == None:
+        try:
+            f = open(os.path.join(config.getDataDir(),
+                     'received-files.json'))
+            received_files = json.load(f)
+            f.close()
+        except:
+            received_files = {}
+    return received_files
 
 
-class BuddyList(object):
+def getReceivedFile(address, file_name):
 
-    # the buddy list object is somewhat like a central API.
-    # All functionality and access to all other objects should
-    # be possible with it's methods. Most other objects carry
-    # a reference to the one and only BuddyList object around
-    # to be able to find and interact with other objects.
+    # the path of the last file_name we have saved from address,
+    # if it is still there and has not been changed since then
 
-    def __init__(self, guiCallback, socket=None):
-        log.info('initializing buddy list')
-        self.guiCallback = guiCallback
+    received_files_lock.acquire()
+    try:
+        entry = loadReceivedFiles().get('%s %s' % (address, file_name))
+    finally:
+        received_files_lock.release()
+    if not entry:
+        return None
+    path = entry['path']
+    try:
+        if os.path.getsize(path) == entry['size'] \
+            and int(os.path.getmtime(path)) == entry['mtime']:
+            return path
+    except OSError:
+        pass
+    return None
 
-        startPortableTor()
 
-        self.file_sender = {}
-        self.file_receiver = {}
+def addReceivedFile(address, file_name, path):
+    received_files_lock.acquire()
+    try:
+        files = loadReceivedFiles()
+        files['%s %s' % (address, file_name)] = {
+            'path': path,
+            'size': os.path.getsize(path),
+            'mtime': int(os.path.getmtime(path)),
+            'time': time.time(),
+            }
+        if len(files) > RECEIVED_FILES_MAX:
+            oldest = min(files, key=lambda key: files[key]['time'])
+            del files[oldest]
+        writeFileAtomic(os.path.join(config.getDataDir(),
+                        'received-files.json'), json.dumps(files))
+    except:
+        log.error('could not update the list of received files')
+        config.tb()
+    received_files_lock.release()
 
-        # temporary buddies, created from incoming pings with new hostnames
-        # these buddies are not yet in the list and if they do not
-        # answer and authenticate on the first try they will be deleted
 
-        self.incoming_buddies = []
+def getDeltaBlockSize(file_size):
 
-        self.listener = Listener(self, socket)
-        self.own_status = STATUS_ONLINE
+    # about sqrt(file_size) like rsync, but not so many that the
+    # signatures would not fit into one message
 
-        filename = os.path.join(config.getDataDir(), 'buddy-list.txt')
+    return int(max(DELTA_BLOCK_MIN, math.sqrt(file_size),
+               math.ceil(float(file_size) / DELTA_MAX_SIGNATURES)))
 
-        # create empty buddy list file if it does not already exist
 
-        f = open(filename, 'a')
-        f.close()
+def getDeltaSignature(data):
 
-        f = open(filename, 'r')
-        l = f.read().split('\n')
-        f.close
-        self.list = []
-        for line in l:
-            line = line.rstrip()
-            if len(line) > 15:
-                address = line[0:16]
-                if len(line) > 17:
-                    name = line[17:].decode('UTF-8')
-                else:
-                    name = ''
-                buddy = Buddy(address, self, name)
-                self.list.append(buddy)
+    # adler32 can be rolled over the data byte by byte (see
+    # FileSender.findDeltaMatches()), md5 confirms a match
 
-        found = False
-        for buddy in self.list:
-            if buddy.address == config.get('client', 'own_hostname'):
-                found = True
+    return struct.pack('>I8s', zlib.adler32(data) & 0xffffffff,
+                       hashlib.md5(data).digest()[:8])
 
-        if not found:
-            log.info('adding own hostname %s to list'
-                     % config.get('client', 'own_hostname'))
-            if config.get('client', 'own_hostname') \
-                != '0000000000000000':
-                self.addBuddy(Buddy(config.get('client', 'own_hostname'
-                              ), self, 'myself'))
-
-        log.info('buddy list initialized')
 
-    def save(self):
-        f = open(os.path.join(config.getDataDir(), 'buddy-list.txt'),
-                 'w')
-        for buddy in self.list:
-            line = '%s %s' % (buddy.address, buddy.name.encode('UTF-8'))
-            f.write('%s\r\n' % line.rstrip())
-        f.close()
-        log.warn('buddy list saved')
+def getAvailableCompressions():
+    available = ['zlib']
+    if lzma:
+        available.append('lzma')
+    return available
 
-    def addBuddy(self, buddy):
-        if self.getBuddyFromAddress(buddy.address) == None:
-            self.list.append(buddy)
-            buddy.setTemporary(False)
-            buddy.setActive(True)
-            if buddy in self.incoming_buddies:
-                self.incoming_buddies.remove(buddy)
-            self.save()
-            buddy.keepAlive()
-            return buddy
-        else:
-            return False
 
-    def removeBuddy(self, buddy_to_remove, disconnect=True):
-        log.warn('removeBuddy(%s, %s)' % (buddy_to_remove.address,
-                 disconnect))
-        buddy_to_remove.setActive(False)
-        if not disconnect:
+def chooseCompression(buddy):
 
-            # send remove_me and leave the connections open
-            # but remove them from this buddy.
+    # the compression to use for data sent to buddy: the one
+    # configured if the buddy knows it, otherwise zlib if the buddy
+    # knows any compression at all (or None)
 
-            buddy_to_remove.sendRemoveMe()
-            if buddy_to_remove.conn_out:
-                buddy_to_remove.conn_out.buddy = None
-                buddy_to_remove.conn_out = None
-            if buddy_to_remove.conn_in:
-                buddy_to_remove.conn_in.buddy = None
-                buddy_to_remove.conn_in = None
-        else:
-            buddy_to_remove.disconnect()
-        self.list.remove(buddy_to_remove)
-        file_name = buddy_to_remove.getOfflineFileName()
+    preferred = config.get('files', 'compression')
+    offered = buddy.getCapabilityList('compression')
+    if not preferred or not offered:
+        return None
+    if preferred in offered and preferred in getAvailableCompressions():
+        return preferred
+    if 'zlib' in offered:
+        return 'zlib'
+    return None
+
+
+def compress(algorithm, data):
+    level = config.getint('files', 'compression_level')
+    if algorithm == 'lzma':
+        return lzma.compress(str(data), preset=level)
+    return zlib.compress(data, level)
+
+
+def decompress(algorithm, data, max_size):
+
+    # raises ValueError if the result would be bigger than max_size,
+    # we don't want to be flooded by a few highly compressed bytes
+
+    if algorithm == 'zlib':
+        decompressor = zlib.decompressobj()
+        result = decompressor.decompress(data, max_size)
+        if decompressor.unconsumed_tail:
+            raise ValueError('decompressed data too big')
+        return result
+    if algorithm == 'lzma' and lzma:
+
+        # the lzma module of Python 2 (backports) cannot limit the
+        # output. We feed it small pieces, none of them can expand
+        # to more than a few MB before we notice.
+
+        decompressor = lzma.LZMADecompressor()
+        parts = []
+        size = 0
+        for pos in xrange(0, len(data), LZMA_INPUT_CHUNK):
+            part = decompressor.decompress(data[pos:pos
+                    + LZMA_INPUT_CHUNK])
+            size += len(part)
+            if size > max_size:
+                raise ValueError('decompressed data too big')
+            parts.append(part)
+        return ''.join(parts)
+    raise ValueError('unknown compression %s' % algorithm)
+
+
+def getAvailableChecksums():
+
+    # all checksum algorithms we can compute, announced to the other
+    # side in our capabilities. crc32 is only meant to detect
+    # transport errors in single blocks (Tor itself protects the data),
+    # whole files are checked with the strongest available digest.
+
+    available = ['crc32', 'md5']
+    for algorithm in FILE_DIGESTS:
         try:
-            os.unlink(file_name)
-        except:
+            hashlib.new(algorithm)
+            available.append(algorithm)
+        except ValueError:
             pass
-        self.save()
+    return available
 
-    def removeBuddyWithAddress(self, address):
-        buddy = self.getBuddyFromAddress(address)
-        if buddy != None:
-            self.removeBuddy(buddy)
 
-    def getBuddyFromAddress(self, address):
-        for buddy in self.list:
-            if buddy.address == address:
-                return buddy
-        return None
+def newDigest(algorithm):
 
-    def getIncomingBuddyFromAddress(self, address):
-        for buddy in self.incoming_buddies:
-            if buddy.address == address:
-                return buddy
-        return None
+    # a hashlib-like object, crc32 is not in hashlib
 
-    def getBuddyFromRandom(self, random):
-        for buddy in self.list:
-            if buddy.random1 == random:
-                return buddy
-        return None
+    if algorithm == 'crc32':
+        return Crc32()
+    return hashlib.new(algorithm)
 
-    def getIncomingBuddyFromRandom(self, random):
-        for buddy in self.incoming_buddies:
-            if buddy.random1 == random:
-                return buddy
-        return None
 
-    def getFileReceiver(self, address, id):
-        try:
-            return self.file_receiver[address, id]
-        except:
-            return None
+def getChecksum(algorithm, data):
 
-    def getFileSender(self, address, id):
-        try:
-            return self.file_sender[address, id]
-        except:
-            return None
+    # the hash field of a filedata message. Old clients only
+    # know md5 and send it without the algorithm prefix.
 
-    def setStatus(self, status):
-        self.own_status = status
-        for buddy in self.list:
-            buddy.sendStatus()
+    digest = newDigest(algorithm)
+    digest.update(data)
+    if algorithm == 'md5':
+        return digest.hexdigest()
+    return '%s:%s' % (algorithm, digest.hexdigest())
 
-    def onErrorIn(self, connection):
-        for buddy in self.incoming_buddies:
-            if buddy.conn_in == connection:
-                log.warn('in-connection %s of temporary buddy %s failed'
-                          % (connection, buddy.address))
-                log.warn('removing buddy instance %s' % buddy.address)
-                buddy.setActive(False)
-                buddy.disconnect()
-                if buddy in self.incoming_buddies:
-                    self.incoming_buddies.remove(buddy)
-                break
 
-        for buddy in self.list:
-            if buddy.conn_in == connection:
-                buddy.disconnect()
-                buddy.onInConnectionFail()
-                break
+def checkChecksum(hash, data):
+    if ':' in hash:
+        algorithm = hash.split(':', 1)[0]
+    else:
+        algorithm = 'md5'
+    try:
+        return getChecksum(algorithm, data) == hash
+    except ValueError:
+        log.warn('unknown checksum algorithm %s' % algorithm)
+        return False
 
-    def onErrorOut(self, connection):
-        buddy = connection.buddy
-        if buddy:
-            if buddy.temporary:
-                log.warn('out-connection of temporary buddy %s failed'
-                         % buddy.address)
-                log.warn('removing buddy instance %s' % buddy.address)
-                buddy.setActive(False)
-                if buddy in self.incoming_buddies:
-                    self.incoming_buddies.remove(buddy)
 
-            buddy.disconnect()
-            buddy.onOutConnectionFail()
-        else:
-            log.warn('out-connection without buddy failed')
+class Crc32(object):
 
-    def onConnected(self, connection):
-        connection.buddy.setStatus(STATUS_HANDSHAKE)
-        connection.buddy.onOutConnectionSuccess()
+    def __init__(self):
+        self.crc = 0
 
-    def onChatMessage(self, buddy, message):
-        self.guiCallback(CB_TYPE_CHAT, (buddy, message))
+    def update(self, data):
+        self.crc = zlib.crc32(data, self.crc)
 
-    def onFileReceive(self, file_receiver):
-        self.guiCallback(CB_TYPE_FILE, file_receiver)
+    def hexdigest(self):
+        return '%08x' % (self.crc & 0xffffffff)
 
-    def stopClient(self):
-        stopPortableTor()
-        self.listener.close()  # FIXME: does this really work?
-        for buddy in self.list + self.incoming_buddies:
-            buddy.disconnect()
 
+# --- ### Client API
 
-class FileSender(threading.Thread):
+
+class ScheduledCall(object):
+
+    # returned by callLater(), can be cancelled like a threading.Timer
 
     def __init__(
         self,
-        buddy,
-        file_name,
-        guiCallback,
+        due,
+        function,
+        args,
         ):
-        threading.Thread.__init__(self)
-        self.buddy = buddy
-        self.bl = buddy.bl
-        self.file_name = file_name
-        self.file_name_short = os.path.basename(self.file_name)
-        self.guiCallback = guiCallback
-        self.id = os.urandom(4)
-        self.buddy.bl.file_sender[self.buddy.address, self.id] = self
-        self.file_size = 0
-        self.block_size = 8192
-        self.blocks_wait = 16
-        self.start_ok = -1
-        self.restart_at = 0
-        self.restart_flag = False
-        self.completed = False
-        self.timeout_count = 0
-        self.start()
 
-    def testTimeout(self):
+        self.due = due
+        self.function = function
+        self.args = args
+        self.cancelled = False
 
-        # this will be called every 0.1 seconds whenever the sender
-        # is waiting for confirmation messages. Either in the
-        # sendBlocks() loop or when all blocks are sent in the
-        # outer loop in run()
-        # if a timeout is detected then the restart flag will be set
+    def cancel(self):
+        self.cancelled = True
 
-        if self.buddy.conn_in:
 
-            # we only increase timeout if we are connected
-            # otherwise other mechanisms are responsible and trying
-            # to get us connected again and we just wait
+class TimerScheduler(threading.Thread):
 
-            self.timeout_count += 1
-        else:
-            self.timeout_count = 0
+    # one thread for all the timers of the client (keep alive and
+    # reconnect of every buddy, timeouts of incoming connections and
+    # so on) instead of a sleeping threading.Timer thread for each of
+    # them. The calls wait in a heap ordered by due time, cancelled
+    # ones are only dropped when they are due. The functions are
+    # called in this thread one after the other, they must not block.
+    #
+    # The thread sleeps in select() on a socket pair until the next
+    # call is due or callLater() wakes it up for an earlier one. A
+    # Condition.wait() with a timeout would not do, in Python 2 it
+    # polls with sleeps of up to 50 ms.
 
-        if self.timeout_count == 6000:
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.heap = []
+        self.sequence = 0  # calls due at the same time keep their order
+        self.lock = threading.Lock()
+        (self.wakeup_in, self.wakeup_out) = socketPair()
+        self.wakeup_in.setblocking(0)
+        self.wakeup_out.setblocking(0)
+        self.start()
 
-            # ten minutes without filedata_ok
+    def callLater(self, delay, function, *args):
+        call = ScheduledCall(time.time() + delay, function, args)
+        self.lock.acquire()
+        heapq.heappush(self.heap, (call.due, self.sequence, call))
+        self.sequence += 1
+        first = self.heap[0][2] is call
+        self.lock.release()
+        if first:
+            try:
+                self.wakeup_out.send('x')
+            except socket.error:
 
-            new_start = self.start_ok + self.block_size
-            self.restart(new_start)
+                # the pipe is full, so there is already a wakeup pending
 
-            # enforce a new connection
+                pass
+        return call
 
+    def run(self):
+        while True:
+            call = None
+            delay = None
+            self.lock.acquire()
+            if self.heap:
+                delay = self.heap[0][0] - time.time()
+                if delay <= 0:
+                    call = heapq.heappop(self.heap)[2]
+            self.lock.release()
+            if call:
+                if not call.cancelled:
+                    try:
+                        call.function(*call.args)
+                    except:
+                        config.tb()
+                continue
             try:
-                self.buddy.conn_in.close()
-            except:
+                select.select([self.wakeup_in], [], [], delay)
+                while self.wakeup_in.recv(4096):
+                    pass
+            except (select.error, socket.error):
                 pass
-            log.warn('timeout file sender restart at %i' % new_start)
-
-    def canGoOn(self, start):
-        position_ok = self.start_ok + self.blocks_wait * self.block_size
-        if not self.running or self.restart_flag:
-            return True
-        else:
-            return position_ok > start
 
-    def sendBlocks(self, first):
-        blocks = int(self.file_size / self.block_size) + 1
 
-        # the inner loop (of the two loops)
+timer_scheduler = None  # see callLater()
+timer_scheduler_lock = threading.Lock()
 
-        for i in range(blocks):
-            start = i * self.block_size
 
-            # jump over already sent blocks
+def callLater(delay, function, *args):
 
-            if start >= first:
-                remaining = self.file_size - start
-                if remaining > self.block_size:
-                    size = self.block_size
-                else:
-                    size = remaining
-                self.file_handle.seek(start)
-                data = self.file_handle.read(size)
-                hash = hashlib.md5(data).hexdigest()
+    # call function(*args) in delay seconds (in the timer thread).
+    # Returns a ScheduledCall, its cancel() prevents the call.
 
-                msg = ProtocolMsg(self.bl, None, 'filedata', (self.id,
-                                  start, hash, data))
+    global timer_scheduler
+    timer_scheduler_lock.acquire()
+    if not timer_scheduler:
+        timer_scheduler = TimerScheduler()
+    timer_scheduler_lock.release()
+    return timer_scheduler.callLater(delay, function, *args)
 
-                # we can only send data if we are connected
 
-                while not self.buddy.conn_in and not self.restart_flag:
-                    time.sleep(0.1)
-                    self.testTimeout()
+def notifyCondition(cond):
+    cond.acquire()
+    cond.notifyAll()
+    cond.release()
 
-                if self.buddy.conn_in:
-                    msg.send(self.buddy, 1)
 
-                # wait for confirmations more than blocks_wait behind
+def waitCondition(cond, timeout=None):
 
-                while not self.canGoOn(start):
-                    time.sleep(0.1)
-                    self.testTimeout()  # this can trigger the restart flag
+    # like cond.wait(timeout), but without the polling Python 2 does
+    # in a wait with a timeout: the wait itself has no timeout, the
+    # timer thread notifies cond when it is over. Waiters must expect
+    # spurious wakeups, as with every Condition. cond must be acquired.
 
-                if self.restart_flag:
+    if timeout == None:
+        cond.wait()
+        return
+    call = callLater(timeout, notifyCondition, cond)
+    cond.wait()
+    call.cancel()
 
-                    # the outer loop in run() will start us again
 
-                    break
+class WorkerThread(threading.Thread):
 
-                if not self.running:
+    # one thread for the jobs that take long (reading a whole file)
+    # and therefore must not run in the network loop or the timer
+    # thread. The jobs are done one after the other in the order they
+    # were queued, they tell about their result with callInLoop().
 
-                    # the outer loop in run() will also end
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.jobs = collections.deque()
+        self.cond = threading.Condition()
+        self.start()
 
-                    break
+    def call(self, function, *args):
+        self.cond.acquire()
+        self.jobs.append((function, args))
+        self.cond.notify()
+        self.cond.release()
 
     def run(self):
-        self.running = True
-        try:
-            self.file_handle = open(self.file_name, mode='rb')
-            self.file_handle.seek(0, 2)  # SEEK_END
-            self.file_size = self.file_handle.tell()
-            self.guiCallback(self.file_size, 0)
-            filename_utf8 = self.file_name_short.encode('utf-8')
-            msg = ProtocolMsg(self.bl, None, 'filename', (self.id,
-                              self.file_size, self.block_size,
-                              filename_utf8))
-            msg.send(self.buddy, 1)
+        while True:
+            self.cond.acquire()
+            while not self.jobs:
+                self.cond.wait()
+            (function, args) = self.jobs.popleft()
+            self.cond.release()
+            try:
+                function(*args)
+            except:
+                config.tb()
 
-            # the outer loop (of the two sender loops)
-            # runs forever until completed ore canceled
 
-            while not self.completed and self.running:
-                self.restart_flag = False
+worker_thread = None  # see callInWorker()
+worker_thread_lock = threading.Lock()
 
-                # (re)start the inner loop
 
-                self.sendBlocks(self.restart_at)
+def callInWorker(function, *args):
 
-                # wait for *last* filedata_ok or restart flag
+    # call function(*args) in the worker thread
 
-                while not self.restart_flag and not self.completed \
-                    and self.running:
-                    time.sleep(0.1)
-                    self.testTimeout()  # this can trigger the restart flag
+    global worker_thread
+    worker_thread_lock.acquire()
+    if not worker_thread:
+        worker_thread = WorkerThread()
+    worker_thread_lock.release()
+    worker_thread.call(function, *args)
 
-            self.running = False
-            self.file_handle.close()
-        except:
 
-            try:
-                self.guiCallback(self.file_size, -1,
-                                 'error while sending %s'
-                                 % self.file_name)
-            except:
-                config.tb()
-            self.close()
-            config.tb()
+class ReachabilityStats(object):
 
-    def receivedOK(self, start):
-        self.timeout_count = 0  # we have received a sign of life
-        end = start + self.block_size
-        if end > self.file_size:
-            end = self.file_size
+    # what we have learned about reaching each buddy, it survives
+    # restarts (reachability.json in the data dir). It is used to
+    # choose the reconnect delay (see getReconnectDelay()) and the
+    # order of waiting connects (Buddy.getConnectPriority()).
+    # For every address:
+    #   seen          last time we got a status from the buddy
+    #   success       last successful connect
+    #   failures      failed connects since the last successful one
+    #   failing_since time of the first of them
+    #   latency       average time a successful connect takes
+    #   hours         how often the buddy was seen online at each
+    #                 hour of the day (local time)
 
+    def __init__(self):
+        self.file_name = os.path.join(config.getDataDir(),
+                'reachability.json')
+        self.lock = threading.Lock()
+        self.save_timer = None
         try:
-            self.guiCallback(self.file_size, end)
+            f = open(self.file_name)
+            self.entries = json.load(f)
+            f.close()
         except:
+            self.entries = {}
+
+    def getEntry(self, address):
+
+        # must be called with the lock held
+
+        if not address in self.entries:
+            self.entries[address] = {
+                'seen': 0,
+                'success': 0,
+                'failures': 0,
+                'failing_since': 0,
+                'latency': 0,
+                'hours': [0] * 24,
+                }
+        return self.entries[address]
+
+    def onSeen(self, address):
+        self.lock.acquire()
+        entry = self.getEntry(address)
+        entry['seen'] = time.time()
+        hours = entry['hours']
+        hours[time.localtime().tm_hour] += 1
+        if max(hours) > 10000:
+
+            # old observations slowly lose their weight
+
+            entry['hours'] = [count / 2 for count in hours]
+        self.lock.release()
+        self.changed()
+
+    def onConnectSuccess(self, address, latency):
+        self.lock.acquire()
+        entry = self.getEntry(address)
+        entry['success'] = time.time()
+        entry['failures'] = 0
+        entry['failing_since'] = 0
+        if entry['latency']:
+            entry['latency'] = 0.8 * entry['latency'] + 0.2 * latency
+        else:
+            entry['latency'] = latency
+        self.lock.release()
+        self.changed()
+
+    def onConnectFail(self, address):
+        self.lock.acquire()
+        entry = self.getEntry(address)
+        if not entry['failures']:
+            entry['failing_since'] = time.time()
+        entry['failures'] += 1
+        self.lock.release()
+        self.changed()
+
+    def forget(self, address):
+        self.lock.acquire()
+        self.entries.pop(address, None)
+        self.lock.release()
+        self.changed()
+
+    def getLastSeen(self, address):
+        entry = self.entries.get(address)
+        if entry:
+            return entry['seen']
+        return 0
+
+    def getLatency(self, address):
+        entry = self.entries.get(address)
+        if entry:
+            return entry['latency']
+        return 0
+
+    def isDormant(self, address):
+
+        # unreachable for weeks, most likely the buddy
+        # does not use this address anymore
+
+        entry = self.entries.get(address)
+        return entry != None and entry['failures'] >= DORMANT_FAILURES \
+            and time.time() - entry['failing_since'] > DORMANT_AFTER
+
+    def isUsuallyOnline(self, address):
+
+        # has been seen online at this hour of the day
+        # at least half as often as at its best hour
+
+        entry = self.entries.get(address)
+        if not entry:
+            return False
+        hours = entry['hours']
+        best = max(hours)
+        return best >= 10 and hours[time.localtime().tm_hour] * 2 >= best
 
-            # cannot update gui
+    def getReconnectDelay(self, address, failed_connects):
 
-            config.tb()
-            self.close()
+        # seconds until the next connect to a buddy that is offline.
+        # failed_connects counts the failures since this start.
+        # Random delays, a fixed pattern of activity over time
+        # could be identified at the other side.
 
-        self.start_ok = start
+        if failed_connects < 4:
+            t = random.randrange(0, 15000) / 1000.0
+        elif failed_connects < 15:
+            t = random.randrange(30000, 60000) / 1000.0
+        else:
+            t = random.randrange(300000, 600000) / 1000.0
+        if self.isDormant(address):
 
-        if end == self.file_size:
+            # one try after all the others when we start,
+            # then only every hour or two
 
-            # the outer sender loop can now stop waiting for timeout
+            if failed_connects == 0:
+                t = random.randrange(300000, 600000) / 1000.0
+            else:
+                t = random.randrange(3600000, 7200000) / 1000.0
+        elif failed_connects >= 4 and self.isUsuallyOnline(address):
+            t = min(t, random.randrange(30000, 60000) / 1000.0)
+        return t
 
-            self.completed = True
+    def changed(self):
 
-    def restart(self, start):
+        # save the changes, but not more often than every
+        # REACHABILITY_SAVE_INTERVAL seconds
 
-        # trigger the reatart flag
+        self.lock.acquire()
+        if not self.save_timer:
+            self.save_timer = callLater(REACHABILITY_SAVE_INTERVAL,
+                    self.save)
+        self.lock.release()
 
-        self.timeout_count = 0
-        self.restart_at = start
-        self.restart_flag = True
+    def save(self):
+        self.lock.acquire()
+        try:
+            if self.save_timer:
+                self.save_timer.cancel()
+                self.save_timer = None
+            writeFileAtomic(self.file_name, json.dumps(self.entries))
+        except:
+            log.error('could not save the reachability statistics')
+            config.tb()
+        self.lock.release()
 
-        # the inner loop will now immediately break and
-        # the outer loop will start it again at position restart_at
 
-    def sendStopMessage(self):
-        msg = ProtocolMsg(self.buddy.bl, None, 'file_stop_receiving',
-                          self.id)
-        msg.send(self.buddy)
+class BuddyListFile(object):
 
-    def close(self):
-        if self.running:
-            self.running = False
-            self.sendStopMessage()
-            try:
-                self.guiCallback(self.file_size, -1, 'transfer aborted')
-            except:
-                pass
-        del self.buddy.bl.file_sender[self.buddy.address, self.id]
+    # the buddy list on disk. buddy-list.txt is the complete list (one
+    # "address name" per line, the format of older versions) and is
+    # only ever replaced as a whole with writeFileAtomic(). Every
+    # change after that is appended to buddy-list.log as one line
+    #   add <address> <name>
+    #   remove <address>
+    # so adding or removing a buddy doesn't rewrite the list. Replaying
+    # a record twice does no harm, a crash during compact() therefore
+    # loses nothing, and a record cut off by a crash is just ignored.
+    # The log is compacted on every start (see BuddyList.__init__).
 
+    def __init__(self):
+        dir = config.getDataDir()
+        self.file_name = os.path.join(dir, 'buddy-list.txt')
+        self.log_name = os.path.join(dir, 'buddy-list.log')
+        self.lock = threading.Lock()
+        self.log_count = 0
 
-class FileReceiver:
+    def load(self):
 
-    def __init__(
-        self,
-        buddy,
-        id,
-        block_size,
-        file_size,
-        file_name,
-        ):
-        self.buddy = buddy
-        self.id = id
-        self.closed = False
-        self.block_size = block_size
-        self.file_name = file_name
-        self.file_name_save = ''
-        tmp = createTemporaryFile(self.file_name)
-        (self.file_name_tmp, self.file_handle_tmp) = tmp
-        self.file_size = file_size
-        self.next_start = 0
-        self.wrong_block_number_count = 0
-        self.buddy.bl.file_receiver[self.buddy.address, self.id] = self
+        # returns a list of (address, name), name is unicode
 
-        # this will (optionally) point to the file transfer GUI callback
+        entries = {}
+        order = []
 
-        self.guiCallback = None
+        def set(address, name):
+            if not address in entries:
+                order.append(address)
+            entries[address] = name
 
-        # the following will result in a call into the GUI
+        # buddy-list.txt.tmp alone is left if an older version
+        # crashed on Windows while replacing the list
 
-        self.buddy.bl.onFileReceive(self)
+        file_name = self.file_name
+        if not os.path.exists(file_name) \
+            and os.path.exists(file_name + '.tmp'):
+            file_name += '.tmp'
+        for line in self.readLines(file_name):
+            line = line.rstrip()
+            if len(line) > 15:
+                set(line[0:16], line[17:].decode('UTF-8', 'replace'))
+        for line in self.readLines(self.log_name):
+            if not line.endswith('\n'):
+                log.warn('ignoring incomplete record in %s'
+                         % self.log_name)
+                break
+            self.log_count += 1
+            words = line.rstrip('\r\n').split(' ', 2)
+            if words[0] == 'add' and len(words) > 1 \
+                and len(words[1]) == 16:
+                if len(words) > 2:
+                    set(words[1], words[2].decode('UTF-8', 'replace'))
+                else:
+                    set(words[1], u'')
+            elif words[0] == 'remove' and len(words) > 1:
+                entries.pop(words[1], None)
+        return [(address, entries[address]) for address in order
+                if address in entries]
 
-    def setCallbackFunction(self, callback):
-        self.guiCallback = callback
+    def readLines(self, file_name):
+        try:
+            f = open(file_name, 'r')
+            lines = f.readlines()
+            f.close()
+            return lines
+        except IOError:
+            return []
+
+    def hasLog(self):
+        return os.path.exists(self.log_name)
+
+    def append(self, line):
+        self.lock.acquire()
+        try:
 
-    def data(
-        self,
-        start,
-        hash,
-        data,
-        ):
-        if start > self.next_start:
-            if self.wrong_block_number_count == 0:
+            # a record cut off by a crash must not swallow this one
 
-                # not on every single out-of-order block in a row
-                # we must send an error message...
+            f = open(self.log_name, 'a+')
+            f.seek(0, 2)
+            if f.tell():
+                f.seek(-1, 2)
+                if f.read(1) != '\n':
+                    line = '\n' + line
+                f.seek(0, 2)
+            f.write(line + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            self.log_count += 1
+        finally:
+            self.lock.release()
 
-                msg = ProtocolMsg(self.buddy.bl, None, 'filedata_error'
-                                  , (self.id, self.next_start))
-                msg.send(self.buddy)
-                self.wrong_block_number_count += 1
+    def logAdd(self, address, name):
+        name = name.encode('UTF-8').replace('\r', ' ').replace('\n', ' ')
+        self.append(('add %s %s' % (address, name)).rstrip())
 
-                # ...only every 16
-                # FIXME: This must be solved more elegantly
+    def logRemove(self, address):
+        self.append('remove %s' % address)
 
-                if self.wrong_block_number_count == 16:
-                    self.wrong_block_number_count = 0
-            return
+    def needsCompact(self):
+        return self.log_count >= BUDDY_LOG_MAX
 
-        self.wrong_block_number_count = 0
-        hash2 = hashlib.md5(data).hexdigest()
-        if hash == hash2:
-            self.file_handle_tmp.seek(start)
-            self.file_handle_tmp.write(data)
-            self.next_start = start + len(data)
-            msg = ProtocolMsg(self.buddy.bl, None, 'filedata_ok',
-                              (self.id, start))
-            msg.send(self.buddy)
-            try:
-                self.guiCallback(self.file_size, start + len(data))
-            except:
+    def compact(self, entries):
 
-                # The GUI has not (yet) provided a callback function
+        # entries is the complete list of (address, name)
 
-                log.warn('FileReceiver cannot call the GUI')
-        else:
-
-            log.critical('receiver wrong hash %i len: %i' % (start,
-                         len(data)))
-            msg = ProtocolMsg(self.buddy.bl, None, 'filedata_error',
-                              (self.id, start))
-            msg.send(self.buddy)
+        self.lock.acquire()
+        try:
+            lines = [('%s %s' % (address, name.encode('UTF-8'))).rstrip()
+                     + '\r\n' for (address, name) in entries]
+            writeFileAtomic(self.file_name, ''.join(lines))
+            if os.path.exists(self.log_name):
+                os.unlink(self.log_name)
+            self.log_count = 0
+        finally:
+            self.lock.release()
+
+
+class ChatHistory(object):
+
+    # all chat messages, sent and received, in an SQLite database
+    # (chat-history.db in the data dir). The table terms is an
+    # inverted index: one row for every word of every message, so a
+    # search only has to look up its words in the primary key.
+    #
+    # If a passphrase is given the text of the messages is
+    # encrypted with AES (CTR mode, random nonce per message) and the
+    # words in the index and the buddy addresses are replaced by an
+    # HMAC of them, both with keys derived from the passphrase. This
+    # needs PyCrypto, without it the history is disabled rather than
+    # written in plain text. An existing history is never mixed with
+    # messages written in the other mode or with another passphrase.
+    # The passphrase is never stored, the GUI asks for it at startup
+    # if [history] encrypt is set (see tc_gui.getHistoryPassphrase()).
+
+    def __init__(self, passphrase=''):
+        self.lock = threading.Lock()
+        self.db = None
+        self.cipher_key = None
+        self.index_key = None
+        if not config.getint('history', 'enabled'):
+            return
+        try:
+            self.db = sqlite3.connect(os.path.join(config.getDataDir(),
+                    'chat-history.db'), check_same_thread=False)
+            self.db.text_factory = str
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT '
+                            'PRIMARY KEY, value TEXT NOT NULL)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS messages (id '
+                            'INTEGER PRIMARY KEY AUTOINCREMENT, buddy TEXT '
+                            'NOT NULL, time REAL NOT NULL, direction '
+                            'INTEGER NOT NULL, text BLOB NOT NULL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS messages_buddy '
+                            'ON messages (buddy, id)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS terms (term TEXT '
+                            'NOT NULL, message INTEGER NOT NULL, '
+                            'PRIMARY KEY (term, message))')
+            self.db.commit()
+            self.setupEncryption(passphrase)
+        except:
+            log.error('chat history disabled')
+            config.tb()
+            self.db = None
+
+    def setupEncryption(self, passphrase):
+        check = self.getMeta('check')
+        if not passphrase:
+            if check or config.getint('history', 'encrypt'):
+                raise Exception('chat history is encrypted but '
+                                'no passphrase was given')
+            return
+        if AES == None:
+            raise Exception('an encrypted chat history needs PyCrypto')
+        salt = self.getMeta('salt')
+        if not salt:
+            if self.db.execute('SELECT 1 FROM messages LIMIT 1'
+                               ).fetchall():
+                raise Exception('chat history is not encrypted, remove '
+                                'it to start an encrypted one')
+            salt = os.urandom(16).encode('hex')
+            self.setMeta('salt', salt)
+        key = hashlib.pbkdf2_hmac('sha256', passphrase, salt.decode('hex'
+                                  ), HISTORY_KEY_ROUNDS, 64)
+        self.cipher_key = key[:32]
+        self.index_key = key[32:]
+        value = self.getHash('check', 'check')
+        if not check:
+            self.setMeta('check', value)
+        elif check != value:
+            raise Exception('wrong passphrase for the chat history')
+
+    def getMeta(self, name):
+        rows = self.db.execute('SELECT value FROM meta WHERE name = ?',
+                               (name, )).fetchall()
+        if rows:
+            return rows[0][0]
+        return None
 
-            # we try to avoid unnecessary wrong-block-number errors
-            # the next block sure will be out of order, but we have sent
-            # an error already because of the wrong hash
+    def setMeta(self, name, value):
+        self.db.execute('INSERT OR REPLACE INTO meta (name, value) '
+                        'VALUES (?, ?)', (name, value))
+        self.db.commit()
+
+    def getHash(self, kind, text):
+        return hmac.new(self.index_key, kind + ' ' + text,
+                        hashlib.sha256).hexdigest()[:32]
+
+    def getBuddyKey(self, address):
+        if self.index_key:
+            return self.getHash('buddy', address)
+        return address
+
+    def getTerms(self, text):
+
+        # the distinct words of a unicode text, as they are stored
+        # in the index. Only whole words can be searched.
+
+        terms = set()
+        for word in re.findall(r'\w+', text.lower(), re.UNICODE):
+            if len(word) > HISTORY_WORD_MAX:
+                continue
+            word = word.encode('UTF-8')
+            if self.index_key:
+                word = self.getHash('term', word)
+            terms.add(word)
+        return terms
+
+    def getCipher(self, nonce):
+        counter = Counter.new(128, initial_value=long(nonce.encode('hex'
+                              ), 16))
+        return AES.new(self.cipher_key, AES.MODE_CTR, counter=counter)
+
+    def encodeText(self, text):
+        text = text.encode('UTF-8')
+        if self.cipher_key:
+            nonce = os.urandom(16)
+            text = nonce + self.getCipher(nonce).encrypt(text)
+        return buffer(text)
+
+    def decodeText(self, data):
+        data = str(data)
+        if self.cipher_key:
+            data = self.getCipher(data[:16]).decrypt(data[16:])
+        return data.decode('UTF-8', 'replace')
+
+    def add(
+        self,
+        address,
+        direction,
+        text,
+        when=None,
+        ):
 
-            self.wrong_block_number_count = 1
+        # text must be unicode, direction is HISTORY_IN or HISTORY_OUT.
+        # A broken history must never keep a message from being shown
+        # or sent, so all errors end here.
 
-    def setFileNameSave(self, file_name_save):
-        self.file_name_save = file_name_save
+        if not self.db:
+            return
+        if when == None:
+            when = time.time()
+        self.lock.acquire()
         try:
-            self.file_handle_save = open(file_name_save, 'w')
-            log.warn('created and opened placeholder file %s'
-                     % self.file_name_save)
-        except:
-            self.file_handle_save = None
-            self.file_name_save = None
-            self.file_save_error = str(sys.exc_info()[1])
-            log.warn('%s could not be created: %s'
-                     % (self.file_name_save, self.file_save_error))
+            try:
+                cursor = self.db.execute('INSERT INTO messages (buddy, '
+                        'time, direction, text) VALUES (?, ?, ?, ?)',
+                        (self.getBuddyKey(address), when, direction,
+                        self.encodeText(text)))
+                id = cursor.lastrowid
+                self.db.executemany('INSERT OR IGNORE INTO terms (term, '
+                                    'message) VALUES (?, ?)', [(term,
+                                    id) for term in self.getTerms(text)])
+                self.db.commit()
+            except:
+                log.error('could not add message to chat history')
+                config.tb()
+                self.db.rollback()
+        finally:
+            self.lock.release()
+
+    def query(self, sql, args):
+        if not self.db:
+            return []
+        self.lock.acquire()
+        try:
+            try:
+                return self.db.execute(sql, args).fetchall()
+            except:
+                log.error('chat history query failed')
+                config.tb()
+                return []
+        finally:
+            self.lock.release()
 
-    def sendStopMessage(self):
-        msg = ProtocolMsg(self.buddy.bl, None, 'file_stop_sending',
-                          self.id)
-        msg.send(self.buddy)
+    def getRecent(
+        self,
+        address,
+        limit,
+        before=None,
+        ):
 
-    def closeForced(self):
-        try:
-            self.guiCallback(self.file_size, -1, 'transfer aborted')
-        except:
-            pass
-        self.sendStopMessage()
-        self.file_name_save = ''
-        self.close()
+        # the last messages with address (older than the message with
+        # the id before), a list of (id, time, direction, text) with
+        # the oldest first
+
+        sql = 'SELECT id, time, direction, text FROM messages ' \
+            'WHERE buddy = ?'
+        args = [self.getBuddyKey(address)]
+        if before != None:
+            sql += ' AND id < ?'
+            args.append(before)
+        sql += ' ORDER BY id DESC LIMIT ?'
+        args.append(limit)
+        rows = self.query(sql, args)
+        rows.reverse()
+        return [(id, when, direction, self.decodeText(text)) for (id,
+                when, direction, text) in rows]
+
+    def search(
+        self,
+        text,
+        addresses,
+        limit=100,
+        ):
 
-    def close(self):
-        if self.closed:
+        # the newest messages that contain all words of text, a list
+        # of (address, time, direction, text) with the newest first.
+        # addresses are all addresses we know, with an encrypted
+        # history they are needed to tell whose message it is.
+
+        terms = list(self.getTerms(text))
+        if not terms:
+            return []
+        sql = 'SELECT buddy, time, direction, text FROM messages ' \
+            'WHERE id IN (%s) ORDER BY id DESC LIMIT ?' \
+            % ' INTERSECT '.join(['SELECT message FROM terms '
+                                 'WHERE term = ?'] * len(terms))
+        names = dict((self.getBuddyKey(address), address) for address in
+                     addresses)
+        return [(names.get(buddy, '?'), when, direction,
+                self.decodeText(text)) for (buddy, when, direction,
+                text) in self.query(sql, terms + [limit])]
+
+    def rename(self, address_old, address_new):
+        if not self.db:
             return
+        self.lock.acquire()
         try:
-            self.file_handle_tmp.close()
-            if self.file_name_save:
-                self.file_handle_save.close()
-                shutil.move(self.file_name_tmp, self.file_name_save)
-                log.warn('moved temporary file to %s'
-                         % self.file_name_save)
-            else:
-                os.unlink(self.file_name_tmp)
-                log.warn('deleted temporary file %s'
-                         % self.file_name_tmp)
-            del self.buddy.bl.file_receiver[self.buddy.address, self.id]
-        except:
-            pass
-
-        self.closed = True
+            try:
+                self.db.execute('UPDATE messages SET buddy = ? WHERE '
+                                'buddy = ?', (self.getBuddyKey(address_new),
+                                self.getBuddyKey(address_old)))
+                self.db.commit()
+            except:
+                log.error('could not rename %s in chat history'
+                          % address_old)
+                config.tb()
+                self.db.rollback()
+        finally:
+            self.lock.release()
+
+
+class OfflineMessageStore(object):
+
+    # chat messages for buddies that are offline, one record per
+    # message in an SQLite database (offline-messages.db in the data
+    # dir). A message is only deleted when the buddy has confirmed it
+    # with offline_message_ok (or it has been sent to an old client
+    # which cannot confirm anything). Used from several threads,
+    # every access goes through the lock.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(config.getDataDir(),
+                                  'offline-messages.db'),
+                                  check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS messages (id INTEGER '
+                        'PRIMARY KEY AUTOINCREMENT, address TEXT NOT NULL, '
+                        'time REAL NOT NULL, text TEXT NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS messages_address '
+                        'ON messages (address, id)')
+        self.db.commit()
+        self.importTextFiles()
+
+    def execute(self, query, args=()):
+        self.lock.acquire()
+        try:
+            cursor = self.db.execute(query, args)
+            rows = cursor.fetchall()
+            self.db.commit()
+            return (rows, cursor.lastrowid)
+        finally:
+            self.lock.release()
 
+    def importTextFiles(self):
 
-# --- ### Protocol messages
+        # older versions had a text file <address>_offline.txt for
+        # every buddy, each message on a line starting with [delayed]
 
+        dir = config.getDataDir()
+        for file_name in os.listdir(dir):
+            if not file_name.endswith('_offline.txt') \
+                or len(file_name) != 28:
+                continue
+            address = file_name[:16]
+            path = os.path.join(dir, file_name)
+            try:
+                f = open(path)
+                lines = f.read().decode('UTF-8', 'replace').split('\n')
+                f.close()
+                messages = []
+                for line in lines:
+                    if line.startswith('[delayed] '):
+                        messages.append(line[10:])
+                    elif messages:
+                        messages[-1] += '\n' + line
+                    elif line:
+                        messages.append(line)
+                when = os.path.getmtime(path)
+                for text in messages:
+                    self.add(address, text.rstrip(), when)
+                os.unlink(path)
+                log.info('imported %i offline messages for %s'
+                         % (len(messages), address))
+            except:
+                log.error('could not import %s' % path)
+                config.tb()
 
-class MProtocolMsg(type):
+    def add(
+        self,
+        address,
+        text,
+        when=None,
+        ):
 
-    # Meta-Class for ProtocolMsg. It automagically creates a hash for
-    # mapping protocol-commands and corresponding ProtocolMsg-subclasses
+        # text must be unicode, returns the id of the new message
 
-    subclasses = {}
+        if when == None:
+            when = time.time()
+        return self.execute('INSERT INTO messages (address, time, text) '
+                            'VALUES (?, ?, ?)', (address, when,
+                            text))[1]
 
-    def __init__(
-        cls,
-        name,
-        bases,
-        dict,
+    def getMessages(
+        self,
+        address,
+        after=0,
+        limit=-1,
         ):
 
-        # this will be executed whenever a ProtocolMsg gets *defined*
-        # (happens once at the time when this module is imported).
-        # the commands and their classes will be stored in
-        # the static member MProtocolMsg.subclasses
+        # list of (id, time, text) in the order they were stored
 
-        cls.subclasses[dict['command']] = cls
-        super(MProtocolMsg, cls).__init__(name, bases, dict)
+        return self.execute('SELECT id, time, text FROM messages WHERE '
+                            'address = ? AND id > ? ORDER BY id LIMIT ?',
+                            (address, after, limit))[0]
 
+    def has(self, address):
+        return len(self.execute('SELECT 1 FROM messages WHERE address = ? '
+                   'LIMIT 1', (address, ))[0]) > 0
 
-class ProtocolMsg(object):
+    def remove(self, address, id):
+        self.execute('DELETE FROM messages WHERE address = ? AND id = ?',
+                     (address, id))
 
-    __metaclass__ = MProtocolMsg
-    command = ''
+    def removeAll(self, address):
+        self.execute('DELETE FROM messages WHERE address = ?', (address, ))
 
-    # the base class for all ProtocolMsg-classes. All message classes
-    # must inherit from this and declare the static member command
-    # which is used (by the metaclass-magic-voodoo;-) to map between the
-    # command-string and the corresponding message class
+    def rename(self, address_old, address_new):
+        self.execute('UPDATE messages SET address = ? WHERE address = ?',
+                     (address_new, address_old))
 
-    # Besides being the base class for all ProtocolMsg_* classes
-    # this class has two other use cases:
-    # - it is used for outgoing messages (therefore the send method)
-    # - it is instantiated for every unknown incoming message
+
+class Buddy(object):
 
     def __init__(
         self,
-        bl,
-        connection,
-        command,
-        data,
+        address,
+        buddy_list,
+        name='',
+        temporary=False,
         ):
+        log.warn('(2) initializing buddy %s, temporary=%s' % (address,
+                 temporary))
+        self.bl = buddy_list
+        self.address = address
+        self.name = name
+        self.random1 = os.urandom(32)
+        self.random2 = os.urandom(32)
+        self.conn_out = None
+        self.conn_in = None
+        self.status = STATUS_OFFLINE
+        self.can_send = False
+        self.version = ''
+        self.capabilities = {}
+        self.capabilities_received = False
+        self.link_rate = 0  # bytes/s of the last file transfer
+        self.offline_pending = False  # see sendOfflineMessages()
+        self.offline_unconfirmed = set()
+        self.offline_last_id = 0
+        self.offline_received = set()  # ids of offline messages we got
+        self.timer = False
+        self.last_status_time = 0
+        self.count_failed_connects = 0
+        self.active = True
+        self.temporary = temporary
+        self.startTimer()
 
-        # connection may be None for outgoing messages
-        # data can be a number, a string, a tuple or a list
+    def connect(self):
+        log.warn('%s.connect()' % self.address)
+        if self.conn_out == None:
+            self.conn_out = OutConnection(self.address + '.onion',
+                    self.bl, self)
+            self.sendPing()
 
-        self.connection = connection
-        if connection:
-            self.buddy = connection.buddy
+    def disconnect(self):
+        log.warn('%s.disconnect()' % self.address)
+        if self.conn_out != None:
+            self.conn_out.close()
+            self.conn_out = None
+        if self.conn_in != None:
+            self.conn_in.close()
+            self.setConnIn(None)
+        self.setStatus(STATUS_OFFLINE)
+        self.can_send = False
+
+        # the other side might come back with a different version
+
+        self.capabilities = {}
+        self.capabilities_received = False
+
+        # offline messages without confirmation are sent again
+
+        self.offline_pending = False
+        self.offline_unconfirmed = set()
+        self.offline_last_id = 0
+
+    def onOutConnectionFail(self):
+        log.warn('%s.onOutConnectionFail()' % self.address)
+        self.count_failed_connects += 1
+        self.startTimer()
+
+    def onInConnectionFail(self):
+        log.warn('%s.onInConnectionFail()' % self.address)
+        self.resetConnectionFailCounter()
+        self.startTimer()
+
+    def onOutConnectionSuccess(self):
+        log.warn('%s.onOutConnectionSuccess()' % self.address)
+        self.startTimer()
+
+    def onInConnectionFound(self, connection):
+        log.warn('%s.onInConnectionFound()' % self.address)
+        conn_old = self.conn_in
+        if conn_old == connection:
+            log.warn('this connection is already the current conn_in. doing nothing.'
+                     )
+            return
+
+        self.setConnIn(connection)
+        connection.buddy = self
+        if conn_old:
+            log.warn('closing old connection of %s, %s'
+                     % (self.address, conn_old))
+            log.warn('new connection is %s' % connection)
+            conn_old.buddy = None
+            conn_old.close()
+
+    def setConnIn(self, connection):
+
+        # conn_in must only be changed here, the buddy list
+        # keeps an index of all incoming connections
+
+        self.bl.onConnInChanged(self, self.conn_in, connection)
+        self.conn_in = connection
+        self.bl.transfers.wakeUpBuddy(self)
+
+    def resetConnectionFailCounter(self):
+        self.count_failed_connects = 0
+
+    def setActive(self, active):
+        log.warn('%s.setActive(%s)' % (self.address, active))
+        self.active = active
+
+    def setTemporary(self, temporary):
+        log.warn('%s.setTemporary(%s)' % (self.address, temporary))
+        self.temporary = temporary
+
+    def setStatus(self, status):
+        if status != STATUS_OFFLINE or self.status != STATUS_OFFLINE:
+            self.resetConnectionFailCounter()
+        changed = status != self.status
+        self.status = status
+        self.last_status_time = time.time()
+        if changed and self.bl.isListed(self):
+            self.bl.guiCallback(CB_TYPE_BUDDY_CHANGED, self)
+        if status not in (STATUS_OFFLINE, STATUS_HANDSHAKE) \
+            and not self.temporary:
+            self.bl.reachability.onSeen(self.address)
+
+    def addToList(self):
+        log.warn('%s.addToList()' % self.address)
+        self.bl.addBuddy(self)
+
+    def sendMsg(self, msg, conn=0):
+
+        # conn: use outgiong or incoming connection
+
+        if self.conn_out == None:
+            self.connect()
+        if conn == 0:
+            self.conn_out.sendMsg(msg)
         else:
-            self.buddy = None
-        self.bl = bl
-        self.command = command
+            if self.conn_in:
+                self.conn_in.sendMsg(msg)
+            else:
 
-        # self.text is always a string containing all arguments and data
+                # FIXME: handle this condition
 
-        if type(data) in (list, tuple):
-            self.text = ' '.join(str(x) for x in data)
+                pass
+
+    def setCapabilities(self, capabilities):
+
+        # capabilities is a list of words, some of them can
+        # have a value attached (name=value)
+
+        self.capabilities = {}
+        self.capabilities_received = True
+        for word in capabilities:
+            if '=' in word:
+                (name, value) = word.split('=', 1)
+            else:
+                (name, value) = (word, '')
+            self.capabilities[name] = value
+
+        # file senders and the offline messages had to wait for this
+
+        self.bl.transfers.wakeUpBuddy(self)
+
+        if self.offline_pending:
+            self.offline_pending = False
+            self.sendOfflineMessages()
+
+    def supports(self, capability):
+        return capability in self.capabilities
+
+    def getCapabilityList(self, capability):
+
+        # for capabilities like checksums=crc32,md5
+
+        value = self.capabilities.get(capability, '')
+        return [x for x in value.split(',') if x]
+
+    def sendChatMessage(self, text):
+
+        # text must be unicode
+
+        if self.can_send:
+            self.bl.history.add(self.address, HISTORY_OUT, text)
+            message = self.createChatMessage(text.encode('UTF-8'))
+            message.send(self)
         else:
-            self.text = str(data)
-        self.parse()
+            self.storeOfflineChatMessage(text)
 
-    def parse(self):
-        pass
+    def createChatMessage(self, text):
 
-    def execute(self):
+        # text must be UTF-8. Long messages are compressed
+        # if the buddy can decompress them.
+
+        compression = chooseCompression(self)
+        if compression and len(text) >= MESSAGE_COMPRESS_MIN:
+            compressed = compress(compression, text)
+            if len(compressed) < len(text) * (1
+                    - COMPRESSION_MIN_SAVING):
+                return ProtocolMsg(self.bl, None, 'message_compressed',
+                                   compression, compressed)
+        return ProtocolMsg(self.bl, None, 'message', text)
+
+    def storeOfflineChatMessage(self, text):
+
+        # text must be unicode
+
+        log.warn('storing offline message to %s' % self.address)
+        self.bl.history.add(self.address, HISTORY_OUT, text)
+        self.bl.offline.add(self.address, text)
+
+    def hasOfflineMessages(self):
+        return self.bl.offline.has(self.address)
+
+    def clearOfflineMessages(self):
+        self.bl.offline.removeAll(self.address)
+
+    def getConnectPriority(self):
+
+        # the order in which waiting connection attempts are started
+        # (see ConnectScheduler), smaller first: buddies that have been
+        # online recently, then those we have offline messages for,
+        # then all others by their number of failed connects (the ones
+        # unreachable for weeks last) and how fast they usually connect.
+
+        stats = self.bl.reachability
+        recent = time.time() - stats.getLastSeen(self.address) \
+            < RECENTLY_ACTIVE
+        return (not recent, not self.hasOfflineMessages(),
+                stats.isDormant(self.address), self.count_failed_connects,
+                stats.getLatency(self.address))
+
+    def getOfflineMessages(self):
+
+        # all waiting messages in one unicode string (for display)
+
+        return '\n'.join('[delayed] ' + text for (id, when, text) in
+                         self.bl.offline.getMessages(self.address))
+
+    def sendOfflineMessages(self):
+
+        # this will be called after the answer to the ping message.
+        # we send without checking online status. because we have sent
+        # a pong before, the receiver will have set the status to online.
+        # The capabilities decide how they are sent, if they are not
+        # known yet setCapabilities() will call us again.
+
+        if not self.capabilities_received:
+            self.offline_pending = True
+            return
+        if self.supports('offline_message'):
+            self.sendMoreOfflineMessages()
+            return
+
+        # old clients get every message as a normal chat message,
+        # they cannot confirm them
+
+        messages = self.bl.offline.getMessages(self.address)
+        if messages:
+            log.warn('sending offline messages to %s' % self.address)
+            for (id, when, text) in messages:
+                message = self.createChatMessage(('[delayed] '
+                        + text).encode('UTF-8'))
+                message.send(self)
+                self.bl.offline.remove(self.address, id)
+            self.bl.guiCallback(CB_TYPE_OFFLINE_SENT, self)
+
+    def sendMoreOfflineMessages(self):
+
+        # one offline_message for every stored message, each one stays
+        # in the store until it is confirmed. At most OFFLINE_WINDOW
+        # are on their way at the same time, every confirmation lets
+        # the next one go.
+
+        count = OFFLINE_WINDOW - len(self.offline_unconfirmed)
+        if count <= 0:
+            return
+        messages = self.bl.offline.getMessages(self.address,
+                self.offline_last_id, count)
+        if messages and not self.offline_last_id:
+            log.warn('sending offline messages to %s' % self.address)
+        for (id, when, text) in messages:
+            self.offline_unconfirmed.add(id)
+            self.offline_last_id = id
+            message = ProtocolMsg(self.bl, None, 'offline_message', (id,
+                                  int(when), text.encode('UTF-8')))
+            message.send(self)
+
+    def onOfflineMessageConfirmed(self, id):
+        if id not in self.offline_unconfirmed:
+            return
+        self.offline_unconfirmed.discard(id)
+        self.bl.offline.remove(self.address, id)
+        self.sendMoreOfflineMessages()
+        if not self.offline_unconfirmed:
+            self.bl.guiCallback(CB_TYPE_OFFLINE_SENT, self)
+
+    def getDisplayNameOrAddress(self):
+        if self.name == '':
+            return self.address
+        else:
+            return self.name
+
+    def getAddressAndDisplayName(self):
+        if self.name == '':
+            return self.address
+        else:
+            return self.address + ' (' + self.name + ')'
+
+    def sendFile(self, filename, gui_callback):
+        sender = FileSender(self, filename, gui_callback)
+        return sender
+
+    def sendFiles(self, filenames, gui_callback):
+
+        # several files and/or directories in one transfer
+
+        sender = FileSender(self, getArchiveName(filenames), gui_callback,
+                            files=filenames)
+        return sender
+
+    def startTimer(self):
+        if not self.active:
+            log.warn('%s is not active. Will not start a new timer'
+                     % self.address)
+            return
+
+        if self.status == STATUS_OFFLINE:
+            t = self.bl.reachability.getReconnectDelay(self.address,
+                    self.count_failed_connects)
+            log.warn('%s had %i failed connections. Setting timer to %f seconds'
+                      % (self.address, self.count_failed_connects, t))
+        else:
+
+            # whenever we are connected to someone we use a fixed timer.
+            # otherwise we would create a unique pattern of activity
+            # over time that could be identified at the other side
+
+            t = 60
+
+        if self.timer:
+            self.timer.cancel()
+        self.timer = callLater(t, self.onTimer)
+
+    def onTimer(self):
+        log.fatal('timer event for %s' % self.address)
+        if not self.active:
+            log.info("%s is not active, onTimer() won't do anything"
+                     % self.address)
+            return
+
+        self.keepAlive()
+
+        if self.status != STATUS_OFFLINE and time.time() \
+            - self.last_status_time > config.get('internal',
+                'dead_connection_timeout'):
+
+            # long time without status is indicating a broken link
+            # disconnect to give it a chance to reconnect
+
+            log.info('%s reveived no status update for a long time. disconnecting'
+                      % self.address)
+            self.disconnect()  # this will trigger outConnectionFail()
+
+        # only restart the timer automatically if we are connected (or handshaking).
+        # else it will be restarted by outConnectionFail() / outConnectionSuccess()
+
+        if self.status != STATUS_OFFLINE:
+            self.startTimer()
+
+    def keepAlive(self):
+        if self.conn_out == None:
+            self.connect()
+        else:
+            if self.conn_in:
+                self.sendStatus()
+            else:
+                if self.status == STATUS_HANDSHAKE:
+                    self.sendPing()
+
+    def sendPing(self):
+        log.warn('%s.sendPing()' % self.address)
+
+        # self.random1 = str(random.getrandbits(256))
+
+        ping = ProtocolMsg(self.bl, None, 'ping', (config.get('client',
+                           'own_hostname'), self.random1))
+        ping.send(self)
+
+    def sendStatus(self):
+        if self.conn_out != None:
+            status = ''
+            if self.bl.own_status == STATUS_ONLINE:
+                status = 'available'
+            if self.bl.own_status == STATUS_AWAY:
+                status = 'away'
+            if self.bl.own_status == STATUS_XA:
+                status = 'xa'
+            if status != '':
+                msg = ProtocolMsg(self.bl, None, 'status', status)
+                msg.send(self)
+
+    def sendAddMe(self):
+        msg = ProtocolMsg(self.bl, None, 'add_me', '')
+        msg.send(self)
+
+    def sendRemoveMe(self):
+        if self.conn_in:
+            msg = ProtocolMsg(self.bl, None, 'remove_me', '')
+            msg.send(self)
+
+    def sendVersion(self):
+        msg = ProtocolMsg(self.bl, None, 'version', version.VERSION)
+        msg.send(self)
+
+        # clients that don't know about capabilities will
+        # answer with not_implemented and we stay compatible
+
+        msg = ProtocolMsg(self.bl, None, 'capabilities',
+                          getOwnCapabilities())
+        msg.send(self)
+
+    def getDisplayName(self):
+        if self.name != '':
+            line = '%s (%s)' % (self.address, self.name)
+        else:
+            line = self.address
+        return line
+
+
+class BuddyList(object):
+
+    # the buddy list object is somewhat like a central API.
+    # All functionality and access to all other objects should
+    # be possible with it's methods. Most other objects carry
+    # a reference to the one and only BuddyList object around
+    # to be able to find and interact with other objects.
+
+    def __init__(
+        self,
+        guiCallback,
+        socket=None,
+        history_passphrase='',
+        ):
+        log.info('initializing buddy list')
+        self.guiCallback = guiCallback
+
+        startPortableTor()
+
+        # all running file transfers, they share the bandwidth
+        # through the scheduler
+
+        self.transfers = TransferScheduler()
+
+        # new out-connections wait here until Tor has time for them
+
+        self.connects = ConnectScheduler()
+
+        # connection history of all buddies, decides when and in
+        # which order we try to connect them
+
+        self.reachability = ReachabilityStats()
+
+        # chat messages waiting until their buddy comes online
+
+        self.offline = OfflineMessageStore()
+
+        # everything that was said, see ChatHistory
+
+        self.history = ChatHistory(history_passphrase)
+
+        # saved states of incoming transfers that were interrupted by
+        # the last shutdown, waiting for the sender to announce them again
+
+        self.resumable_receivers = {}
+
+        # all socket I/O is done in this one thread
+
+        self.network = NetworkLoop()
+
+        # temporary buddies, created from incoming pings with new hostnames
+        # these buddies are not yet in the list and if they do not
+        # answer and authenticate on the first try they will be deleted
+
+        self.incoming_buddies = []
+
+        # indexes for the lookups that are done on every ping and pong.
+        # they must be kept consistent with self.list and
+        # self.incoming_buddies, so never change these lists directly.
+
+        self.buddy_by_address = {}
+        self.buddy_by_random = {}
+        self.incoming_by_address = {}
+        self.incoming_by_random = {}
+        self.buddy_by_conn_in = {}
+
+        self.listener = Listener(self, socket)
+        self.own_status = STATUS_ONLINE
+
+        self.list = []
+        self.list_file = BuddyListFile()
+        for (address, name) in self.list_file.load():
+            buddy = Buddy(address, self, name)
+            self.list.append(buddy)
+            self.buddy_by_address[buddy.address] = buddy
+            self.buddy_by_random[buddy.random1] = buddy
+
+        # fold the changes of the last session into the list file,
+        # this also gets rid of a record cut off by a crash
+
+        if self.list_file.hasLog():
+            self.save()
+
+        found = self.getBuddyFromAddress(config.get('client',
+                'own_hostname'))
+
+        if not found:
+            log.info('adding own hostname %s to list'
+                     % config.get('client', 'own_hostname'))
+            if config.get('client', 'own_hostname') \
+                != '0000000000000000':
+                self.addBuddy(Buddy(config.get('client', 'own_hostname'
+                              ), self, 'myself'))
+
+        self.resumeTransfers()
+
+        log.info('buddy list initialized')
+
+    def save(self):
+
+        # write the complete list, addBuddy() and removeBuddy()
+        # only append their change to the log (see BuddyListFile)
+
+        try:
+            self.list_file.compact([(buddy.address, buddy.name)
+                                   for buddy in self.list])
+            log.warn('buddy list saved')
+        except:
+            log.error('could not save buddy list')
+            config.tb()
+
+    def saveChange(self, buddy, added):
+        try:
+            if added:
+                self.list_file.logAdd(buddy.address, buddy.name)
+            else:
+                self.list_file.logRemove(buddy.address)
+        except:
+            log.error('could not save buddy list change')
+            config.tb()
+        if self.list_file.needsCompact():
+            self.save()
+
+    def addBuddy(self, buddy):
+        if self.getBuddyFromAddress(buddy.address) == None:
+            self.list.append(buddy)
+            self.buddy_by_address[buddy.address] = buddy
+            self.buddy_by_random[buddy.random1] = buddy
+            buddy.setTemporary(False)
+            buddy.setActive(True)
+            self.removeIncomingBuddy(buddy)
+            self.saveChange(buddy, True)
+            self.guiCallback(CB_TYPE_BUDDY_ADDED, buddy)
+            buddy.keepAlive()
+            return buddy
+        else:
+            return False
+
+    def removeBuddy(self, buddy_to_remove, disconnect=True):
+        log.warn('removeBuddy(%s, %s)' % (buddy_to_remove.address,
+                 disconnect))
+        buddy_to_remove.setActive(False)
+        if not disconnect:
+
+            # send remove_me and leave the connections open
+            # but remove them from this buddy.
+
+            buddy_to_remove.sendRemoveMe()
+            if buddy_to_remove.conn_out:
+                buddy_to_remove.conn_out.buddy = None
+                buddy_to_remove.conn_out = None
+            if buddy_to_remove.conn_in:
+                buddy_to_remove.conn_in.buddy = None
+                buddy_to_remove.setConnIn(None)
+        else:
+            buddy_to_remove.disconnect()
+        self.list.remove(buddy_to_remove)
+        del self.buddy_by_address[buddy_to_remove.address]
+        del self.buddy_by_random[buddy_to_remove.random1]
+        self.reachability.forget(buddy_to_remove.address)
+        self.offline.removeAll(buddy_to_remove.address)
+        self.saveChange(buddy_to_remove, False)
+        self.guiCallback(CB_TYPE_BUDDY_REMOVED, buddy_to_remove)
+
+    def removeBuddyWithAddress(self, address):
+        buddy = self.getBuddyFromAddress(address)
+        if buddy != None:
+            self.removeBuddy(buddy)
+
+    def setBuddyAddress(self, buddy, address):
+
+        # the address is the key of the index, so it
+        # must not be changed without telling us
+
+        if self.buddy_by_address.get(buddy.address) is buddy:
+            del self.buddy_by_address[buddy.address]
+            self.buddy_by_address[address] = buddy
+        self.offline.rename(buddy.address, address)
+        self.history.rename(buddy.address, address)
+        buddy.address = address
+        self.guiCallback(CB_TYPE_BUDDY_CHANGED, buddy)
+
+    def isListed(self, buddy):
+
+        # True if buddy is on the buddy list (and not temporary)
+
+        return self.buddy_by_address.get(buddy.address) is buddy
+
+    def addIncomingBuddy(self, buddy):
+        self.incoming_buddies.append(buddy)
+        self.incoming_by_address[buddy.address] = buddy
+        self.incoming_by_random[buddy.random1] = buddy
+
+    def removeIncomingBuddy(self, buddy):
+        if self.incoming_by_address.get(buddy.address) is buddy:
+            self.incoming_buddies.remove(buddy)
+            del self.incoming_by_address[buddy.address]
+            del self.incoming_by_random[buddy.random1]
+
+    def getBuddyFromAddress(self, address):
+        return self.buddy_by_address.get(address)
+
+    def getIncomingBuddyFromAddress(self, address):
+        return self.incoming_by_address.get(address)
+
+    def getBuddyFromRandom(self, random):
+        return self.buddy_by_random.get(random)
+
+    def getIncomingBuddyFromRandom(self, random):
+        return self.incoming_by_random.get(random)
+
+    def getBuddyFromConnIn(self, connection):
+
+        # the buddy (listed or incoming) which has
+        # connection as its conn_in, or None
+
+        buddy = self.buddy_by_conn_in.get(connection)
+        if buddy and buddy.conn_in is connection:
+            return buddy
+        return None
+
+    def onConnInChanged(
+        self,
+        buddy,
+        conn_old,
+        conn_new,
+        ):
+        if conn_old and self.buddy_by_conn_in.get(conn_old) is buddy:
+            del self.buddy_by_conn_in[conn_old]
+        if conn_new:
+            self.buddy_by_conn_in[conn_new] = buddy
+
+    def getFileReceiver(self, address, id):
+        try:
+            return self.transfers.receivers[address, id]
+        except:
+            return None
+
+    def getFileSender(self, address, id):
+        try:
+            return self.transfers.senders[address, id]
+        except:
+            return None
+
+    def setStatus(self, status):
+        self.own_status = status
+        for buddy in self.list:
+            buddy.sendStatus()
+
+    def onErrorIn(self, connection):
+        buddy = self.getBuddyFromConnIn(connection)
+        if not buddy:
+            return
+
+        if self.getIncomingBuddyFromAddress(buddy.address) is buddy:
+            log.warn('in-connection %s of temporary buddy %s failed'
+                     % (connection, buddy.address))
+            log.warn('removing buddy instance %s' % buddy.address)
+            buddy.setActive(False)
+            buddy.disconnect()
+            self.removeIncomingBuddy(buddy)
+        elif self.isListed(buddy):
+            buddy.disconnect()
+            buddy.onInConnectionFail()
+
+    def onErrorOut(self, connection):
+        buddy = connection.buddy
+        if buddy and not buddy.temporary \
+            and connection.state != 'connected':
+            self.reachability.onConnectFail(buddy.address)
+        if buddy:
+            if buddy.temporary:
+                log.warn('out-connection of temporary buddy %s failed'
+                         % buddy.address)
+                log.warn('removing buddy instance %s' % buddy.address)
+                buddy.setActive(False)
+                self.removeIncomingBuddy(buddy)
+
+            buddy.disconnect()
+            buddy.onOutConnectionFail()
+        else:
+            log.warn('out-connection without buddy failed')
+
+    def onConnected(self, connection):
+        if not connection.buddy.temporary:
+            self.reachability.onConnectSuccess(connection.buddy.address,
+                    time.time() - connection.connect_started)
+        connection.buddy.setStatus(STATUS_HANDSHAKE)
+        connection.buddy.onOutConnectionSuccess()
+
+    def onChatMessage(self, buddy, message):
+        self.history.add(buddy.address, HISTORY_IN, message)
+        self.guiCallback(CB_TYPE_CHAT, (buddy, message))
+
+    def searchHistory(self, text):
+        return self.history.search(text, [buddy.address for buddy in
+                                   self.list + self.incoming_buddies])
+
+    def onFileReceive(self, file_receiver):
+        self.guiCallback(CB_TYPE_FILE, file_receiver)
+
+    def onFileResume(self, file_sender):
+        self.guiCallback(CB_TYPE_FILE_RESUME, file_sender)
+
+    def resumeTransfers(self):
+
+        # continue the file transfers that were interrupted by the last
+        # shutdown (as far as the files and buddies are still there)
+
+        for (name, state) in loadTransferStates():
+            try:
+                address = str(state['address'])
+                id = str(state['id']).decode('hex')
+                buddy = self.getBuddyFromAddress(address)
+                if not buddy:
+                    deleteTransferState(name)
+                elif name.startswith('send_'):
+                    file_name = state['file_name']
+                    files = state.get('files')
+                    if files:
+                        size = ArchiveSource(files).size
+                    elif os.path.exists(file_name):
+                        size = os.path.getsize(file_name)
+                    else:
+                        size = -1
+                    if size == state['file_size']:
+                        self.onFileResume(FileSender(buddy, file_name,
+                                          ignoreCallback, state, files))
+                    else:
+                        log.warn('%s has changed, not resuming'
+                                 % file_name)
+                        deleteTransferState(name)
+                else:
+                    self.resumable_receivers[address, id] = state
+            except:
+                log.error('could not resume transfer %s' % name)
+                config.tb()
+                deleteTransferState(name)
+
+    def popResumableReceiver(self, address, id):
+        state = self.resumable_receivers.pop((address, id), None)
+        if state:
+            deleteTransferState('receive_%s_%s' % (address,
+                                id.encode('hex')))
+        return state
+
+    def stopClient(self):
+        stopPortableTor()
+
+        # save the state of all unfinished transfers before
+        # the connections are closed, they continue on next start
+
+        for sender in self.transfers.senders.values():
+            sender.checkpoint(True)
+        for receiver in self.transfers.receivers.values():
+            receiver.checkpoint(True)
+        self.reachability.save()
+        self.listener.close()
+        for buddy in self.list + self.incoming_buddies:
+            buddy.disconnect()
+        self.network.close()
+
+
+def getArchiveName(file_names):
+
+    # the name under which a directory or multi file transfer
+    # is offered to the receiver
+
+    if len(file_names) == 1:
+        return os.path.abspath(file_names[0])
+    return os.path.dirname(os.path.commonprefix([os.path.abspath(name)
+                           + os.sep for name in file_names]))
+
+
+def getTarPadding(size):
+    return (TAR_BLOCK - size % TAR_BLOCK) % TAR_BLOCK
+
+
+class ArchiveSource(object):
+
+    # a tar archive of several files and directories which is never
+    # written anywhere. read() assembles any part of it on demand from
+    # the tar headers (generated once) and the files themselves, so it
+    # can be sent with the same random access as a single file.
+
+    def __init__(self, file_names):
+        self.members = []  # (offset, header, path, size)
+        self.offsets = []
+        self.size = 0
+        self.handle = None
+        self.handle_path = None
+        for file_name in file_names:
+            file_name = os.path.abspath(file_name)
+            if os.path.isdir(file_name) and len(file_names) == 1:
+
+                # a single directory is sent with its contents,
+                # the receiver saves it under a name of its choice
+
+                self.addDirectory(file_name, '')
+            elif os.path.isdir(file_name):
+                self.addDirectory(file_name, os.path.basename(file_name))
+            else:
+                self.addMember(file_name, os.path.basename(file_name))
+
+        # the end of the archive are two empty blocks
+
+        self.end = self.size
+        self.size += 2 * TAR_BLOCK
+
+    def addDirectory(self, path, arcname):
+        if arcname:
+            self.addMember(path, arcname)
+        for name in sorted(os.listdir(path)):
+            full_name = os.path.join(path, name)
+            if os.path.isdir(full_name) and not os.path.islink(full_name):
+                self.addDirectory(full_name, os.path.join(arcname, name))
+            elif os.path.isfile(full_name):
+                self.addMember(full_name, os.path.join(arcname, name))
+
+    def addMember(self, path, arcname):
+        info = tarfile.TarInfo(arcname.replace(os.sep, '/'))
+        stat = os.stat(path)
+        info.mtime = stat.st_mtime
+        if os.path.isdir(path):
+            info.type = tarfile.DIRTYPE
+            info.mode = 0755
+            size = 0
+        else:
+            info.mode = 0644
+            size = stat.st_size
+        info.size = size
+        header = info.tobuf(tarfile.GNU_FORMAT, 'utf-8')
+        self.members.append((self.size, header, path, size))
+        self.offsets.append(self.size)
+        self.size += len(header) + size + getTarPadding(size)
+
+    def readMember(self, path, pos, size):
+        if self.handle_path != path:
+            if self.handle:
+                self.handle.close()
+            self.handle = open(path, 'rb')
+            self.handle_path = path
+        self.handle.seek(pos)
+        data = self.handle.read(size)
+        if len(data) < size:
+
+            # the file has shrunk since we started, the
+            # digest will tell the receiver that it is broken
+
+            log.warn('%s has changed while sending it' % path)
+            data += '\0' * (size - len(data))
+        return data
+
+    def read(self, start, size):
+        parts = []
+        index = bisect.bisect_right(self.offsets, start) - 1
+        end = min(start + size, self.size)
+        while start < end:
+            if index >= len(self.members) or start >= self.end:
+                parts.append('\0' * (end - start))
+                break
+            (offset, header, path, member_size) = self.members[index]
+            pos = start - offset
+            if pos < len(header):
+                chunk = header[pos:pos + end - start]
+            elif pos < len(header) + member_size:
+                pos -= len(header)
+                chunk = self.readMember(path, pos, min(end - start,
+                        member_size - pos))
+            elif pos < len(header) + member_size \
+                + getTarPadding(member_size):
+                chunk = '\0' * min(end - start, len(header) + member_size
+                                   + getTarPadding(member_size) - pos)
+            else:
+                index += 1
+                continue
+            parts.append(chunk)
+            start += len(chunk)
+        return ''.join(parts)
+
+    def close(self):
+        if self.handle:
+            self.handle.close()
+            self.handle = None
+            self.handle_path = None
+
+
+def logTransferStats(
+    direction,
+    file_name,
+    raw_bytes,
+    wire_bytes,
+    duration,
+    ):
+
+    # raw_bytes and wire_bytes include blocks that were sent twice
+
+    ratio = 100.0 * wire_bytes / max(raw_bytes, 1)
+    rate = raw_bytes / max(duration, 0.001) / 1024
+    log.info('%s %s: %i bytes as %i (%.0f%%) in %.1f s, %i KiB/s'
+             % (direction, file_name, raw_bytes, wire_bytes, ratio,
+             duration, rate))
+
+
+class TransferProgress(object):
+
+    # sits between a FileSender or FileReceiver and its GUI callback.
+    # The transfer reports its progress for every block, the callback
+    # gets only the newest state and at most PROGRESS_RATE times per
+    # second (errors and the completion immediately). A state that
+    # is held back is delivered by a timer. Also measures the rate
+    # and estimates the remaining time (see getRate(), getETA()).
+
+    def __init__(self, callback=None):
+        self.callback = callback  # None until the GUI has one
+        self.lock = threading.Lock()
+        self.call_lock = threading.RLock()  # keeps the calls in order
+        self.state = None  # (total, complete, error_msg)
+        self.pending = False
+        self.last_call = 0
+        self.timer = None
+        self.samples = collections.deque()  # (time, complete)
+        self.rate = 0
+        self.eta = None
+
+    def setCallback(self, callback):
+
+        # the latest state is delivered at once to a new callback
+
+        self.lock.acquire()
+        self.callback = callback
+        self.pending = self.state != None
+        self.lock.release()
+        self.flush()
+
+    def update(
+        self,
+        total,
+        complete,
+        error_msg='',
+        ):
+
+        now = time.time()
+        self.lock.acquire()
+        self.state = (total, complete, error_msg)
+        self.pending = True
+        if complete >= 0:
+            self.updateRate(now, total, complete)
+        due = complete == -1 or complete == total or now \
+            - self.last_call >= 1.0 / PROGRESS_RATE
+        if not due and not self.timer:
+            self.timer = callLater(1.0 / PROGRESS_RATE - (now
+                                   - self.last_call), self.onTimer)
+        self.lock.release()
+        if due:
+            self.flush()
+
+    def updateRate(
+        self,
+        now,
+        total,
+        complete,
+        ):
+
+        # the rate over the last PROGRESS_RATE_WINDOW seconds,
+        # a transfer that has gone back (restart) is measured anew
+
+        if self.samples and complete < self.samples[-1][1]:
+            self.samples.clear()
+        self.samples.append((now, complete))
+        while len(self.samples) > 2 and now - self.samples[0][0] \
+            > PROGRESS_RATE_WINDOW:
+            self.samples.popleft()
+        (first_time, first_complete) = self.samples[0]
+        if now - first_time > 0:
+            self.rate = (complete - first_complete) / (now - first_time)
+        if self.rate > 0:
+            self.eta = (total - complete) / self.rate
+        else:
+            self.eta = None
+
+    def getRate(self):
+
+        # bytes per second
+
+        return self.rate
+
+    def getETA(self):
+
+        # seconds until completion, None if unknown
+
+        return self.eta
+
+    def onTimer(self):
+        try:
+            self.flush()
+        except:
+            config.tb()
+
+    def flush(self):
+        self.call_lock.acquire()
+        try:
+            self.lock.acquire()
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            if not self.pending or not self.callback:
+                self.lock.release()
+                return
+            self.pending = False
+            self.last_call = time.time()
+            (total, complete, error_msg) = self.state
+            callback = self.callback
+            self.lock.release()
+            callback(total, complete, error_msg)
+        finally:
+            self.call_lock.release()
+
+
+class TokenBucket(object):
+
+    # a rate limit in bytes per second which allows bursts
+    # of up to one second. A rate of 0 means no limit.
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.time()
+
+    def update(self):
+        now = time.time()
+        self.tokens = min(self.rate, self.tokens + (now - self.last)
+                          * self.rate)
+        self.last = now
+
+    def getDelay(self, size):
+
+        # seconds until size bytes may be sent. A block bigger than
+        # the whole bucket only has to wait until the bucket is full.
+
+        if not self.rate:
+            return 0
+        self.update()
+        needed = min(size, self.rate) - self.tokens
+        if needed <= 0:
+            return 0
+        return float(needed) / self.rate
+
+    def consume(self, size):
+        if self.rate:
+            self.tokens -= size
+
+
+class TransferScheduler(object):
+
+    # owns all running file transfers and decides which file sender
+    # may send its next block. Every sender thread asks with acquire()
+    # before it sends a block. Senders get their turns in deficit round
+    # robin order, each round a sender is credited TRANSFER_QUANTUM
+    # bytes times its weight and may send as long as its credit lasts.
+    # On top of this the global and the per buddy rate limits are
+    # enforced with token buckets.
+
+    def __init__(self):
+        self.senders = {}
+        self.receivers = {}
+        self.waiting = collections.deque()  # senders that want a turn
+        self.current = None  # the sender that had the last turn
+        self.cond = threading.Condition()
+        self.global_bucket = TokenBucket(config.getint('files',
+                'max_rate_global'))
+        self.buddy_buckets = {}
+
+    def addSender(self, sender):
+        self.senders[sender.buddy.address, sender.id] = sender
+
+    def removeSender(self, sender):
+        self.cond.acquire()
+        try:
+            del self.senders[sender.buddy.address, sender.id]
+        except KeyError:
+            pass
+        if sender in self.waiting:
+            self.waiting.remove(sender)
+        if self.current == sender:
+            self.current = None
+        self.cond.notifyAll()
+        self.cond.release()
+
+    def addReceiver(self, receiver):
+        self.receivers[receiver.buddy.address, receiver.id] = receiver
+
+    def removeReceiver(self, receiver):
+        del self.receivers[receiver.buddy.address, receiver.id]
+
+    def getBuddyBucket(self, address):
+        if not address in self.buddy_buckets:
+            self.buddy_buckets[address] = TokenBucket(config.getint('files'
+                    , 'max_rate_per_buddy'))
+        return self.buddy_buckets[address]
+
+    def wakeUp(self):
+
+        # a waiting sender has been stopped or restarted
+
+        self.cond.acquire()
+        self.cond.notifyAll()
+        self.cond.release()
+
+    def wakeUpBuddy(self, buddy):
+
+        # the senders of buddy wait for its connection
+        # and capabilities, they have changed
+
+        for sender in self.senders.values():
+            if sender.buddy == buddy:
+                notifyCondition(sender.cond)
+
+    def acquire(self, sender, size):
+
+        # block until sender may send size bytes. Returns False if the
+        # sender has been stopped or restarted in the meantime.
+
+        self.cond.acquire()
+        try:
+            if sender == self.current:
+
+                # it still has credit left from its last turn
+
+                self.waiting.appendleft(sender)
+            else:
+                self.waiting.append(sender)
+            while True:
+                if not sender.running or sender.restart_flag:
+                    if sender in self.waiting:
+                        self.waiting.remove(sender)
+                    return False
+                if self.waiting[0] != sender:
+
+                    # every change of the queue or of a sender's
+                    # running and restart_flag is notified
+
+                    self.cond.wait()
+                    continue
+                if sender.deficit < size:
+                    sender.deficit += TRANSFER_QUANTUM * sender.weight
+                    if sender.deficit < size:
+                        self.waiting.rotate(-1)
+                        self.cond.notifyAll()
+                        continue
+                bucket = self.getBuddyBucket(sender.buddy.address)
+                delay = max(bucket.getDelay(size),
+                            self.global_bucket.getDelay(size))
+                if delay:
+                    waitCondition(self.cond, delay)
+                    continue
+                bucket.consume(size)
+                self.global_bucket.consume(size)
+                sender.deficit -= size
+                self.waiting.popleft()
+                if sender.deficit > 0:
+                    self.current = sender
+                else:
+                    self.current = None
+                    sender.deficit = 0
+                self.cond.notifyAll()
+                return True
+        finally:
+            self.cond.release()
+
+
+class FileSender(threading.Thread):
+
+    # the sender keeps a window of blocks in flight which have not yet
+    # been confirmed by filedata_ok. The size of this window adapts to
+    # the connection, roughly like TCP congestion control: it starts
+    # small, doubles every round trip (slow start) until it reaches
+    # ssthresh and from then on grows by one block per round trip.
+    # A filedata_error or a round trip time that grows far beyond the
+    # smallest one we have seen (the blocks are only piling up in some
+    # queue inside the Tor circuit) halves the window again.
+
+    def __init__(
+        self,
+        buddy,
+        file_name,
+        guiCallback,
+        resume_state=None,
+        files=None,
+        ):
+
+        # resume_state is the saved state (see getState()) of a
+        # transfer that was interrupted by a restart of the client.
+        # files is a list of files and directories which are sent as
+        # one archive (then file_name is only the name of the archive)
+
+        threading.Thread.__init__(self)
+        self.buddy = buddy
+        self.bl = buddy.bl
+        self.file_name = file_name
+        self.file_name_short = os.path.basename(self.file_name)
+        self.files = files
+        self.source = None  # ArchiveSource, see mapFile()
+        self.file_handle = None
+        self.progress = TransferProgress(guiCallback)
+        self.resume_state = resume_state
+        if resume_state:
+            self.id = resume_state['id'].decode('hex')
+        else:
+            self.id = os.urandom(4)
+        self.weight = 1  # share of the bandwidth, see TransferScheduler
+        self.deficit = 0
+        self.buddy.bl.transfers.addSender(self)
+        self.file_size = 0
+        self.block_size = LEGACY_BLOCK_SIZE
+        self.confirmed = None  # BlockBitmap, see run()
+        self.map = None  # see mapFile()
+        self.last_checkpoint = time.time()
+        self.window = float(WINDOW_MIN)
+        self.window_max = WINDOW_MIN
+        self.ssthresh = self.window_max
+        self.time_started = 0
+        self.block_checksum = 'md5'
+        self.compression = None
+        self.compression_skip = 0  # blocks to send without trying
+        self.compression_backoff = 0
+        self.raw_bytes = 0  # for the compression statistics
+        self.wire_bytes = 0
+        self.digest = None
+        self.digest_pos = 0  # the digest covers the file up to here
+        self.digest_sent = False
+        self.srtt = 0
+        self.min_rtt = 0
+        self.send_times = {}
+        self.last_decrease = 0
+        self.restart_at = 0
+        self.next_block = 0  # the next block that has not yet been sent
+        self.resend = collections.deque()  # blocks reported missing
+        self.resend_set = set()  # the same indices, for lookups
+        self.delta_answer = None  # see setDeltaSignatures()
+        self.delta = {}  # blocks the receiver can copy from its old file
+        self.restart_flag = False
+        self.completed = False
+        self.last_activity = time.time()
+
+        # every change of the state above that the sender thread might
+        # be waiting for is signalled through this condition
+
+        self.cond = threading.Condition()
+        self.start()
+
+    def negotiate(self):
+
+        # choose block size and checksums according to what the
+        # receiver has told us in its capabilities message.
+        # A fast checksum for the blocks and a strong digest of the
+        # whole file, if the receiver can verify them. Otherwise md5
+        # for every block, like all the old clients do.
+
+        if self.resume_state:
+            self.block_size = self.resume_state['block_size']
+        else:
+            self.block_size = self.chooseBlockSize()
+        self.window_max = max(WINDOW_MIN, config.getint('files',
+                              'max_window_bytes') / self.block_size)
+        self.ssthresh = self.window_max
+
+        self.compression = chooseCompression(self.buddy)
+        checksums = self.buddy.getCapabilityList('checksums')
+        if 'crc32' in checksums:
+            self.block_checksum = 'crc32'
+        for algorithm in FILE_DIGESTS:
+            if algorithm in checksums \
+                and algorithm in getAvailableChecksums():
+                self.digest = newDigest(algorithm)
+                self.digest_algorithm = algorithm
+                break
+
+    def chooseBlockSize(self):
+
+        # bigger blocks mean less overhead per byte (hash, escaping,
+        # one filedata_ok for every block) but on a slow link a lost
+        # block is more expensive. We aim at blocks that take about
+        # BLOCK_TIME seconds at the rate we have measured on the last
+        # transfer to this buddy, within what the receiver accepts.
+        # Clients which don't tell us their limit get the classic
+        # TorChat block size.
+
+        try:
+            max_size = int(self.buddy.capabilities['max_block_size'])
+        except:
+            return LEGACY_BLOCK_SIZE
+        max_size = min(max_size, config.getint('files', 'block_size'))
+        if self.buddy.link_rate:
+            size = LEGACY_BLOCK_SIZE
+            while size * 2 <= self.buddy.link_rate * BLOCK_TIME:
+                size *= 2
+        else:
+            size = max_size
+        return max(LEGACY_BLOCK_SIZE, min(size, max_size))
+
+    def setCallbackFunction(self, callback):
+        self.progress.setCallback(callback)
+
+    def setWeight(self, weight):
+
+        # a sender with weight 2 gets twice the bandwidth of the others
+
+        self.weight = weight
+
+    def wait(self, timeout=SENDER_IDLE_WAIT):
+
+        # sleep until something happens (or timeout) and then
+        # check whether we have been waiting for too long
+
+        self.cond.acquire()
+        waitCondition(self.cond, timeout)
+        self.cond.release()
+        self.testTimeout()
+        self.checkpoint()
+
+    def waitForBuddy(self):
+
+        # wait until the buddy is connected and has told us
+        # its capabilities (or is an old client without them).
+        # The buddy wakes us up, see TransferScheduler.wakeUpBuddy()
+
+        timeout = None
+        self.cond.acquire()
+        while self.running:
+            if self.buddy.conn_in:
+                if timeout == None:
+                    timeout = time.time() + CAPABILITIES_TIMEOUT
+                if self.buddy.capabilities_received \
+                    or time.time() >= timeout:
+                    break
+                waitCondition(self.cond, timeout - time.time())
+            else:
+                self.cond.wait()
+        self.cond.release()
+
+    def wantsDelta(self):
+
+        # a file sent again after it has been changed. The receiver
+        # might still have the old version, then we only need to
+        # send what is different (delta sync, like rsync does it)
+
+        return not self.files and not self.resume_state \
+            and self.map != None and self.buddy.supports('delta')
+
+    def setDeltaSignatures(self, block_size, signatures):
+
+        # the answer of the receiver to our filename message,
+        # signatures == None if it has no old version of the file
+
+        self.cond.acquire()
+        if self.delta_answer == None:
+            if signatures:
+                self.delta_answer = (block_size, signatures)
+            else:
+                self.delta_answer = False
+        self.cond.notifyAll()
+        self.cond.release()
+
+    def waitForDelta(self):
+        timeout = time.time() + DELTA_WAIT
+        self.cond.acquire()
+        while self.delta_answer == None and self.running \
+            and time.time() < timeout:
+            waitCondition(self.cond, timeout - time.time())
+        answer = self.delta_answer
+        self.delta_answer = False  # too late for anything that follows
+        self.cond.release()
+        if not answer:
+            return
+        try:
+            (block_size, signatures) = answer
+            matches = self.findDeltaMatches(block_size, signatures)
+            self.delta = self.getDeltaCopies(matches)
+            log.info('delta sync %s: %i of %i blocks unchanged'
+                     % (self.file_name_short, len(self.delta),
+                     self.confirmed.count))
+        except:
+            log.warn('delta sync of %s failed, sending everything'
+                     % self.file_name_short)
+            config.tb(log.WARNING)
+            self.delta = {}
+
+    def findDeltaMatches(self, block_size, signatures):
+
+        # returns a list of (position, old position, size) of the parts
+        # of the file that the receiver already has in its old version.
+        # Where the last match has ended we first look for the next
+        # block right there, only if it is not found we roll adler32
+        # byte by byte through the file (up to DELTA_ROLL_BUDGET bytes,
+        # then we only compare at whole block distances).
+
+        table = {}
+        for index in range(len(signatures) / 12):
+            (weak, strong) = struct.unpack_from('>I8s', signatures,
+                    index * 12)
+            table.setdefault(weak, {}).setdefault(strong, index)
+        data = self.map
+        size = self.file_size
+        matches = []
+        budget = DELTA_ROLL_BUDGET
+        pos = 0
+        while pos + block_size <= size:
+            if not self.isMapped(size):
+                raise Exception('%s has changed' % self.file_name)
+            weak = zlib.adler32(data[pos:pos + block_size]) & 0xffffffff
+            a = weak & 0xffff
+            b = weak >> 16
+            end = min(size - block_size, pos + block_size, pos + budget)
+            found = False
+            while True:
+                if weak in table:
+                    strong = hashlib.md5(data[pos:pos
+                            + block_size]).digest()[:8]
+                    index = table[weak].get(strong)
+                    if index != None:
+                        matches.append((pos, index * block_size,
+                                block_size))
+                        found = True
+                        break
+                if pos >= end:
+                    break
+                out = ord(data[pos])
+                a = (a - out + ord(data[pos + block_size])) % 65521
+                b = (b - block_size * out + a - 1) % 65521
+                weak = b << 16 | a
+                pos += 1
+                budget -= 1
+            if found:
+                pos += block_size
+            elif budget > 0:
+                pos += 1
+            else:
+                pos += block_size
+        return matches
+
+    def getDeltaCopies(self, matches):
+
+        # for every block touched by a match, the list of its pieces
+        # (old position, size) in order. old position is None for the
+        # parts which are not in the old file, they are sent with the
+        # copy instructions (see createDataMsg()).
+
+        pieces = {}
+        for (pos, old, size) in matches:
+            while size:
+                index = pos / self.block_size
+                length = min(size, (index + 1) * self.block_size - pos)
+                block = pieces.setdefault(index, [])
+                if block and block[-1][0] + block[-1][2] == pos \
+                    and block[-1][1] + block[-1][2] == old:
+                    block[-1][2] += length
+                else:
+                    block.append([pos, old, length])
+                pos += length
+                old += length
+                size -= length
+        delta = {}
+        for (index, block) in pieces.items():
+            pos = index * self.block_size
+            end = min(pos + self.block_size, self.file_size)
+            copies = []
+            for (piece_pos, old, length) in block + [[end, None, 0]]:
+                if piece_pos > pos:
+                    copies.append((None, piece_pos - pos))
+                if length:
+                    copies.append((old, length))
+                pos = piece_pos + length
+            delta[index] = copies
+        return delta
+
+    def getState(self):
+
+        # everything needed to continue after a restart of the client
+
+        return {
+            'id': self.id.encode('hex'),
+            'address': self.buddy.address,
+            'file_name': self.file_name,
+            'files': self.files,
+            'file_size': self.file_size,
+            'block_size': self.block_size,
+            'confirmed': self.confirmed.toString(),
+            }
+
+    def getStateName(self):
+        return 'send_%s_%s' % (self.buddy.address, self.id.encode('hex'))
+
+    def checkpoint(self, force=False):
+        if not self.confirmed or not self.running or self.completed:
+            return
+        if force or time.time() - self.last_checkpoint \
+            > CHECKPOINT_INTERVAL:
+            self.last_checkpoint = time.time()
+            saveTransferState(self.getStateName(), self.getState())
+
+    def testTimeout(self):
+
+        # this will be called whenever the sender has been waiting
+        # for confirmation messages. Either in the sendBlocks() loop
+        # or when all blocks are sent in the outer loop in run()
+        # if a timeout is detected then the restart flag will be set
+
+        if not self.buddy.conn_in:
+
+            # we only count the time if we are connected
+            # otherwise other mechanisms are responsible and trying
+            # to get us connected again and we just wait
+
+            self.last_activity = time.time()
+
+        idle = time.time() - self.last_activity
+        first_missing = self.confirmed.getFirstMissing()
+        if self.buddy.supports('selective_ack') and idle \
+            > max(RETRANSMIT_TIMEOUT_MIN, 4 * self.srtt) \
+            and idle <= SENDER_TIMEOUT and self.next_block > first_missing:
+
+            # the receiver tells us about the blocks it is missing, but
+            # not if the last ones (or a retransmission) got lost.
+            # Nothing confirmed for so long, everything that is not
+            # yet confirmed has to be sent again.
+
+            log.warn('file sender %s retransmit timeout'
+                     % self.file_name_short)
+            self.restart(first_missing * self.block_size)
+
+        if idle > SENDER_TIMEOUT:
+
+            # ten minutes without filedata_ok
+
+            new_start = first_missing * self.block_size
+            self.restart(new_start)
+
+            # enforce a new connection
+
+            try:
+                self.buddy.conn_in.close()
+            except:
+                pass
+            log.warn('timeout file sender restart at %i' % new_start)
+
+    def canGoOn(self, start):
+
+        # the window begins at the first block that is not confirmed
+
+        position_ok = (self.confirmed.getFirstMissing()
+                       + int(self.window)) * self.block_size
+        if not self.running or self.restart_flag:
+            return True
+        else:
+            return position_ok > start
+
+    def updateWindow(self, start):
+
+        # called for every filedata_ok (with the lock held)
+
+        sent = self.send_times.pop(start, None)
+        if sent == None:
+            return
+        rtt = time.time() - sent
+        if not self.min_rtt or rtt < self.min_rtt:
+            self.min_rtt = rtt
+        if not self.srtt:
+            self.srtt = rtt
+        else:
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+        if self.srtt > RTT_GROWTH_LIMIT * self.min_rtt:
+            self.decreaseWindow()
+        elif self.window < self.ssthresh:
+            self.window += 1
+        else:
+            self.window += 1 / self.window
+        if self.window > self.window_max:
+            self.window = self.window_max
+
+    def decreaseWindow(self):
+
+        # not more than once per round trip, all the other errors
+        # (or slow confirmations) of the same window are the
+        # consequence of the same event
+
+        now = time.time()
+        if now - self.last_decrease < self.srtt:
+            return
+        self.last_decrease = now
+        self.ssthresh = max(self.window / 2, WINDOW_MIN)
+        self.window = self.ssthresh
+        log.warn('file sender %s window decreased to %i blocks'
+                 % (self.file_name_short, self.window))
+
+    def nextResend(self):
+
+        # the next block reported missing by the receiver which
+        # has not been confirmed in the meantime (or None)
+
+        self.cond.acquire()
+        try:
+            while self.resend:
+                index = self.resend.popleft()
+                self.resend_set.discard(index)
+                if not self.confirmed.isSet(index):
+                    return index
+            return None
+        finally:
+            self.cond.release()
+
+    def sendBlocks(self):
+        blocks = self.confirmed.count
+
+        # the inner loop (of the two loops). Blocks the receiver
+        # has reported missing are sent before we go on with new ones.
+
+        while True:
+            index = self.nextResend()
+            if index == None:
+                if self.next_block >= blocks:
+                    break
+                index = self.next_block
+                self.next_block += 1
+                if self.confirmed.isSet(index):
+
+                    # jump over already confirmed blocks
+
+                    continue
+            start = index * self.block_size
+            remaining = self.file_size - start
+            if remaining > self.block_size:
+                size = self.block_size
+            else:
+                size = remaining
+            data = self.readBlock(start, size)
+            hash = getChecksum(self.block_checksum, data)
+            self.updateDigest(start, data)
+            msg = self.createDataMsg(start, hash, data)
+
+            # we can only send data if we are connected
+
+            while not self.buddy.conn_in and not self.restart_flag:
+                self.wait()
+
+            # don't let the send queue of the connection grow
+            # without bounds, wait until the socket has taken it
+
+            conn = self.buddy.conn_in
+            while conn and not conn.waitSendSpace(SENDER_IDLE_WAIT) \
+                and not self.restart_flag:
+                self.testTimeout()
+
+            # wait for our turn (fair share and rate limits)
+
+            if self.buddy.conn_in \
+                and self.bl.transfers.acquire(self, len(msg.payload)) \
+                and self.buddy.conn_in:
+                self.cond.acquire()
+                self.send_times[start] = time.time()
+                self.cond.release()
+                msg.send(self.buddy, 1)
+
+            # wait for confirmations more than one window behind
+
+            self.cond.acquire()
+            while not self.canGoOn(start):
+                self.cond.release()
+                self.wait()  # this can trigger the restart flag
+                self.cond.acquire()
+            self.cond.release()
+
+            if self.restart_flag:
+
+                # the outer loop in run() will start us again
+
+                break
+
+            if not self.running:
+
+                # the outer loop in run() will also end
+
+                break
+
+    def createDataMsg(
+        self,
+        start,
+        hash,
+        data,
+        ):
+
+        # compress the block if the receiver can decompress it and
+        # it is worth it. Blocks that don't compress (media files)
+        # are sent as they are and we stop trying for a while.
+        # Of blocks the receiver has (partly) in its old version of
+        # the file only the new parts are sent and where to copy the
+        # rest from.
+
+        self.raw_bytes += len(data)
+        copies = self.delta.get(start / self.block_size)
+        if copies:
+            pos = 0
+            text = []
+            literal = []
+            for (old, length) in copies:
+                if old == None:
+                    text.append('%i' % length)
+                    literal.append(data[pos:pos + length])
+                else:
+                    text.append('%i:%i' % (old, length))
+                pos += length
+            payload = ','.join(text) + ' ' + ''.join(literal)
+            self.wire_bytes += len(payload)
+            return ProtocolMsg(self.bl, None, 'delta_copy', (self.id,
+                               start, hash), payload)
+        if self.compression and data:
+            if self.compression_skip:
+                self.compression_skip -= 1
+            else:
+                compressed = compress(self.compression, data)
+                if len(compressed) < len(data) * (1
+                        - COMPRESSION_MIN_SAVING):
+                    self.compression_backoff = 0
+                    self.wire_bytes += len(compressed)
+                    return ProtocolMsg(self.bl, None,
+                            'filedata_compressed', (self.id, start,
+                            hash, self.compression), compressed)
+                self.compression_backoff = min(self.compression_backoff
+                        * 2 or 1, COMPRESSION_SKIP_MAX)
+                self.compression_skip = self.compression_backoff
+        self.wire_bytes += len(data)
+        return ProtocolMsg(self.bl, None, 'filedata', (self.id, start,
+                           hash), data)
+
+    def updateDigest(self, start, data):
+
+        # the whole file digest is built while the blocks are sent for
+        # the first time. It is sent right before the last block, so the
+        # receiver has it when the transfer is complete.
+
+        if not self.digest or self.digest_sent:
+            return
+        if start == self.digest_pos:
+            self.digest.update(data)
+            self.digest_pos += len(data)
+        if start + len(data) == self.file_size:
+            while self.digest_pos < self.file_size:
+
+                # can only happen after a restart behind digest_pos
+
+                rest = self.readBlock(self.digest_pos, min(self.block_size,
+                        self.file_size - self.digest_pos))
+                self.digest.update(rest)
+                self.digest_pos += len(rest)
+            msg = ProtocolMsg(self.bl, None, 'filedigest', (self.id,
+                              self.digest_algorithm,
+                              self.digest.hexdigest()))
+            msg.send(self.buddy, 1)
+            self.digest_sent = True
+
+    def mapFile(self):
+
+        # the blocks are sent as buffers into the memory mapped file,
+        # they are neither read into strings nor copied on their way
+        # into the socket (in binary framing mode). The map is never
+        # closed explicitly, buffers of it might still be waiting in a
+        # send queue. It goes away with the last of them.
+
+        self.map = None
+        if self.file_size == 0:
+            return
+        try:
+            self.map = mmap.mmap(self.file_handle.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        except:
+            log.warn('cannot map %s, reading it instead' % self.file_name)
+            config.tb(log.WARNING)
+
+    def isMapped(self, end):
+
+        # touching a page of the map behind the end of the file kills
+        # the whole process with SIGBUS, so before a part of the map is
+        # used we check that the file has not shrunk since it was
+        # mapped. If it has, the map is dropped and the file is read
+        # like any other. (This cannot protect buffers that are already
+        # in the send queue, but they are sent within a few seconds.)
+
+        if self.map == None:
+            return False
+        if os.fstat(self.file_handle.fileno()).st_size >= end:
+            return True
+        log.warn('%s has changed while sending it, not mapping it any more'
+                  % self.file_name)
+        self.map = None
+        return False
+
+    def readBlock(self, start, size):
+        if self.source:
+            return self.source.read(start, size)
+        if self.isMapped(start + size):
+            return buffer(self.map, start, size)
+        self.file_handle.seek(start)
+        data = self.file_handle.read(size)
+        if len(data) < size:
+
+            # the file has shrunk since we started, the digest
+            # will tell the receiver that it is broken (like
+            # ArchiveSource.readMember() does it)
+
+            data += '\0' * (size - len(data))
+        return data
+
+    def run(self):
+        self.running = True
+        try:
+            if self.files:
+                self.source = ArchiveSource(self.files)
+                self.file_size = self.source.size
+            else:
+                self.file_handle = open(self.file_name, mode='rb')
+                self.file_handle.seek(0, 2)  # SEEK_END
+                self.file_size = self.file_handle.tell()
+                self.mapFile()
+            self.progress.update(self.file_size, 0)
+            self.waitForBuddy()
+            if self.files and not self.buddy.supports('archive'):
+                self.progress.update(self.file_size, -1,
+                                     '%s cannot receive directories'
+                                     % self.buddy.address)
+                self.running = False
+                self.closeFile()
+                self.close()
+                return
+            self.negotiate()
+            self.confirmed = BlockBitmap(getBlockCount(self.file_size,
+                    self.block_size))
+            if self.resume_state:
+
+                # continue behind the last confirmed block. If the
+                # receiver has lost its part of the transfer it will
+                # answer with filedata_error and we start again at 0,
+                # if it has more than we know it sends file_resume.
+
+                self.confirmed = BlockBitmap(self.confirmed.count,
+                        self.resume_state['confirmed'])
+                self.restart_at = self.confirmed.getFirstMissing() \
+                    * self.block_size
+                log.warn('resuming %s at %i' % (self.file_name,
+                         self.restart_at))
+                self.progress.update(self.file_size,
+                        min(self.restart_at, self.file_size))
+            self.checkpoint(True)
+            self.time_started = time.time()
+            filename_utf8 = self.file_name_short.encode('utf-8')
+            if self.files:
+                command = 'filename_archive'
+            else:
+                command = 'filename'
+            msg = ProtocolMsg(self.bl, None, command, (self.id,
+                              self.file_size, self.block_size,
+                              filename_utf8))
+            msg.send(self.buddy, 1)
+            if self.wantsDelta():
+                self.waitForDelta()
+
+            # the outer loop (of the two sender loops)
+            # runs forever until completed ore canceled
+
+            self.next_block = self.restart_at / self.block_size
+            while not self.completed and self.running:
+                if self.restart_flag:
+                    self.restart_flag = False
+                    self.next_block = self.restart_at / self.block_size
+
+                # (re)start the inner loop
+
+                self.sendBlocks()
+
+                # wait for *last* filedata_ok, restart flag
+                # or blocks that have to be sent again
+
+                while not self.restart_flag and not self.completed \
+                    and self.running and not self.resend:
+                    self.wait()  # this can trigger the restart flag
+
+            self.running = False
+            self.closeFile()
+            deleteTransferState(self.getStateName())
+        except:
+
+            try:
+                self.progress.update(self.file_size, -1,
+                                     'error while sending %s'
+                                     % self.file_name)
+            except:
+                config.tb()
+            self.close()
+            config.tb()
+
+    def closeFile(self):
+        if self.source:
+            self.source.close()
+        if self.file_handle:
+            self.file_handle.close()
+        self.map = None
+
+    def receivedOK(self, start):
+        if not self.confirmed or start % self.block_size \
+            or start / self.block_size >= self.confirmed.count:
+            log.warn('file sender %s: filedata_ok for invalid start %i'
+                     % (self.file_name_short, start))
+            return
+        self.cond.acquire()
+        self.last_activity = time.time()  # we have received a sign of life
+        self.updateWindow(start)
+        self.confirmed.set(start / self.block_size)
+        done = self.confirmed.getBytes(self.block_size, self.file_size)
+
+        if self.confirmed.isComplete():
+
+            # the outer sender loop can now stop waiting for timeout
+
+            self.completed = True
+
+            # remember the speed of the link for the choice
+            # of the block size in the next transfer
+
+            duration = time.time() - self.time_started
+            if duration > 1:
+                self.buddy.link_rate = self.file_size / duration
+            logTransferStats('sent', self.file_name_short, self.raw_bytes,
+                             self.wire_bytes, duration)
+        self.cond.notifyAll()
+        self.cond.release()
+
+        try:
+            self.progress.update(self.file_size, done)
+        except:
+
+            # cannot update gui
+
+            config.tb()
+            self.close()
+
+    def restart(self, start, loss=True):
+
+        # trigger the reatart flag
+        # (loss=False if the receiver just tells us where to resume)
+
+        self.cond.acquire()
+        self.last_activity = time.time()
+        self.restart_at = start
+        self.restart_flag = True
+        if loss:
+            self.decreaseWindow()
+        self.send_times.clear()
+        self.resend.clear()
+        self.resend_set.clear()
+        self.cond.notifyAll()
+        self.cond.release()
+        self.bl.transfers.wakeUp()
+
+        # the inner loop will now immediately break and
+        # the outer loop will start it again at position restart_at
+
+    def receivedError(self, start):
+
+        # a receiver with selective_ack only wants this one block again,
+        # an old one has dropped everything from start on (go back N).
+        # A block that could not be copied from the old version of
+        # the file is sent the normal way.
+
+        self.delta.pop(start / self.block_size, None)
+        if self.buddy.supports('selective_ack'):
+            self.resendBlocks([(start, start + self.block_size)])
+        else:
+            if self.confirmed:
+                self.cond.acquire()
+                self.confirmed.clearFrom(start / self.block_size)
+                self.cond.release()
+            self.restart(start)
+
+    def resendBlocks(self, ranges):
+
+        # ranges is a list of (start, end) byte positions the receiver
+        # is missing, we send only these blocks again. Blocks we think
+        # are confirmed can be among them if the receiver has lost its
+        # part of a resumed transfer (messages arrive in order, so it
+        # cannot be an old report from before the confirmation).
+
+        if not self.confirmed:
+            return
+        self.cond.acquire()
+        self.last_activity = time.time()
+        self.decreaseWindow()
+        for (start, end) in ranges:
+            first = max(0, start / self.block_size)
+            last = min(self.confirmed.count, (end + self.block_size - 1)
+                       / self.block_size, self.next_block)
+            for index in range(first, last):
+                self.confirmed.clear(index)
+                if index not in self.resend_set:
+                    self.resend.append(index)
+                    self.resend_set.add(index)
+
+                    # no round trip time from a retransmitted block
+
+                    self.send_times.pop(index * self.block_size, None)
+        self.cond.notifyAll()
+        self.cond.release()
+
+    def sendStopMessage(self):
+        msg = ProtocolMsg(self.buddy.bl, None, 'file_stop_receiving',
+                          self.id)
+        msg.send(self.buddy)
+
+    def close(self):
+        if self.running:
+            self.running = False
+            self.sendStopMessage()
+            try:
+                self.progress.update(self.file_size, -1, 'transfer aborted')
+            except:
+                pass
+        self.cond.acquire()
+        self.cond.notifyAll()
+        self.cond.release()
+        deleteTransferState(self.getStateName())
+        self.buddy.bl.transfers.removeSender(self)
+
+
+class ArchiveUnpacker(object):
+
+    # unpacks the tar archive of a directory or multi file transfer
+    # while it is being received. feed() is called whenever the part
+    # without gaps at the beginning of the temporary file has grown.
+
+    def __init__(self, dir):
+        if type(dir) == unicode and not os.path.supports_unicode_filenames:
+            dir = dir.encode(sys.getfilesystemencoding() or 'utf-8')
+        self.dir = dir
+        self.pos = 0  # everything before this has been unpacked
+        self.data_left = 0  # bytes of the current member still to come
+        self.data_end = 0  # where the (padded) data of the member ends
+        self.out = None
+        self.long_name = None
+        self.finished = False
+
+    def getTargetName(self, name):
+
+        # we never write anything outside of our directory
+
+        # names in the archive are utf-8, only use unicode
+        # if the file system has unicode names (Windows)
+
+        if os.path.supports_unicode_filenames:
+            name = name.decode('utf-8', 'replace')
+        name = name.strip('/')
+        path = os.path.normpath(os.path.join(self.dir, *name.split('/')))
+        if not name or not path.startswith(os.path.join(self.dir, '')):
+            raise ValueError('illegal name in archive: %s' % name)
+        return path
+
+    def feed(self, handle, end):
+        while not self.finished:
+            if self.data_left:
+                size = min(self.data_left, end - self.pos, 1048576)
+                if size <= 0:
+                    return
+                handle.seek(self.pos)
+                data = handle.read(size)
+                if self.out:
+                    self.out.write(data)
+                self.pos += size
+                self.data_left -= size
+                if not self.data_left:
+                    if self.out:
+                        self.out.close()
+                        self.out = None
+                    self.pos = self.data_end
+                continue
+
+            if self.pos + TAR_BLOCK > end:
+                return
+            handle.seek(self.pos)
+            header = handle.read(TAR_BLOCK)
+            if header == '\0' * TAR_BLOCK:
+                self.finished = True
+                return
+            info = tarfile.TarInfo.frombuf(header)
+            data_end = self.pos + TAR_BLOCK + info.size \
+                + getTarPadding(info.size)
+            if info.type == tarfile.GNUTYPE_LONGNAME:
+
+                # the name of the next member, it is too long
+                # for the header. We need all of it at once.
+
+                if data_end > end:
+                    return
+                self.long_name = handle.read(info.size).rstrip('\0')
+                self.pos = data_end
+                continue
+
+            name = self.long_name or info.name
+            self.long_name = None
+            self.pos += TAR_BLOCK
+            self.data_left = info.size
+            self.data_end = data_end
+            path = self.getTargetName(name)
+            if info.isdir():
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+            elif info.isreg():
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                self.out = open(path, 'wb')
+            else:
+                log.warn('not unpacking %s, unsupported type' % name)
+            if not self.data_left:
+                if self.out:
+                    self.out.close()
+                    self.out = None
+                self.pos = data_end
+
+    def close(self):
+        if self.out:
+            self.out.close()
+            self.out = None
+
+
+class FileReceiver:
+
+    def __init__(
+        self,
+        buddy,
+        id,
+        block_size,
+        file_size,
+        file_name,
+        archive=False,
+        resume_state=None,
+        ):
+
+        # resume_state is the saved state (see getState()) of a
+        # transfer that was interrupted by a restart of the client,
+        # it has already been checked by canResume().
+        # archive is True for a directory or multi file transfer,
+        # it is unpacked into a directory while it is received.
+
+        self.buddy = buddy
+        self.id = id
+        self.closed = False
+
+        # the GUI callback is set later with setCallbackFunction()
+
+        self.progress = TransferProgress()
+        self.block_size = block_size
+        self.file_name = file_name
+        self.file_name_save = ''
+        self.file_size = file_size
+        self.received = BlockBitmap(getBlockCount(file_size, block_size))
+        self.next_start = 0
+        self.wrong_block_number_count = 0
+        self.digest_algorithm = None  # see setDigest()
+        self.digest = None
+        if resume_state:
+            self.file_name_tmp = resume_state['file_name_tmp']
+            self.file_handle_tmp = open(self.file_name_tmp, 'r+b')
+            self.received = BlockBitmap(self.received.count,
+                    resume_state['received'])
+            self.next_start = min(self.received.getFirstMissing()
+                                  * block_size, file_size)
+            self.digest_algorithm = resume_state['digest_algorithm']
+            self.digest = resume_state['digest']
+            log.warn('resuming %s from %s at %i' % (file_name,
+                     buddy.address, self.next_start))
+        else:
+            tmp = createTemporaryFile(self.file_name)
+            (self.file_name_tmp, self.file_handle_tmp) = tmp
+
+        # received blocks are collected in the write buffer (see
+        # writeBlock()) and written in big chunks
+
+        self.write_start = 0
+        self.write_parts = []
+        self.write_size = 0
+        self.disk_error = None
+
+        # the size is what the sender says, we don't reserve anything
+        # before the user has accepted the file (see preallocate()),
+        # but we can refuse a file that cannot fit anyway
+
+        free = getFreeSpace(os.path.dirname(self.file_name_tmp))
+        needed = file_size - os.path.getsize(self.file_name_tmp)
+        if free != None and needed > free:
+            self.failDisk('%i bytes needed, only %i free' % (needed,
+                          free))
+
+        self.wire_bytes = 0  # for the compression statistics
+        self.raw_bytes = 0
+        self.time_started = time.time()
+        self.archive = archive
+        self.unpacker = None
+        self.unpack_error = False
+        if archive:
+            self.archive_dir = tempfile.mkdtemp('', 'phantom_incoming_',
+                    os.path.dirname(self.file_name_tmp))
+            self.unpacker = ArchiveUnpacker(self.archive_dir)
+
+            # a resumed archive is unpacked again from the beginning
+
+            self.unpack()
+            if resume_state and resume_state.get('archive_dir'):
+                shutil.rmtree(resume_state['archive_dir'], True)
+
+        # everything behind this position is new to the sender's
+        # knowledge of what we have, gaps in front of it are reported
+
+        self.frontier = self.next_start
+        self.last_checkpoint = time.time()
+        self.buddy.bl.transfers.addReceiver(self)
+        self.checkpoint(True)
+
+        # the old version of the file for delta sync, see offerDelta()
+
+        self.base_name = None
+        self.base_handle = None
+        self.base_size = 0
+        if buddy.supports('delta') and not archive and not resume_state \
+            and not self.disk_error:
+            callInWorker(self.offerDelta)
+
+        # the following will result in a call into the GUI
+
+        self.buddy.bl.onFileReceive(self)
+
+    def setCallbackFunction(self, callback):
+        self.progress.setCallback(callback)
+
+    def getState(self):
+        return {
+            'id': self.id.encode('hex'),
+            'address': self.buddy.address,
+            'file_name': self.file_name,
+            'file_name_tmp': self.file_name_tmp,
+            'file_size': self.file_size,
+            'block_size': self.block_size,
+            'received': self.received.toString(),
+            'digest_algorithm': self.digest_algorithm,
+            'digest': self.digest,
+            'archive': self.archive,
+            'archive_dir': self.unpacker and self.archive_dir,
+            }
+
+    def getStateName(self):
+        return 'receive_%s_%s' % (self.buddy.address,
+                                  self.id.encode('hex'))
+
+    def canResume(
+        self,
+        file_size,
+        block_size,
+        file_name,
+        archive,
+        ):
+
+        # a sender announces the same transfer again, either after
+        # it has been restarted or because we have been restarted
+
+        return not self.closed and self.file_size == file_size \
+            and self.block_size == block_size \
+            and self.file_name == file_name and self.archive == archive
+
+    def unpack(self):
+
+        # unpack what has arrived without gaps and is on the disk
+
+        end = self.next_start
+        if self.write_parts:
+            end = min(end, self.write_start)
+        if not self.unpacker or self.unpacker.pos >= end:
+            return
+        try:
+            self.unpacker.feed(self.file_handle_tmp, end)
+        except:
+            log.error('cannot unpack %s from %s' % (self.file_name,
+                      self.buddy.address))
+            config.tb(log.ERROR)
+            self.unpacker.close()
+            self.unpacker = None
+            self.unpack_error = True
+
+    def sendResume(self):
+
+        # tell the sender where to continue. Old clients don't
+        # know file_resume, they will get a filedata_error when
+        # their first block does not fit and restart there.
+
+        if self.next_start >= self.file_size and self.file_size > 0:
+
+            # we have everything, only the last filedata_ok was lost
+
+            last = (self.received.count - 1) * self.block_size
+            msg = ProtocolMsg(self.buddy.bl, None, 'filedata_ok',
+                              (self.id, last))
+            msg.send(self.buddy)
+        elif self.buddy.supports('resume'):
+            msg = ProtocolMsg(self.buddy.bl, None, 'file_resume',
+                              (self.id, self.next_start))
+            msg.send(self.buddy)
+
+    def checkpoint(self, force=False):
+
+        # the state must never claim more than what is on the disk
+
+        if self.closed or self.disk_error:
+            return
+        if force or time.time() - self.last_checkpoint \
+            > CHECKPOINT_INTERVAL:
+            self.last_checkpoint = time.time()
+            if not self.flushWrites():
+                return
+            try:
+                os.fsync(self.file_handle_tmp.fileno())
+            except:
+                config.tb()
+                return
+            saveTransferState(self.getStateName(), self.getState())
+
+    def writeBlock(self, start, data):
+
+        # contiguous blocks are collected and written together. The
+        # buffer is flushed when it is full, when the next block is
+        # not contiguous, before the file is read (unpack(), close())
+        # and at every checkpoint().
+
+        if self.write_parts and start != self.write_start \
+            + self.write_size:
+            self.flushWrites()
+        if not self.write_parts:
+            self.write_start = start
+        self.write_parts.append(data)
+        self.write_size += len(data)
+        if self.write_size >= WRITE_BUFFER_SIZE:
+            self.flushWrites()
+
+    def flushWrites(self):
+
+        # returns False if the data could not be written, then
+        # the transfer is aborted (see failDisk())
+
+        if not self.write_parts:
+            return not self.disk_error
+        try:
+            self.file_handle_tmp.seek(self.write_start)
+            self.file_handle_tmp.write(''.join(self.write_parts))
+            self.file_handle_tmp.flush()
+            return True
+        except:
+            config.tb()
+            self.failDisk(str(sys.exc_info()[1]))
+            return False
+        finally:
+            self.write_parts = []
+            self.write_size = 0
+
+    def failDisk(self, error):
+
+        # we cannot write the file (disk full), tell the sender
+        # to stop and the user why
+
+        log.error('cannot write %s from %s: %s' % (self.file_name,
+                  self.buddy.address, error))
+        self.disk_error = 'cannot write file: %s' % error
+        self.sendStopMessage()
+        try:
+            self.progress.update(self.file_size, -1, self.disk_error)
+        except:
+            pass
+
+    def data(
+        self,
+        start,
+        hash,
+        data,
+        wire_size=None,
+        ):
+
+        # wire_size is the size of the (compressed) block as received
+
+        if self.disk_error:
+            return
+        if wire_size == None:
+            wire_size = len(data)
+        self.wire_bytes += wire_size
+        self.raw_bytes += len(data)
+        if self.buddy.supports('selective_ack'):
+            self.dataSelective(start, hash, data)
+            return
+
+        # old clients send in order and go back to where we tell
+        # them with filedata_error, everything else is dropped
+
+        if start > self.next_start:
+            if self.wrong_block_number_count == 0:
+
+                # not on every single out-of-order block in a row
+                # we must send an error message...
+
+                msg = ProtocolMsg(self.buddy.bl, None, 'filedata_error'
+                                  , (self.id, self.next_start))
+                msg.send(self.buddy)
+                self.wrong_block_number_count += 1
+
+                # ...only every 16
+                # FIXME: This must be solved more elegantly
+
+                if self.wrong_block_number_count == 16:
+                    self.wrong_block_number_count = 0
+            return
+
+        self.wrong_block_number_count = 0
+        if checkChecksum(hash, data):
+            self.writeBlock(start, data)
+            self.next_start = start + len(data)
+            self.received.set(start / self.block_size)
+            self.unpack()
+            self.checkpoint()
+            msg = ProtocolMsg(self.buddy.bl, None, 'filedata_ok',
+                              (self.id, start))
+            msg.send(self.buddy)
+            try:
+                self.progress.update(self.file_size, start + len(data))
+            except:
+                log.warn('FileReceiver cannot call the GUI')
+                config.tb(log.WARNING)
+        else:
+
+            log.critical('receiver wrong hash %i len: %i' % (start,
+                         len(data)))
+            msg = ProtocolMsg(self.buddy.bl, None, 'filedata_error',
+                              (self.id, start))
+            msg.send(self.buddy)
+
+            # we try to avoid unnecessary wrong-block-number errors
+            # the next block sure will be out of order, but we have sent
+            # an error already because of the wrong hash
+
+            self.wrong_block_number_count = 1
+
+    def dataSelective(
+        self,
+        start,
+        hash,
+        data,
+        ):
+
+        # every correct block is written where it belongs, no matter in
+        # which order they arrive. Gaps are reported once with
+        # filedata_missing, the sender only sends these blocks again.
+
+        index = start / self.block_size
+        if start < 0 or start % self.block_size \
+            or index >= self.received.count \
+            or len(data) != min(self.block_size, self.file_size - start):
+            log.warn('receiver ignoring invalid block %i len: %i'
+                     % (start, len(data)))
+            return
+
+        if not checkChecksum(hash, data):
+            log.critical('receiver wrong hash %i len: %i' % (start,
+                         len(data)))
+            msg = ProtocolMsg(self.buddy.bl, None, 'filedata_error',
+                              (self.id, start))
+            msg.send(self.buddy)
+            return
+
+        if not self.received.isSet(index):
+            self.writeBlock(start, data)
+            self.received.set(index)
+            self.next_start = min(self.received.getFirstMissing()
+                                  * self.block_size, self.file_size)
+            self.unpack()
+            if start > self.frontier:
+                self.sendMissing(self.frontier, start)
+            self.frontier = max(self.frontier, start + len(data))
+            self.checkpoint()
+
+        # confirm duplicates too, the first filedata_ok might be lost
+
+        msg = ProtocolMsg(self.buddy.bl, None, 'filedata_ok', (self.id,
+                          start))
+        msg.send(self.buddy)
+        try:
+            self.progress.update(self.file_size,
+                                 self.received.getBytes(self.block_size,
+                                 self.file_size))
+        except:
+            log.warn('FileReceiver cannot call the GUI')
+            config.tb(log.WARNING)
+
+    def offerDelta(self):
+
+        # runs in the worker thread. If we have saved a file with this
+        # name from this buddy before and it has not been changed since
+        # then, we send the signatures of its blocks. The sender then
+        # only sends what is different and tells us where to copy the
+        # rest from (delta_copy). Otherwise we send delta_none, the
+        # sender is waiting for one of the two.
+
+        base_name = getReceivedFile(self.buddy.address, self.file_name)
+        if base_name:
+            try:
+                handle = open(base_name, 'rb')
+                base_size = os.path.getsize(base_name)
+                block_size = getDeltaBlockSize(base_size)
+                signatures = []
+                for index in range(base_size / block_size):
+                    signatures.append(getDeltaSignature(
+                            handle.read(block_size)))
+                if signatures and not self.closed:
+                    self.base_name = base_name
+                    self.base_size = base_size
+                    self.base_handle = handle
+                    log.info('offering %s as delta base for %s'
+                             % (base_name, self.file_name))
+                    msg = ProtocolMsg(self.buddy.bl, None,
+                            'delta_signatures', (self.id, block_size),
+                            ''.join(signatures))
+                    msg.send(self.buddy)
+                    return
+                handle.close()
+            except:
+                log.warn('cannot use %s as delta base' % base_name)
+                config.tb(log.WARNING)
+        msg = ProtocolMsg(self.buddy.bl, None, 'delta_none', self.id)
+        msg.send(self.buddy)
+
+    def readDelta(
+        self,
+        start,
+        copies,
+        literal,
+        ):
+
+        # put together a block from the old version of the file and
+        # the new data that came with it. copies is a comma separated
+        # list of old position:size to copy and size (without a
+        # position) to take from literal. Returns None if it fails.
+
+        size = min(self.block_size, self.file_size - start)
+        if not self.base_handle or start < 0 or size <= 0:
+            return None
+        data = []
+        literal_pos = 0
+        try:
+            for item in copies.split(','):
+                if ':' in item:
+                    (old, length) = [int(x) for x in item.split(':')]
+                else:
+                    (old, length) = (None, int(item))
+                if length <= 0 or length > size:
+                    return None
+                size -= length
+                if old == None:
+                    if literal_pos + length > len(literal):
+                        return None
+                    data.append(literal[literal_pos:literal_pos
+                                + length])
+                    literal_pos += length
+                elif 0 <= old and old + length <= self.base_size:
+                    self.base_handle.seek(old)
+                    data.append(self.base_handle.read(length))
+                else:
+                    return None
+        except:
+            log.warn('receiver cannot copy block %i from %s'
+                     % (start, self.base_name))
+            config.tb(log.WARNING)
+            return None
+        if size:
+            return None
+        return ''.join(data)
+
+    def closeBase(self):
+        if self.base_handle:
+            self.base_handle.close()
+            self.base_handle = None
+
+    def sendMissing(self, start, end):
+        ranges = self.received.getMissingRanges(start / self.block_size,
+                end / self.block_size)
+        if not ranges:
+            return
+        text = ','.join('%i-%i' % (first * self.block_size, last
+                        * self.block_size) for (first, last) in ranges)
+        msg = ProtocolMsg(self.buddy.bl, None, 'filedata_missing',
+                          (self.id, text))
+        msg.send(self.buddy)
+
+    def setDigest(self, algorithm, digest):
+
+        # newer clients send a digest of the whole file,
+        # it is checked before the file is saved
+
+        self.digest_algorithm = algorithm
+        self.digest = digest
+        self.checkpoint(True)
+
+    def checkDigest(self):
+
+        # runs in the worker thread (see close()), it reads the whole
+        # file. The result goes back to the network loop.
+
+        ok = False
+        try:
+            digest = newDigest(self.digest_algorithm)
+            f = open(self.file_name_tmp, 'rb')
+            while True:
+                data = f.read(1048576)
+                if not data:
+                    break
+                digest.update(data)
+            f.close()
+            ok = digest.hexdigest() == self.digest
+        except ValueError:
+            log.warn('unknown digest algorithm %s'
+                     % self.digest_algorithm)
+        except:
+            config.tb()
+        self.buddy.bl.network.callInLoop(self.finishClose, ok)
+
+    def setFileNameSave(self, file_name_save):
+        self.file_name_save = file_name_save
+        try:
+            if self.archive:
+
+                # an empty directory as placeholder, replaced
+                # with the unpacked archive on close()
+
+                os.mkdir(file_name_save)
+                self.file_handle_save = None
+            elif self.isBase(file_name_save):
+
+                # the old version is replaced only on close(),
+                # until then we still copy blocks from it
+
+                self.file_handle_save = open(file_name_save, 'a')
+            else:
+                self.file_handle_save = open(file_name_save, 'w')
+            log.warn('created placeholder %s' % self.file_name_save)
+            self.buddy.bl.network.callInLoop(self.preallocate)
+        except:
+            self.file_handle_save = None
+            self.file_name_save = None
+            self.file_save_error = str(sys.exc_info()[1])
+            log.warn('%s could not be created: %s'
+                     % (self.file_name_save, self.file_save_error))
+
+    def preallocate(self):
+
+        # the user has accepted the file. Called in the network loop,
+        # nothing else writes to the file meanwhile.
+
+        if self.closed or self.disk_error:
+            return
+        try:
+            preallocateFile(self.file_handle_tmp, self.file_size)
+        except:
+            self.file_handle_tmp.truncate(0)
+            self.failDisk(str(sys.exc_info()[1]))
+
+    def isBase(self, file_name):
+        return self.base_name != None \
+            and os.path.abspath(file_name) \
+            == os.path.abspath(self.base_name)
+
+    def removePlaceholder(self):
+        if self.archive:
+            os.rmdir(self.file_name_save)
+        else:
+            self.file_handle_save.close()
+            if not self.isBase(self.file_name_save):
+                os.unlink(self.file_name_save)
+        self.file_name_save = ''
+
+    def sendStopMessage(self):
+        msg = ProtocolMsg(self.buddy.bl, None, 'file_stop_sending',
+                          self.id)
+        msg.send(self.buddy)
+
+    def closeForced(self):
+        try:
+            self.progress.update(self.file_size, -1, 'transfer aborted')
+        except:
+            pass
+        self.sendStopMessage()
+        self.file_name_save = ''
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.flushWrites()
+            self.unpack()
+            if self.file_name_save and self.received.isComplete():
+                os.fsync(self.file_handle_tmp.fileno())
+            self.file_handle_tmp.close()
+            self.closeBase()
+            if self.received.isComplete():
+                logTransferStats('received', self.file_name,
+                                 self.raw_bytes, self.wire_bytes,
+                                 time.time() - self.time_started)
+        except:
+            pass
+
+        # hashing a big file takes a while, the network loop
+        # must go on meanwhile. finishClose() does the rest.
+
+        if self.file_name_save and self.digest:
+            callInWorker(self.checkDigest)
+        else:
+            self.finishClose(True)
+
+    def finishClose(self, digest_ok):
+        try:
+            if self.file_name_save and not digest_ok:
+                log.critical('%s from %s has a wrong digest, not saving'
+                             % (self.file_name, self.buddy.address))
+                self.removePlaceholder()
+                try:
+                    self.progress.update(self.file_size, -1,
+                            'checksum error, file not saved')
+                except:
+                    pass
+            if self.file_name_save and self.archive \
+                and not (self.unpacker and self.unpacker.finished):
+                log.critical('%s from %s could not be unpacked, not saving'
+                              % (self.file_name, self.buddy.address))
+                self.removePlaceholder()
+                try:
+                    self.progress.update(self.file_size, -1,
+                            'broken archive, not saved')
+                except:
+                    pass
+            if self.unpacker:
+                self.unpacker.close()
+            if self.file_name_save and self.archive:
+                os.rmdir(self.file_name_save)
+                shutil.move(self.archive_dir, self.file_name_save)
+                os.unlink(self.file_name_tmp)
+                log.warn('moved unpacked archive to %s'
+                         % self.file_name_save)
+            elif self.file_name_save:
+                self.file_handle_save.close()
+                shutil.move(self.file_name_tmp, self.file_name_save)
+                log.warn('moved temporary file to %s'
+                         % self.file_name_save)
+                addReceivedFile(self.buddy.address, self.file_name,
+                                os.path.abspath(self.file_name_save))
+            else:
+                os.unlink(self.file_name_tmp)
+                if self.archive:
+                    shutil.rmtree(self.archive_dir, True)
+                log.warn('deleted temporary file %s'
+                         % self.file_name_tmp)
+            self.buddy.bl.transfers.removeReceiver(self)
+        except:
+            pass
+
+        deleteTransferState(self.getStateName())
+
+
+# --- ### Protocol messages
+
+
+class MProtocolMsg(type):
+
+    # Meta-Class for ProtocolMsg. It automagically creates a hash for
+    # mapping protocol-commands and corresponding ProtocolMsg-subclasses
+
+    subclasses = {}
+
+    def __init__(
+        cls,
+        name,
+        bases,
+        dict,
+        ):
+
+        # this will be executed whenever a ProtocolMsg gets *defined*
+        # (happens once at the time when this module is imported).
+        # the commands and their classes will be stored in
+        # the static member MProtocolMsg.subclasses
+
+        cls.subclasses[dict['command']] = cls
+        super(MProtocolMsg, cls).__init__(name, bases, dict)
+
+
+class ProtocolMsg(object):
+
+    __metaclass__ = MProtocolMsg
+    command = ''
+
+    # the base class for all ProtocolMsg-classes. All message classes
+    # must inherit from this and declare the static member command
+    # which is used (by the metaclass-magic-voodoo;-) to map between the
+    # command-string and the corresponding message class
+
+    # Besides being the base class for all ProtocolMsg_* classes
+    # this class has two other use cases:
+    # - it is used for outgoing messages (therefore the send method)
+    # - it is instantiated for every unknown incoming message
+
+    def __init__(
+        self,
+        bl,
+        connection,
+        command,
+        data,
+        payload=None,
+        ):
+
+        # connection may be None for outgoing messages
+        # data can be a number, a string, a tuple or a list
+        # payload (outgoing only) is a buffer which is appended to the
+        # data as the last argument. In binary framing mode it goes
+        # into the send queue as it is, without being copied.
+
+        self.connection = connection
+        if connection:
+            self.buddy = connection.buddy
+        else:
+            self.buddy = None
+        self.bl = bl
+        self.command = command
+
+        # self.text is always a string containing all arguments and data
+
+        if type(data) in (list, tuple):
+            self.text = ' '.join(str(x) for x in data)
+        else:
+            self.text = str(data)
+        self.payload = payload
+        self.parse()
+
+    def parse(self):
+        pass
+
+    def execute(self):
+
+        # a generic message of this class will be automatically instantiated
+        # if an incoming message with an unknown command is received
+        # do nothing and just reply with "not_implemented"
+
+        if self.buddy:
+            log.warn('received unimplemented msg (%s) from %s'
+                     % (self.command, self.buddy.address))
+            message = ProtocolMsg(self.bl, None, 'not_implemented',
+                                  self.command)
+            message.send(self.buddy)
+        else:
+            log.warn('received unknown command on unknown connection. closing.'
+                     )
+            log.warn("unknown connection had '%s' in last ping. closing"
+                      % self.connection.last_ping_address)
+            self.connection.close()
+
+    def getLine(self):
+
+        # bring the message into a form we can transmit over the socket
+        # it will escape newline characters, as they are the only
+        # characters with a special meaning.
+        # the opposite of this operation takes place in the function
+        # ProtocolMsgFromLine() where incoming messages are instantiated.
+
+        if self.payload != None:
+            return self.command + ' ' + escape(self.text + ' '
+                    + str(self.payload))
+        return self.command + ' ' + escape(self.text)
+
+    def getFrame(self):
+
+        # the binary form of the message (see Connection.sendMsg())
+        # command and data are prefixed with their lengths, the data
+        # can be sent as it is, without any escaping.
+        # Returns a list of strings and buffers to be sent one after
+        # the other, the payload is not joined with the header.
+
+        if self.payload != None:
+            header = self.text + ' '
+            length = len(header) + len(self.payload)
+            return [struct.pack('>BI', len(self.command), length)
+                    + self.command + header, self.payload]
+        return [struct.pack('>BI', len(self.command), len(self.text))
+                + self.command + self.text]
+
+    def send(self, buddy, conn=0):
+
+        # conn=0 use outgoing connection
+        # conn=1 use incoming connection
+        # FIXME: what if buddy is None?
+
+        buddy.sendMsg(self, conn)
+
+
+def ProtocolMsgFromLine(bl, conn, line):
+
+    # this is the factory for producing instances of ProtocolMsg classes.
+    # it separates the first word from the line, looks up the corresponding
+    # ProtocolMsg subclass which can handle this kind of protocol message
+    # and returns an instance. If no class matches the command string it
+    # returns a ProtocolMsg instance which is generic and just does nothing.
+
+    # line can be a string or a buffer object (see Receiver)
+
+    (command, text_escaped) = str(line).split(' ', 1)
+
+    # the rest of the message can be arbitrary (but escaped) data.
+    # unescape it, so it is in it's original (maybe even binary) form.
+
+    data = unescape(text_escaped)
+    return ProtocolMsgFromData(bl, conn, command, data)
+
+
+def ProtocolMsgFromData(
+    bl,
+    conn,
+    command,
+    data,
+    ):
+
+    # messages received in binary framing mode come in here directly,
+    # their data is not escaped (and can be a buffer object).
+
+    data = str(data)
+    try:
+        return MProtocolMsg.subclasses[command](bl, conn, command, data)
+    except:
+        return ProtocolMsg(bl, conn, command, data)
+
+
+def getOwnCapabilities():
+
+    # the list of optional protocol features this client supports.
+    # it is sent after the version message.
+
+    return ['binary_framing', 'max_block_size=%i' % getMaxBlockSize(),
+            'checksums=%s' % ','.join(getAvailableChecksums()), 'resume',
+            'selective_ack', 'archive', 'compression=%s'
+            % ','.join(getAvailableCompressions()), 'delta',
+            'offline_message']
+
+
+def getMaxBlockSize():
+
+    # the biggest file transfer blocks we accept. In the worst case
+    # escaping doubles the size of a filedata line, it must still be
+    # below max_line_length.
+
+    return min(config.getint('files', 'max_block_size'),
+               (config.getint('internal', 'max_line_length') - 1024)
+               / 2)
+
+
+class ProtocolMsg_not_implemented(ProtocolMsg):
+
+    command = 'not_implemented'
+
+    # FIXME: Maybe it would be better to have a *separate*
+    # "not_implemented"-message for every protocol message.
+    # I have to meditate over this for a while.
+
+    def execute(self):
+        if self.buddy:
+            log.critical("%s says it can't handle '%s'"
+                         % (self.buddy.address, self.text))
+            if self.text == 'capabilities':
+
+                # an older client, it gets only the plain line protocol
+
+                self.buddy.setCapabilities([])
+
+
+class ProtocolMsg_ping(ProtocolMsg):
+
+    command = 'ping'
+
+    # a ping message consists of sender address and a random string
+
+    def parse(self):
+
+        # the sender address is in the text. we take it for granted
+        # and see if we can find a buddy in our list with that address.
+
+        (self.address, self.answer) = self.text.split(' ', 1)
+        self.buddy = self.bl.getBuddyFromAddress(self.address)
+
+    def execute(self):
+        log.critical('received ping from %s' % self.address)
+
+        # first a little security check to detect mass pings
+        # with faked host names over the same connection
+
+        if self.connection.last_ping_address != '':
+
+            # this is not the first ping over this connection
+            # lets see if it has the correct address:
+
+            if self.address != self.connection.last_ping_address:
+                log.info('Possible Attack: in-connection sent fake address %s'
+                          % self.address)
+                log.info('Will disconnect incoming connection from fake %s'
+                          % self.address)
+                self.connection.close()
+                return
+        else:
+            self.connection.last_ping_address = self.address
+
+        # another check for faked pings: we search all our already
+        # *connected* buddies and if there is one with the same address
+        # but another incoming connection then this one must be a fake.
+
+        found = False
+        for buddy in (self.bl.getBuddyFromAddress(self.address),
+                      self.bl.getIncomingBuddyFromAddress(self.address)):
+            if buddy and buddy.conn_in:
+                if buddy.conn_in != self.connection:
+                    found = True
+                    break
+        if found:
+            log.warn('detected ping from %s on other connection.'
+                     % self.address)
+            log.warn('sending a ping to %s to find correct in-connection.'
+                      % self.address)
+            buddy.sendPing()
+
+        # if someone is pinging us with our own address and the
+        # random value is not from us, then someone is definitely
+        # trying to fake and we can close.
+
+        if self.address == config.get('client', 'own_hostname'):
+            own_buddy = self.bl.getBuddyFromAddress(self.address)
+            if own_buddy.random1 != self.answer:
+                log.warn('faked ping with our own address. closing.')
+                self.connection.send(['message you are trying to use my ID!\n'
+                        ])
+                return
+
+        # ping messages must be answered with pong messages
+        # the pong must contain the same random string as the ping.
+        # note that we will NOT yet assign buddy.conn_in
+        # this can only be done in reaction to a pong message
+
+        if not self.buddy:
+            log.warn('%s is not on the buddy-list' % self.address)
+
+            # we have received a ping, but there is no buddy with
+            # that address in our buddy-list. The only reason for that
+            # can be that someone new has added our address to his list
+            # and his client now has connected us. First we search if
+            # we already have a connection to this buddy, if not we
+            # create one.
+
+            self.buddy = \
+                self.bl.getIncomingBuddyFromAddress(self.address)
+            if not self.buddy:
+
+                # create it and put it in the temporary list
+
+                log.warn('%s is new. creating a temporary buddy instance'
+                          % self.address)
+                self.buddy = Buddy(self.address, self.bl,
+                                   temporary=True)
+                self.bl.addIncomingBuddy(self.buddy)
+            else:
+                log.warn('%s is already in the incoming list'
+                         % self.address)
+                log.warn('%s status is %i' % (self.address,
+                         self.buddy.status))
+
+            # this will connect if necessary
+
+            log.warn('%s.keepAlive()' % self.buddy.address)
+            self.buddy.keepAlive()
+
+        log.critical('sending pong and status to %s' % self.address)
+        self.buddy.resetConnectionFailCounter()
+        answer = ProtocolMsg(self.bl, None, 'pong', self.answer)
+        answer.send(self.buddy)
+        self.buddy.can_send = True
+        self.buddy.sendStatus()
+
+        if self.bl.isListed(self.buddy):
+            self.buddy.sendAddMe()
+
+        self.buddy.sendVersion()
+
+
+class ProtocolMsg_pong(ProtocolMsg):
+
+    command = 'pong'
+
+    def parse(self):
+        self.is_new_buddy = False
+
+        # incoming pong messages are used to identify and authenticate
+        # incoming connections. Basically we send out pings and see which
+        # corresponding pongs come in on which connections.
+        # we search all our known buddies for the corresponding random
+        # string to identify which buddy is replying here.
+
+        # first we search the buddy-list
+
+        self.buddy = self.bl.getBuddyFromRandom(self.text)
+        if not self.buddy:
+
+            # we also try to find it in the temporary buddies list
+
+            self.buddy = self.bl.getIncomingBuddyFromRandom(self.text)
+
+    def execute(self):
+
+        # if the pong is found to belong to a known buddy we can now
+        # safely assign this incoming connection to this buddy and
+        # regard the handshake as completed.
+
+        if self.buddy:
+            log.critical('received pong from %s' % self.buddy.address)
+
+            # assign the in-connection to this buddy
+
+            self.buddy.onInConnectionFound(self.connection)
+        else:
+
+            # there is no buddy for this pong. nothing to do.
+
+            log.warn("unknown incoming 'pong'. ignoring.")
+
+
+class ProtocolMsg_version(ProtocolMsg):
+
+    command = 'version'
+
+    def parse(self):
+        self.version = self.text
+
+    def execute(self):
+        if self.buddy:
+            log.warn('%s has version %s' % (self.buddy.address,
+                     self.version))
+            self.buddy.version = self.version
+
+
+class ProtocolMsg_capabilities(ProtocolMsg):
+
+    command = 'capabilities'
+
+    # the list of optional protocol features the other client
+    # supports, see getOwnCapabilities()
+
+    def parse(self):
+        self.capabilities = self.text.split()
+
+    def execute(self):
+        if self.buddy:
+            log.warn('%s has capabilities %s' % (self.buddy.address,
+                     self.text))
+            self.buddy.setCapabilities(self.capabilities)
+
+
+class ProtocolMsg_binary_framing(ProtocolMsg):
+
+    command = 'binary_framing'
+
+    # the other side announces that everything following this message
+    # on this connection will be sent in binary frames. We will only
+    # receive this if we have announced binary_framing ourselves.
+
+    def execute(self):
+        log.warn('connection %s switches to binary framing'
+                 % self.connection)
+        self.connection.receiver.setBinary()
+
+
+class ProtocolMsg_status(ProtocolMsg):
+
+    command = 'status'
+
+    # this is a status message.
+
+    def execute(self):
+
+        # set the status flag of the corresponding buddy
+
+        if self.buddy:
+            log.critical('received status %s from %s' % (self.text,
+                         self.buddy.address))
+
+            # send offline messages if buddy was previously offline
+
+            if self.buddy.status == STATUS_HANDSHAKE:
+                log.warn('%s came online, sending delayed messages'
+                         % self.buddy.address)
+                self.buddy.sendOfflineMessages()
+
+            # set buddy status
+
+            if self.text == 'available':
+                self.buddy.setStatus(STATUS_ONLINE)
+            if self.text == 'away':
+                self.buddy.setStatus(STATUS_AWAY)
+            if self.text == 'xa':
+                self.buddy.setStatus(STATUS_XA)
+
+
+class ProtocolMsg_add_me(ProtocolMsg):
+
+    command = 'add_me'
+
+    def execute(self):
+        if self.buddy:
+            log.warn('add me from %s' % self.buddy.address)
+            if not self.bl.isListed(self.buddy):
+                log.warn('received add_me from new buddy %s'
+                         % self.buddy.address)
+                self.buddy.addToList()
+                msg = '<- has added you'
+                self.bl.onChatMessage(self.buddy, msg)
+
+
+class ProtocolMsg_remove_me(ProtocolMsg):
+
+    command = 'remove_me'
+
+    def execute(self):
+        if self.buddy:
+            log.warn('received remove_me from buddy %s'
+                     % self.buddy.address)
+            if self.bl.isListed(self.buddy):
+                log.warn('removing %s from list' % self.buddy.address)
+                self.bl.removeBuddy(self.buddy)
+        else:
+            log.warn("received 'remove_me' on unknown connection")
+            log.warn("unknown connection had '%s' in last ping. closing"
+                      % self.connection.last_ping_address)
+            self.connection.close()
+
+
+class ProtocolMsg_message(ProtocolMsg):
+
+    command = 'message'
+
+    # this is a normal text chat message.
+
+    def parse(self):
+        self.text = self.text.decode('UTF-8')
+
+    def execute(self):
+
+        # give buddy and text to bl. bl will then call into the gui
+        # to open a chat window and/or display the text.
+
+        if self.buddy:
+            if self.bl.isListed(self.buddy):
+                if self.text.strip() != '':
+                    self.bl.onChatMessage(self.buddy, self.text)
+            else:
+                log.warn('***** wrong version reply to %s'
+                         % self.buddy.address)
+                msg = 'This is an automatic reply. '
+                msg += 'Your version seems to be out of date.'
+                msg += \
+                    'Make sure you have the latest version of TorChat. '
+                self.buddy.sendChatMessage(msg)
+                self.buddy.sendRemoveMe()
+        else:
+            log.warn("received 'message' on unknown connection")
+            log.warn("unknown connection had '%s' in last ping. closing"
+                      % self.connection.last_ping_address)
+            self.connection.close()
+
+
+class ProtocolMsg_message_compressed(ProtocolMsg_message):
+
+    command = 'message_compressed'
+
+    # a long chat message, compressed with the algorithm given in the
+    # first word. Only sent to clients with the compression capability.
+
+    def parse(self):
+        (algorithm, data) = self.text.split(' ', 1)
+        self.text = decompress(algorithm, data, config.getint('internal'
+                               , 'max_line_length'))
+        ProtocolMsg_message.parse(self)
+
+
+class ProtocolMsg_offline_message(ProtocolMsg):
+
+    command = 'offline_message'
+
+    # a chat message that was written while we were offline, with its
+    # id and the time it was written. Must be confirmed with
+    # offline_message_ok, it is sent again until it is. Only sent to
+    # clients with the offline_message capability.
+
+    def parse(self):
+        (id, when, text) = self.text.split(' ', 2)
+        self.id = int(id)
+        self.time = int(when)
+        self.text = text.decode('UTF-8')
+
+    def execute(self):
+        if not self.buddy:
+            log.warn("received 'offline_message' on unknown connection")
+            log.warn("unknown connection had '%s' in last ping. closing"
+                      % self.connection.last_ping_address)
+            self.connection.close()
+            return
+        if not self.bl.isListed(self.buddy):
+            return
+        if self.id not in self.buddy.offline_received \
+            and self.text.strip() != '':
+            if len(self.buddy.offline_received) >= OFFLINE_RECEIVED_MAX:
+                self.buddy.offline_received.clear()
+            self.buddy.offline_received.add(self.id)
+            when = time.strftime('%Y-%m-%d %H:%M',
+                                 time.localtime(self.time))
+            self.bl.onChatMessage(self.buddy, '[delayed %s] %s'
+                                  % (when, self.text))
+        msg = ProtocolMsg(self.bl, None, 'offline_message_ok', self.id)
+        msg.send(self.buddy)
+
+
+class ProtocolMsg_offline_message_ok(ProtocolMsg):
+
+    command = 'offline_message_ok'
+
+    # the confirmation of an offline_message, the
+    # sender can now delete it from its store
 
-        # a generic message of this class will be automatically instantiated
-        # if an incoming message with an unknown command is received
-        # do nothing and just reply with "not_implemented"
+    def parse(self):
+        self.id = int(self.text)
 
+    def execute(self):
         if self.buddy:
-            log.warn('received unimplemented msg (%s) from %s'
-                     % (self.command, self.buddy.address))
-            message = ProtocolMsg(self.bl, None, 'not_implemented',
-                                  self.command)
-            message.send(self.buddy)
+            self.buddy.onOfflineMessageConfirmed(self.id)
         else:
-            log.warn('received unknown command on unknown connection. closing.'
-                     )
+            log.warn("received 'offline_message_ok' on unknown connection")
             log.warn("unknown connection had '%s' in last ping. closing"
                       % self.connection.last_ping_address)
             self.connection.close()
 
-    def getLine(self):
-
-        # bring the message into a form we can transmit over the socket
-        # it will escape newline characters, as they are the only
-        # characters with a special meaning.
-        # the opposite of this operation takes place in the function
-        # ProtocolMsgFromLine() where incoming messages are instantiated.
 
-        return self.command + ' ' + escape(self.text)
+class ProtocolMsg_filename(ProtocolMsg):
 
-    def send(self, buddy, conn=0):
+    command = 'filename'
+    archive = False
 
-        # conn=0 use outgoing connection
-        # conn=1 use incoming connection
-        # FIXME: what if buddy is None?
+    # the first message in a file transfer, initiating the transfer.
 
-        buddy.sendLine(self.getLine(), conn)
+    def parse(self):
+        (self.id, text) = self.text.split(' ', 1)
+        (file_size, text) = text.split(' ', 1)
+        (block_size, self.file_name) = text.split(' ', 1)
+        self.file_size = int(file_size)
+        self.block_size = int(block_size)
+        self.file_name = self.file_name.decode('utf-8')
+        self.file_name = self.file_name.replace('\\', '')
+        self.file_name = self.file_name.replace('/', '')
 
+        # we don't accept blocks bigger than we have announced
+        # (older clients always use LEGACY_BLOCK_SIZE)
 
-def ProtocolMsgFromLine(bl, conn, line):
+        self.acceptable = 0 < self.block_size <= max(getMaxBlockSize(),
+                LEGACY_BLOCK_SIZE) and self.file_size >= 0
 
-    # this is the factory for producing instances of ProtocolMsg classes.
-    # it separates the first word from the line, looks up the corresponding
-    # ProtocolMsg subclass which can handle this kind of protocol message
-    # and returns an instance. If no class matches the command string it
-    # returns a ProtocolMsg instance which is generic and just does nothing.
+    def execute(self):
+        if not self.buddy:
+            log.warn("received 'filename' on unknown connection")
+            log.warn("unknown connection had '%s' in last ping. closing"
+                      % self.connection.last_ping_address)
+            self.connection.close()
+            return
 
-    (command, text_escaped) = line.split(' ', 1)
+        if not self.acceptable:
+            log.warn('%s wants to send %s with a block size of %i. refusing'
+                      % (self.buddy.address, self.file_name,
+                     self.block_size))
+            msg = ProtocolMsg(self.bl, None, 'file_stop_sending',
+                              self.id)
+            msg.send(self.buddy)
+            return
 
-    # the rest of the message can be arbitrary (but escaped) data.
-    # unescape it, so it is in it's original (maybe even binary) form.
+        # the sender might continue an interrupted transfer. We might
+        # still have the receiver or have saved its state before we
+        # were restarted. Then we only need to tell it where to go on.
 
-    data = unescape(text_escaped)
-    try:
-        return MProtocolMsg.subclasses[command](bl, conn, command, data)
-    except:
-        return ProtocolMsg(bl, conn, command, data)
+        receiver = self.bl.getFileReceiver(self.buddy.address, self.id)
+        if receiver and receiver.canResume(self.file_size,
+                self.block_size, self.file_name, self.archive):
+            receiver.sendResume()
+            return
+        state = self.bl.popResumableReceiver(self.buddy.address, self.id)
+        if state and state['file_size'] == self.file_size \
+            and state['block_size'] == self.block_size \
+            and state['file_name'] == self.file_name \
+            and state.get('archive', False) == self.archive \
+            and os.path.exists(state['file_name_tmp']):
+            try:
+                receiver = FileReceiver(
+                    self.buddy,
+                    self.id,
+                    self.block_size,
+                    self.file_size,
+                    self.file_name,
+                    self.archive,
+                    state,
+                    )
+                receiver.sendResume()
+                return
+            except:
+                config.tb()
 
+        # we create a file receiver instance which can deal with the
+        # file data we expect to receive now
 
-class ProtocolMsg_not_implemented(ProtocolMsg):
+        FileReceiver(self.buddy, self.id, self.block_size,
+                     self.file_size, self.file_name, self.archive)
 
-    command = 'not_implemented'
 
-    # FIXME: Maybe it would be better to have a *separate*
-    # "not_implemented"-message for every protocol message.
-    # I have to meditate over this for a while.
+class ProtocolMsg_filename_archive(ProtocolMsg_filename):
 
-    def execute(self):
-        if self.buddy:
-            log.critical("%s says it can't handle '%s'"
-                         % (self.buddy.address, self.text))
+    command = 'filename_archive'
 
+    # like filename, but the file is a tar archive of several files
+    # and directories which the receiver unpacks while receiving.
+    # Only sent to clients with the archive capability.
 
-class ProtocolMsg_ping(ProtocolMsg):
+    archive = True
 
-    command = 'ping'
 
-    # a ping message consists of sender address and a random string
+class ProtocolMsg_filedata(ProtocolMsg):
 
-    def parse(self):
+    command = 'filedata'
 
-        # the sender address is in the text. we take it for granted
-        # and see if we can find a buddy in our list with that address.
+    # after a filename message has initiated the transfer several
+    # filedata messagess transport the actual data in blocks of fixed
+    # size. The data blocks are transmitted as they are and only
+    # newline characters are escaped. (see escape() and unescape())
 
-        (self.address, self.answer) = self.text.split(' ', 1)
-        self.buddy = self.bl.getBuddyFromAddress(self.address)
+    def parse(self):
+        (self.id, text) = self.text.split(' ', 1)
+        (start, text) = text.split(' ', 1)
+        (self.hash, self.data) = text.split(' ', 1)
+        self.start = int(start)
+        self.wire_size = len(self.data)
 
     def execute(self):
-        log.critical('received ping from %s' % self.address)
+        if not self.buddy:
+            log.warn("received 'filedata' on unknown connection")
+            log.warn("unknown connection had '%s' in last ping. closing"
+                      % self.connection.last_ping_address)
+            self.connection.close()
+            return
 
-        # first a little security check to detect mass pings
-        # with faked host names over the same connection
+        # there should already be a receiver, because there should have been
+        # a "filename"-message at the very beginning of the transfer.
 
-        if self.connection.last_ping_address != '':
+        receiver = self.bl.getFileReceiver(self.buddy.address, self.id)
+        if receiver and self.data == None:
 
-            # this is not the first ping over this connection
-            # lets see if it has the correct address:
+            # could not be decompressed
 
-            if self.address != self.connection.last_ping_address:
-                log.info('Possible Attack: in-connection sent fake address %s'
-                          % self.address)
-                log.info('Will disconnect incoming connection from fake %s'
-                          % self.address)
-                self.connection.close()
-                return
+            msg = ProtocolMsg(self.bl, None, 'filedata_error', (self.id,
+                              self.start))
+            msg.send(self.buddy)
+        elif receiver:
+            receiver.data(self.start, self.hash, self.data,
+                          self.wire_size)
         else:
-            self.connection.last_ping_address = self.address
-
-        # another check for faked pings: we search all our already
-        # *connected* buddies and if there is one with the same address
-        # but another incoming connection then this one must be a fake.
 
-        found = False
-        for buddy in self.bl.list + self.bl.incoming_buddies:
-            if buddy.conn_in:
-                if buddy.address == self.address:
-                    if buddy.conn_in != self.connection:
-                        found = True
-                        break
-        if found:
-            log.warn('detected ping from %s on other connection.'
-                     % self.address)
-            log.warn('sending a ping to %s to find correct in-connection.'
-                      % self.address)
-            buddy.sendPing()
+            # if there is no receiver for this data, we just reply
+            # with a stop message and hope the sender gets it and
+            # stops sending data. Not much else to do for us here.
 
-        # if someone is pinging us with our own address and the
-        # random value is not from us, then someone is definitely
-        # trying to fake and we can close.
+            msg = ProtocolMsg(self.bl, None, 'file_stop_sending',
+                              self.id)
+            msg.send(self.buddy)
 
-        if self.address == config.get('client', 'own_hostname'):
-            own_buddy = self.bl.getBuddyFromAddress(self.address)
-            if own_buddy.random1 != self.answer:
-                log.warn('faked ping with our own address. closing.')
-                self.connection.send('message you are trying to use my ID!\n'
-                        )
-                return
 
-        # ping messages must be answered with pong messages
-        # the pong must contain the same random string as the ping.
-        # note that we will NOT yet assign buddy.conn_in
-        # this can only be done in reaction to a pong message
+class ProtocolMsg_filedata_compressed(ProtocolMsg_filedata):
 
-        if not self.buddy:
-            log.warn('%s is not on the buddy-list' % self.address)
+    command = 'filedata_compressed'
 
-            # we have received a ping, but there is no buddy with
-            # that address in our buddy-list. The only reason for that
-            # can be that someone new has added our address to his list
-            # and his client now has connected us. First we search if
-            # we already have a connection to this buddy, if not we
-            # create one.
+    # a compressed filedata block, the algorithm is given after the
+    # hash (which is the hash of the uncompressed data). Only sent to
+    # clients with the compression capability.
 
-            self.buddy = \
-                self.bl.getIncomingBuddyFromAddress(self.address)
-            if not self.buddy:
+    def parse(self):
+        (self.id, start, self.hash, algorithm, data) = \
+            self.text.split(' ', 4)
+        self.start = int(start)
+        self.wire_size = len(data)
+        try:
+            self.data = decompress(algorithm, data, getMaxBlockSize())
+        except:
+            log.warn('cannot decompress filedata block %i' % self.start)
+            self.data = None
 
-                # create it and put it in the temporary list
 
-                log.warn('%s is new. creating a temporary buddy instance'
-                          % self.address)
-                self.buddy = Buddy(self.address, self.bl,
-                                   temporary=True)
-                self.bl.incoming_buddies.append(self.buddy)
-            else:
-                log.warn('%s is already in the incoming list'
-                         % self.address)
-                log.warn('%s status is %i' % (self.address,
-                         self.buddy.status))
+class ProtocolMsg_delta_copy(ProtocolMsg_filedata):
 
-            # this will connect if necessary
+    command = 'delta_copy'
 
-            log.warn('%s.keepAlive()' % self.buddy.address)
-            self.buddy.keepAlive()
+    # instead of a filedata block: the receiver has (parts of) this
+    # block in the old version of the file. It is put together from
+    # the comma separated list of old position:size and size, the
+    # latter are new data which follow the list after a space. The
+    # hash is the hash of the whole block as in filedata. Only sent to
+    # clients with the delta capability after delta_signatures.
 
-        log.critical('sending pong and status to %s' % self.address)
-        self.buddy.resetConnectionFailCounter()
-        answer = ProtocolMsg(self.bl, None, 'pong', self.answer)
-        answer.send(self.buddy)
-        self.buddy.can_send = True
-        self.buddy.sendStatus()
+    def parse(self):
+        ProtocolMsg_filedata.parse(self)
+        (self.copies, self.literal) = self.data.split(' ', 1)
 
-        if self.buddy in self.bl.list:
-            self.buddy.sendAddMe()
+    def execute(self):
+        self.data = None
+        if self.buddy:
+            receiver = self.bl.getFileReceiver(self.buddy.address,
+                    self.id)
+            if receiver:
+                self.data = receiver.readDelta(self.start, self.copies,
+                        self.literal)
+        ProtocolMsg_filedata.execute(self)
 
-        self.buddy.sendVersion()
 
+class ProtocolMsg_filedata_ok(ProtocolMsg):
 
-class ProtocolMsg_pong(ProtocolMsg):
+    command = 'filedata_ok'
 
-    command = 'pong'
+    # every received "filedata" must be confirmed with a "filedata_ok"
+    # (or a "filedata_error")
 
     def parse(self):
-        self.is_new_buddy = False
+        (self.id, start) = self.text.split(' ', 1)
+        self.start = int(start)
 
-        # incoming pong messages are used to identify and authenticate
-        # incoming connections. Basically we send out pings and see which
-        # corresponding pongs come in on which connections.
-        # we search all our known buddies for the corresponding random
-        # string to identify which buddy is replying here.
+    def execute(self):
+        if self.buddy:
+            sender = self.bl.getFileSender(self.buddy.address, self.id)
+            if sender:
+                sender.receivedOK(self.start)
+            else:
 
-        # first we search the buddy-list
+                # there is no sender (anymore) to handle confirmation messages
+                # so we can send a stop message to tell the other side
+                # to stop receiving
 
-        self.buddy = self.bl.getBuddyFromRandom(self.text)
-        if not self.buddy:
+                msg = ProtocolMsg(self.bl, None, 'file_stop_receiving',
+                                  self.id)
+                msg.send(self.buddy)
+        else:
+            log.warn("received 'filedata_ok' on unknown connection")
+            log.warn("unknown connection had '%s' in last ping. closing"
+                      % self.connection.last_ping_address)
+            self.connection.close()
 
-            # we also try to find it in the temporary buddies list
 
-            self.buddy = self.bl.getIncomingBuddyFromRandom(self.text)
+class ProtocolMsg_filedata_error(ProtocolMsg):
 
-    def execute(self):
+    command = 'filedata_error'
 
-        # if the pong is found to belong to a known buddy we can now
-        # safely assign this incoming connection to this buddy and
-        # regard the handshake as completed.
+    def parse(self):
+        (self.id, start) = self.text.split(' ', 1)
+        self.start = int(start)
 
+    def execute(self):
         if self.buddy:
-            log.critical('received pong from %s' % self.buddy.address)
-
-            # assign the in-connection to this buddy
-
-            self.buddy.onInConnectionFound(self.connection)
+            sender = self.bl.getFileSender(self.buddy.address, self.id)
+            if sender:
+                sender.receivedError(self.start)
+            else:
+                msg = ProtocolMsg(self.bl, None, 'file_stop_receiving',
+                                  self.id)
+                msg.send(self.buddy)
         else:
+            log.warn("received 'filedata_error' on unknown connection")
+            log.warn("unknown connection had '%s' in last ping. closing"
+                      % self.connection.last_ping_address)
+            self.connection.close()
 
-            # there is no buddy for this pong. nothing to do.
-
-            log.warn("unknown incoming 'pong'. ignoring.")
 
+class ProtocolMsg_filedata_missing(ProtocolMsg):
 
-class ProtocolMsg_version(ProtocolMsg):
+    command = 'filedata_missing'
 
-    command = 'version'
+    # selective acknowledgement: a receiver which has announced the
+    # selective_ack capability accepts blocks in any order and tells
+    # the sender which ranges (start-end, comma separated, end
+    # excluded) it has not received, instead of filedata_error.
 
     def parse(self):
-        self.version = self.text
+        (self.id, text) = self.text.split(' ', 1)
+        self.ranges = []
+        for item in text.split(','):
+            (start, end) = item.split('-')
+            self.ranges.append((int(start), int(end)))
 
     def execute(self):
         if self.buddy:
-            log.warn('%s has version %s' % (self.buddy.address,
-                     self.version))
-            self.buddy.version = self.version
+            sender = self.bl.getFileSender(self.buddy.address, self.id)
+            if sender:
+                sender.resendBlocks(self.ranges)
+        else:
+            log.warn("received 'filedata_missing' on unknown connection")
+            log.warn("unknown connection had '%s' in last ping. closing"
+                      % self.connection.last_ping_address)
+            self.connection.close()
 
 
-class ProtocolMsg_status(ProtocolMsg):
+class ProtocolMsg_filedigest(ProtocolMsg):
 
-    command = 'status'
+    command = 'filedigest'
 
-    # this is a status message.
+    # the digest of the whole file, sent right before the last
+    # filedata message (only to clients that have announced the
+    # algorithm in their checksums capability)
+
+    def parse(self):
+        (self.id, self.algorithm, self.digest) = self.text.split(' ', 2)
 
     def execute(self):
+        if self.buddy:
+            receiver = self.bl.getFileReceiver(self.buddy.address,
+                    self.id)
+            if receiver:
+                receiver.setDigest(self.algorithm, self.digest)
+        else:
+            log.warn("received 'filedigest' on unknown connection")
+            log.warn("unknown connection had '%s' in last ping. closing"
+                      % self.connection.last_ping_address)
+            self.connection.close()
 
-        # set the status flag of the corresponding buddy
 
-        if self.buddy:
-            log.critical('received status %s from %s' % (self.text,
-                         self.buddy.address))
+class ProtocolMsg_delta_signatures(ProtocolMsg):
 
-            # send offline messages if buddy was previously offline
+    command = 'delta_signatures'
 
-            if self.buddy.status == STATUS_HANDSHAKE:
-                log.warn('%s came online, sending delayed messages'
+    # the answer to filename from a client with the delta capability
+    # which has an old version of the file: the block size followed by
+    # the signatures of all its complete blocks (12 bytes each, 4 bytes
+    # adler32 and the first 8 bytes of the md5, see getDeltaSignature())
+
+    def parse(self):
+        (self.id, block_size, self.signatures) = self.text.split(' ', 2)
+        self.block_size = int(block_size)
+
+    def execute(self):
+        if self.buddy:
+            sender = self.bl.getFileSender(self.buddy.address, self.id)
+            if not sender:
+                return
+            if self.block_size < DELTA_BLOCK_MIN \
+                or len(self.signatures) % 12 \
+                or len(self.signatures) > DELTA_MAX_SIGNATURES * 12:
+                log.warn('invalid delta_signatures from %s'
                          % self.buddy.address)
-                self.buddy.sendOfflineMessages()
+                sender.setDeltaSignatures(0, None)
+            else:
+                sender.setDeltaSignatures(self.block_size,
+                        self.signatures)
+        else:
+            log.warn("received 'delta_signatures' on unknown connection")
+            log.warn("unknown connection had '%s' in last ping. closing"
+                      % self.connection.last_ping_address)
+            self.connection.close()
 
-            # set buddy status
 
-            if self.text == 'available':
-                self.buddy.setStatus(STATUS_ONLINE)
-            if self.text == 'away':
-                self.buddy.setStatus(STATUS_AWAY)
-            if self.text == 'xa':
-                self.buddy.setStatus(STATUS_XA)
+class ProtocolMsg_delta_none(ProtocolMsg):
 
+    command = 'delta_none'
 
-class ProtocolMsg_add_me(ProtocolMsg):
+    # the answer to filename from a client with the delta capability
+    # which has no old version of the file, everything must be sent
 
-    command = 'add_me'
+    def parse(self):
+        self.id = self.text
 
     def execute(self):
         if self.buddy:
-            log.warn('add me from %s' % self.buddy.address)
-            if not self.buddy in self.bl.list:
-                log.warn('received add_me from new buddy %s'
-                         % self.buddy.address)
-                self.buddy.addToList()
-                msg = '<- has added you'
-                self.bl.onChatMessage(self.buddy, msg)
+            sender = self.bl.getFileSender(self.buddy.address, self.id)
+            if sender:
+                sender.setDeltaSignatures(0, None)
+        else:
+            log.warn("received 'delta_none' on unknown connection")
+            log.warn("unknown connection had '%s' in last ping. closing"
+                      % self.connection.last_ping_address)
+            self.connection.close()
 
 
-class ProtocolMsg_remove_me(ProtocolMsg):
+class ProtocolMsg_file_resume(ProtocolMsg):
 
-    command = 'remove_me'
+    command = 'file_resume'
+
+    # the receiver of a transfer that is announced again with filename
+    # (after a restart of one of the two clients) already has all data
+    # before start and tells the sender to continue there.
+
+    def parse(self):
+        (self.id, start) = self.text.split(' ')
+        self.start = int(start)
 
     def execute(self):
         if self.buddy:
-            log.warn('received remove_me from buddy %s'
-                     % self.buddy.address)
-            if self.buddy in self.bl.list:
-                log.warn('removing %s from list' % self.buddy.address)
-                self.bl.removeBuddy(self.buddy)
+            sender = self.bl.getFileSender(self.buddy.address, self.id)
+            if sender:
+                sender.restart(self.start, False)
         else:
-            log.warn("received 'remove_me' on unknown connection")
+            log.warn("received 'file_resume' on unknown connection")
             log.warn("unknown connection had '%s' in last ping. closing"
                       % self.connection.last_ping_address)
             self.connection.close()
 
 
-class ProtocolMsg_message(ProtocolMsg):
+class ProtocolMsg_file_stop_sending(ProtocolMsg):
 
-    command = 'message'
+    command = 'file_stop_sending'
 
-    # this is a normal text chat message.
+    # if the file transfer is prematurely canceled by the receiver
+    # then this message tells the sender to stop sending further data
 
     def parse(self):
-        self.text = self.text.decode('UTF-8')
+        self.id = self.text
 
     def execute(self):
+        if self.buddy:
+            sender = self.bl.getFileSender(self.buddy.address, self.id)
+            if sender:
 
-        # give buddy and text to bl. bl will then call into the gui
-        # to open a chat window and/or display the text.
+                # close the sender (if not already closed)
+                # otherwise just ignore it
 
-        if self.buddy:
-            if self.buddy in self.bl.list:
-                if self.text.strip() != '':
-                    self.bl.onChatMessage(self.buddy, self.text)
-            else:
-                log.warn('***** wrong version reply to %s'
-                         % self.buddy.address)
-                msg = 'This is an automatic reply. '
-                msg += 'Your version seems to be out of date.'
-                msg += \
-                    'Make sure you have the latest version of TorChat. '
-                self.buddy.sendChatMessage(msg)
-                self.buddy.sendRemoveMe()
+                sender.close()
         else:
-            log.warn("received 'message' on unknown connection")
-            log.warn("unknown connection had '%s' in last ping. closing"
+            log.warn("received 'file_stop_sending' on unknown connection"
+                     )
+            log.warn("(2) unknown connection had '%s' in last ping. closing"
                       % self.connection.last_ping_address)
             self.connection.close()
 
 
-class ProtocolMsg_filename(ProtocolMsg):
+class ProtocolMsg_file_stop_receiving(ProtocolMsg):
 
-    command = 'filename'
+    command = 'file_stop_receiving'
 
-    # the first message in a file transfer, initiating the transfer.
+    # if the file transfer is prematurely canceled by the sender
+    # then this message tells the receiving buddy to close its receiver
 
     def parse(self):
-        (self.id, text) = self.text.split(' ', 1)
-        (file_size, text) = text.split(' ', 1)
-        (block_size, self.file_name) = text.split(' ', 1)
-        self.file_size = int(file_size)
-        self.block_size = int(block_size)
-        self.file_name = self.file_name.decode('utf-8')
-        self.file_name = self.file_name.replace('\\', '')
-        self.file_name = self.file_name.replace('/', '')
+        self.id = self.text
 
     def execute(self):
-        if not self.buddy:
-            log.warn("received 'filename' on unknown connection")
+        if self.buddy:
+            receiver = self.bl.getFileReceiver(self.buddy.address,
+                    self.id)
+            if receiver:
+
+                # close the receiver (if not already closed)
+                # otherwise just ignore it
+
+                receiver.closeForced()
+        else:
+            log.warn("received 'file_stop_receiving' on unknown connection"
+                     )
             log.warn("unknown connection had '%s' in last ping. closing"
                       % self.connection.last_ping_address)
             self.connection.close()
-            return
 
-        # we create a file receiver instance which can deal with the
-        # file data we expect to receive now
 
-        FileReceiver(self.buddy, self.id, self.block_size,
-                     self.file_size, self.file_name)
+# --- ### Low level network stuff
 
 
-class ProtocolMsg_filedata(ProtocolMsg):
+class Poller(object):
 
-    command = 'filedata'
+    # a thin wrapper around select.poll() which scales to thousands of
+    # sockets. On platforms where poll() is not available (Windows) we
+    # fall back to select.select().
 
-    # after a filename message has initiated the transfer several
-    # filedata messagess transport the actual data in blocks of fixed
-    # size. The data blocks are transmitted as they are and only
-    # newline characters are escaped. (see escape() and unescape())
+    def __init__(self):
+        self.fds = {}  # fd -> (read, write)
+        if hasattr(select, 'poll'):
+            self.poll_obj = select.poll()
+        else:
+            self.poll_obj = None
 
-    def parse(self):
-        (self.id, text) = self.text.split(' ', 1)
-        (start, text) = text.split(' ', 1)
-        (self.hash, self.data) = text.split(' ', 1)
-        self.start = int(start)
+    def getMask(self, read, write):
+        mask = 0
+        if read:
+            mask |= select.POLLIN | select.POLLPRI
+        if write:
+            mask |= select.POLLOUT
+        return mask
 
-    def execute(self):
-        if not self.buddy:
-            log.warn("received 'filedata' on unknown connection")
-            log.warn("unknown connection had '%s' in last ping. closing"
-                      % self.connection.last_ping_address)
-            self.connection.close()
+    def register(
+        self,
+        fd,
+        read,
+        write,
+        ):
+        self.fds[fd] = (read, write)
+        if self.poll_obj:
+            self.poll_obj.register(fd, self.getMask(read, write))
+
+    def modify(
+        self,
+        fd,
+        read,
+        write,
+        ):
+        if not fd in self.fds or self.fds[fd] == (read, write):
             return
+        self.fds[fd] = (read, write)
+        if self.poll_obj:
+            self.poll_obj.modify(fd, self.getMask(read, write))
+
+    def unregister(self, fd):
+        if fd in self.fds:
+            del self.fds[fd]
+            if self.poll_obj:
+                self.poll_obj.unregister(fd)
+
+    def poll(self, timeout=None):
+
+        # returns a list of (fd, readable, writable, error) tuples
+
+        events = []
+        if self.poll_obj:
+            if timeout != None:
+                timeout = int(timeout * 1000)
+            for (fd, event) in self.poll_obj.poll(timeout):
+                events.append((fd, event & (select.POLLIN
+                              | select.POLLPRI) != 0, event
+                              & select.POLLOUT != 0, event
+                              & (select.POLLERR | select.POLLHUP
+                              | select.POLLNVAL) != 0))
+        else:
+            r = [fd for (fd, (read, write)) in self.fds.items() if read]
+            w = [fd for (fd, (read, write)) in self.fds.items()
+                 if write]
+            (r, w, x) = select.select(r, w, r, timeout)
+            for fd in self.fds.keys():
+                if fd in r or fd in w or fd in x:
+                    events.append((fd, fd in r, fd in w, fd in x))
+        return events
+
+
+class NetworkLoop(threading.Thread):
+
+    # this one thread is doing all the socket I/O of the client. The
+    # Listener and all connections register their sockets here and get
+    # called back from this thread whenever their socket is ready.
+    # Protocol messages are also executed in this thread.
+    # Other threads (file senders, timers, the GUI) must never touch
+    # the sockets directly, they use callInLoop() which will wake up
+    # the loop and let it do the work.
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.poller = Poller()
+        self.handlers = {}  # fd -> Listener or Connection
+        self.calls = []
+        self.calls_lock = threading.Lock()
+        (self.wakeup_in, self.wakeup_out) = socketPair()
+        self.wakeup_in.setblocking(0)
+        self.wakeup_out.setblocking(0)
+        self.wakeup_fd = self.wakeup_in.fileno()
+        self.poller.register(self.wakeup_fd, True, False)
+        self.running = True
+        self.start()
 
-        # there should already be a receiver, because there should have been
-        # a "filename"-message at the very beginning of the transfer.
+    def isLoopThread(self):
+        return threading.currentThread() is self
 
-        receiver = self.bl.getFileReceiver(self.buddy.address, self.id)
-        if receiver:
-            receiver.data(self.start, self.hash, self.data)
+    def callInLoop(self, func, *args):
+
+        # run func(*args) in the context of the network thread.
+        # if we already are in the network thread it runs immediately.
+
+        if self.isLoopThread():
+            func(*args)
         else:
+            self.calls_lock.acquire()
+            self.calls.append((func, args))
+            self.calls_lock.release()
+            self.wakeup()
 
-            # if there is no receiver for this data, we just reply
-            # with a stop message and hope the sender gets it and
-            # stops sending data. Not much else to do for us here.
+    def wakeup(self):
+        try:
+            self.wakeup_out.send('x')
+        except socket.error:
+
+            # the pipe is full, so there is already a wakeup pending
+
+            pass
+
+    def register(self, handler):
+
+        # must be called in the network thread
+
+        handler.fd = handler.socket.fileno()
+        self.handlers[handler.fd] = handler
+        self.poller.register(handler.fd, True, handler.writable())
+
+    def unregister(self, handler):
+
+        # must be called in the network thread
+
+        if self.handlers.get(handler.fd) is handler:
+            del self.handlers[handler.fd]
+            self.poller.unregister(handler.fd)
+
+    def updateInterest(self, handler):
+
+        # tell the poller whether we want to write to this socket
+
+        if self.handlers.get(handler.fd) is handler:
+            self.poller.modify(handler.fd, True, handler.writable())
+
+    def wantWrite(self, handler):
+
+        # can be called from any thread when new data has been queued
+
+        self.callInLoop(self.updateInterest, handler)
+
+    def runCalls(self):
+        self.calls_lock.acquire()
+        calls = self.calls
+        self.calls = []
+        self.calls_lock.release()
+        for (func, args) in calls:
+            try:
+                func(*args)
+            except:
+                config.tb()
+
+    def handleError(self, handler):
+
+        # an exception in handleError() (it goes on into disconnect()
+        # and the GUI callback) must not end this thread, then nothing
+        # would be sent or received anymore. At least the socket is
+        # taken out of the loop and closed.
+
+        try:
+            handler.handleError()
+        except:
+            config.tb()
+            try:
+                self.unregister(handler)
+                handler.socket.close()
+            except:
+                config.tb()
+
+    def run(self):
+        while self.running:
+            self.runCalls()
+            try:
+                events = self.poller.poll()
+            except (select.error, socket.error):
+                if sys.exc_info()[1][0] != errno.EINTR:
+                    config.tb()
+                continue
+
+            for (fd, readable, writable, error) in events:
+                if fd == self.wakeup_fd:
+                    try:
+                        while self.wakeup_in.recv(4096):
+                            pass
+                    except socket.error:
+                        pass
+                    continue
+
+                handler = self.handlers.get(fd)
+                if not handler:
+                    continue
+                try:
+                    if readable or error:
+                        handler.handleRead()
+                    if writable and self.handlers.get(fd) is handler:
+                        handler.handleWrite()
+                    self.updateInterest(handler)
+                except:
+                    config.tb()
+                    self.handleError(handler)
+
+        # execute the close() calls that have been queued by stopClient()
+
+        self.runCalls()
+
+    def close(self):
+        self.running = False
+        self.wakeup()
+
+
+class Receiver(object):
+
+    # the receiving side of a connection. The network loop hands us
+    # every chunk of data it has read from the socket, we cut it into
+    # messages and execute them. The data is either in lines (the
+    # normal TorChat protocol) or, after the other side has sent a
+    # binary_framing message, in length prefixed binary frames.
+    #
+    # The data is collected in a bytearray and we only search the
+    # newly arrived bytes for the end of a line, so a long line that
+    # trickles in slowly is not scanned and copied again on every
+    # recv(). Complete messages are handed on as buffer objects
+    # (read-only views into the bytearray, Python 2 has no usable
+    # memoryview here) and the consumed part of the bytearray is only
+    # removed once per recv().
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.readbuffer = bytearray()
+        self.start = 0  # begin of the first unprocessed message
+        self.scan_pos = 0  # where the search for the next '\n' continues
+        self.max_size = config.getint('internal', 'max_line_length')
+        self.binary = False
+        self.running = True
+
+    def setBinary(self):
+        self.binary = True
+
+    def onData(self, recv):
+        self.readbuffer.extend(recv)
+
+        # one message at a time, because every message
+        # can switch the framing mode for the following ones
+
+        while self.running:
+            try:
+                if self.binary:
+                    message = self.nextFrame()
+                else:
+                    message = self.nextLine()
+                if not message:
+                    break
+                message.execute()
+            except:
+                config.tb()
+
+        # throw away what has been processed. The buffer objects
+        # handed out above must not be used after this point.
+
+        if self.start:
+            del self.readbuffer[:self.start]
+            self.scan_pos -= self.start
+            self.start = 0
+
+        if self.running and len(self.readbuffer) > self.max_size:
+            log.warn('incoming message exceeds %i bytes, closing %s'
+                     % (self.max_size, self.conn))
+            self.running = False
+            self.conn.onReceiverError()
+
+    def nextLine(self):
+        pos = self.readbuffer.find('\n', self.scan_pos)
+        if pos == -1:
+            self.scan_pos = len(self.readbuffer)
+            return None
+        line = buffer(self.readbuffer, self.start, pos - self.start)
+        self.start = pos + 1
+        self.scan_pos = self.start
+        return ProtocolMsgFromLine(self.conn.bl, self.conn, line)
+
+    def nextFrame(self):
+        available = len(self.readbuffer) - self.start
+        if available < FRAME_HEADER_SIZE:
+            return None
+        (command_len, data_len) = struct.unpack_from('>BI',
+                self.readbuffer, self.start)
+        size = FRAME_HEADER_SIZE + command_len + data_len
+        if size > self.max_size:
+            log.warn('incoming frame of %i bytes exceeds %i bytes'
+                     % (size, self.max_size))
+            self.running = False
+            self.conn.onReceiverError()
+            return None
+        if available < size:
+            return None
+        pos = self.start + FRAME_HEADER_SIZE
+        command = str(buffer(self.readbuffer, pos, command_len))
+        data = buffer(self.readbuffer, pos + command_len, data_len)
+        self.start += size
+        self.scan_pos = self.start
+        return ProtocolMsgFromData(self.conn.bl, self.conn, command,
+                                   data)
 
-            msg = ProtocolMsg(self.bl, None, 'file_stop_sending',
-                              self.id)
-            msg.send(self.buddy)
+    def close(self):
+        self.running = False
 
 
-class ProtocolMsg_filedata_ok(ProtocolMsg):
+class SendQueue(object):
+
+    # the outgoing data of a connection. put() can be called from any
+    # thread and never blocks, the network loop takes everything that
+    # has been queued in one batch when the socket is writable.
+    # Threads that produce a lot of data (file senders) must call
+    # waitSpace() before putting more data into the queue, this keeps
+    # the amount of buffered data per connection bounded.
+    # Every item in the queue is a complete message (a list of strings
+    # and buffers). Bulk messages (file data) are only taken when no
+    # other message is waiting, but a message that has been started is
+    # always finished before the next one. A barrier message is sent
+    # after everything queued before it, bulk messages included.
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.queue = collections.deque()
+        self.bulk_queue = collections.deque()
+        self.current = collections.deque()  # rest of the started message
+        self.size = 0
+        self.closed = False
+        self.cond = threading.Condition()
 
-    command = 'filedata_ok'
+    def put(
+        self,
+        parts,
+        bulk=False,
+        barrier=False,
+        ):
 
-    # every received "filedata" must be confirmed with a "filedata_ok"
-    # (or a "filedata_error")
+        # returns True if the queue was empty before
 
-    def parse(self):
-        (self.id, start) = self.text.split(' ', 1)
-        self.start = int(start)
+        self.cond.acquire()
+        was_empty = self.size == 0
+        if barrier:
+            self.queue.extend(self.bulk_queue)
+            self.bulk_queue.clear()
+        if bulk:
+            self.bulk_queue.append(parts)
+        else:
+            self.queue.append(parts)
+        for part in parts:
+            self.size += len(part)
+        self.cond.release()
+        return was_empty
+
+    def take(self, max_batch):
+
+        # remove up to max_batch bytes from the queue and return them
+        # joined into one string (or '' if the queue is empty).
+        # Buffers (file data, see FileSender) are never joined with
+        # anything, they are returned alone and sent without a copy.
+
+        self.cond.acquire()
+        items = []
+        size = 0
+        while size < max_batch:
+            if not self.current:
+                if self.queue:
+                    self.current.extend(self.queue.popleft())
+                elif self.bulk_queue:
+                    self.current.extend(self.bulk_queue.popleft())
+                else:
+                    break
+            if type(self.current[0]) == buffer:
+                if not items:
+                    items.append(self.current.popleft())
+                    size = len(items[0])
+                break
+            text = self.current.popleft()
+            items.append(text)
+            size += len(text)
+        self.size -= size
+        self.cond.release()
+        if len(items) == 1:
+            return items[0]
+        return ''.join(items)
 
-    def execute(self):
-        if self.buddy:
-            sender = self.bl.getFileSender(self.buddy.address, self.id)
-            if sender:
-                sender.receivedOK(self.start)
-            else:
+    def putBack(self, text):
 
-                # there is no sender (anymore) to handle confirmation messages
-                # so we can send a stop message to tell the other side
-                # to stop receiving
+        # give back the part of a batch that could not be sent
 
-                msg = ProtocolMsg(self.bl, None, 'file_stop_receiving',
-                                  self.id)
-                msg.send(self.buddy)
-        else:
-            log.warn("received 'filedata_ok' on unknown connection")
-            log.warn("unknown connection had '%s' in last ping. closing"
-                      % self.connection.last_ping_address)
-            self.connection.close()
+        self.cond.acquire()
+        self.current.appendleft(text)
+        self.size += len(text)
+        self.cond.release()
 
+    def notifySpace(self):
+        self.cond.acquire()
+        if self.size < self.max_bytes:
+            self.cond.notifyAll()
+        self.cond.release()
 
-class ProtocolMsg_filedata_error(ProtocolMsg):
+    def isEmpty(self):
+        return self.size == 0
 
-    command = 'filedata_error'
+    def waitSpace(self, timeout=None):
 
-    def parse(self):
-        (self.id, start) = self.text.split(' ', 1)
-        self.start = int(start)
+        # block until the queue is below its limit (or closed).
+        # returns False on timeout.
 
-    def execute(self):
-        if self.buddy:
-            sender = self.bl.getFileSender(self.buddy.address, self.id)
-            if sender:
-                sender.restart(self.start)
-            else:
-                msg = ProtocolMsg(self.bl, None, 'file_stop_receiving',
-                                  self.id)
-                msg.send(self.buddy)
-        else:
-            log.warn("received 'filedata_error' on unknown connection")
-            log.warn("unknown connection had '%s' in last ping. closing"
-                      % self.connection.last_ping_address)
-            self.connection.close()
+        self.cond.acquire()
+        try:
+            if self.size >= self.max_bytes and not self.closed:
+                waitCondition(self.cond, timeout)
+            return self.size < self.max_bytes or self.closed
+        finally:
+            self.cond.release()
 
+    def close(self):
+        self.cond.acquire()
+        self.closed = True
+        self.queue.clear()
+        self.bulk_queue.clear()
+        self.current.clear()
+        self.size = 0
+        self.cond.notifyAll()
+        self.cond.release()
 
-class ProtocolMsg_file_stop_sending(ProtocolMsg):
 
-    command = 'file_stop_sending'
+class Connection(object):
 
-    # if the file transfer is prematurely canceled by the receiver
-    # then this message tells the sender to stop sending further data
+    # common base class of InConnection and OutConnection. Connections
+    # are no threads, they are driven by the NetworkLoop which calls
+    # handleRead() and handleWrite() whenever the socket is ready.
+    # send() can be called from any thread.
 
-    def parse(self):
-        self.id = self.text
+    def __init__(self, buddy_list):
+        self.bl = buddy_list
+        self.network = buddy_list.network
+        self.socket = None
+        self.fd = None
+        self.running = True
+        self.send_queue = SendQueue(config.getint('internal',
+                                    'send_queue_max_bytes'))
+        self.send_lock = threading.Lock()
+        self.binary = False
+        self.receiver = Receiver(self)
 
-    def execute(self):
-        if self.buddy:
-            sender = self.bl.getFileSender(self.buddy.address, self.id)
-            if sender:
+    def send(
+        self,
+        parts,
+        bulk=False,
+        barrier=False,
+        ):
 
-                # close the sender (if not already closed)
-                # otherwise just ignore it
+        # parts is a list of strings and buffers that belong together
+        # (for bulk and barrier see SendQueue)
 
-                sender.close()
-        else:
-            log.warn("received 'file_stop_sending' on unknown connection"
-                     )
-            log.warn("(2) unknown connection had '%s' in last ping. closing"
-                      % self.connection.last_ping_address)
-            self.connection.close()
+        if not self.running:
+            return
 
+        # the network loop only needs to be woken up if the queue was
+        # empty, otherwise it is already waiting for the socket to
+        # become writable.
 
-class ProtocolMsg_file_stop_receiving(ProtocolMsg):
+        if self.send_queue.put(parts, bulk, barrier):
+            self.network.wantWrite(self)
 
-    command = 'file_stop_receiving'
+    def sendMsg(self, msg):
 
-    # if the file transfer is prematurely canceled by the sender
-    # then this message tells the receiving buddy to close its receiver
+        # encode the message in the framing mode of this connection.
+        # As soon as we know that the buddy understands binary frames
+        # we announce the switch with a last line, every following
+        # message on this connection will then be a binary frame.
+        # Lines still queued as bulk must go out before the switch,
+        # the other side would take them for frames.
+        # (encoding and queuing must happen under the lock because
+        # several threads can be sending on the same connection)
 
-    def parse(self):
-        self.id = self.text
+        self.send_lock.acquire()
+        try:
+            if not self.binary and self.buddy \
+                and self.buddy.supports('binary_framing'):
+                switch = ProtocolMsg(self.bl, None, 'binary_framing', '')
+                self.send([switch.getLine() + '\n'], barrier=True)
+                self.binary = True
+            bulk = msg.command in BULK_COMMANDS
+            if self.binary:
+                self.send(msg.getFrame(), bulk)
+            else:
+                self.send([msg.getLine() + '\n'], bulk)
+        finally:
+            self.send_lock.release()
 
-    def execute(self):
-        if self.buddy:
-            receiver = self.bl.getFileReceiver(self.buddy.address,
-                    self.id)
-            if receiver:
+    def waitSendSpace(self, timeout=None):
+        return self.send_queue.waitSpace(timeout)
 
-                # close the receiver (if not already closed)
-                # otherwise just ignore it
+    def writable(self):
+        return not self.send_queue.isEmpty()
 
-                receiver.closeForced()
+    def handleRead(self):
+        try:
+            recv = self.socket.recv(RECV_SIZE)
+        except socket.error:
+            if isWouldBlock():
+                return
+            config.tb(2)
+            self.onReceiverError()
+            return
+        if recv != '':
+            self.receiver.onData(recv)
         else:
-            log.warn("received 'file_stop_receiving' on unknown connection"
-                     )
-            log.warn("unknown connection had '%s' in last ping. closing"
-                      % self.connection.last_ping_address)
-            self.connection.close()
+            self.onReceiverError()
 
+    def handleWrite(self):
 
-# --- ### Low level network stuff
-
+        # send everything that is queued (up to SEND_BATCH_SIZE) with
+        # one single call and put back what did not fit into the socket
 
-class Receiver(threading.Thread):
+        batch = self.send_queue.take(SEND_BATCH_SIZE)
+        if not batch:
+            return
+        try:
+            sent = self.socket.send(batch)
+        except socket.error:
+            if isWouldBlock():
+                sent = 0
+            else:
+                raise
+        if sent < len(batch):
+            self.send_queue.putBack(buffer(batch, sent))
+        self.send_queue.notifySpace()
 
-    def __init__(self, conn):
-        threading.Thread.__init__(self)
-        self.conn = conn
-        self.socket = conn.socket
-        self.running = True
-        self.start()
+    def handleError(self):
+        self.onReceiverError()
 
-    def run(self):
-        readbuffer = ''
+    def onReceiverError(self):
+        pass
 
-        # self.socket.settimeout(5)
+    def close(self):
 
-        while self.running:
-            try:
-                recv = self.socket.recv(4096)
-                if recv != '':
-                    readbuffer = readbuffer + recv
-                    temp = readbuffer.split('\n')
-                    readbuffer = temp.pop()
-
-                    for line in temp:
-                        if self.running:
-                            try:
-                                message = \
-                                    ProtocolMsgFromLine(self.conn.bl,
-                                        self.conn, line)
-                                message.execute()
-                            except:
-                                config.tb()
-                else:
-                    self.running = False
-                    self.conn.onReceiverError()
-            except socket.timeout:
+        # returns True if this call actually closed the connection
 
-                pass
-            except socket.error:
+        if not self.running:
+            return False
+        self.running = False
+        self.receiver.close()
+        self.send_queue.close()
+        self.network.callInLoop(self.closeSocket)
+        return True
 
-                config.tb(2)
-                self.running = False
-                self.conn.onReceiverError()
+    def closeSocket(self):
+        if not self.socket:
+            return
+        self.network.unregister(self)
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except:
+            pass
+        try:
+            self.socket.close()
+        except:
+            pass
 
 
-class InConnection:
+class InConnection(Connection):
 
     def __init__(self, socket, buddy_list):
+        Connection.__init__(self, buddy_list)
         self.buddy = None
-        self.bl = buddy_list
         self.socket = socket
-        self.receiver = Receiver(self)
+        self.socket.setblocking(0)
         self.last_ping_address = ''  # used to detect mass pings with fake adresses
-        self.timer = threading.Timer(config.get('internal',
-                'dead_connection_timeout'), self.onTimeout)
-        self.started = True
-        self.timer.start()
+        self.network.callInLoop(self.network.register, self)
+        self.timer = callLater(config.getint('internal',
+                               'dead_connection_timeout'), self.onTimeout)
 
-    def send(self, text):
-        try:
-            self.socket.send(text)
-        except:
-            config.tb()
+    def send(
+        self,
+        parts,
+        bulk=False,
+        barrier=False,
+        ):
+        if not self.running:
             log.warn('in-connection send error.')
-            self.bl.onErrorIn(self)
-            self.close()
+            return
+        Connection.send(self, parts, bulk, barrier)
 
     def onReceiverError(self):
         log.warn('in-connection receive error. %s' % self)
@@ -1602,30 +5842,21 @@ class InConnection:
         self.close()
 
     def close(self):
-        if not self.started:
+        if not Connection.close(self):
             return
-        try:
-            self.socket.shutdown(socket.SHUT_RDWR)
-        except:
-            pass
-        try:
-            self.socket.close()
-        except:
-            pass
-        self.started = False
-        log.warn('n-connection closing (%s, %s)'
+        self.timer.cancel()
+        log.warn('in-connection closing (%s, %s)'
                  % (self.last_ping_address, self))
-        if self in self.bl.listener.conns:
-            self.bl.listener.conns.remove(self)
+        self.bl.listener.conns.discard(self)
 
     def onTimeout(self):
 
         # if after this long time the connection is still unused, close it.
 
         if self.buddy and self.buddy.conn_in == self:
-            self.timer = threading.Timer(config.get('internal',
-                    'dead_connection_timeout'), self.onTimeout)
-            self.timer.start()
+            self.timer = callLater(config.getint('internal',
+                                   'dead_connection_timeout'),
+                                   self.onTimeout)
         else:
             log.warn('closing unused in-connection (%s, %s)'
                      % (self.last_ping_address, self))
@@ -1635,7 +5866,68 @@ class InConnection:
                      % len(self.bl.listener.conns))
 
 
-class OutConnection(threading.Thread):
+class ConnectScheduler(object):
+
+    # for every new out-connection Tor has to look up the hidden
+    # service. Hundreds of them at once (all buddies after the start)
+    # overload it and most of them time out. Only max_pending_connects
+    # connects are in progress at the same time, from the start of the
+    # SOCKS connect until it has succeeded or failed. The others wait
+    # in the order of Buddy.getConnectPriority(), their messages are
+    # queued until then.
+
+    def __init__(self):
+        self.pending = set()
+        self.waiting = []  # heap of (priority, sequence, connection)
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def request(self, connection):
+        if connection.buddy:
+            priority = connection.buddy.getConnectPriority()
+        else:
+            priority = ()
+        self.lock.acquire()
+        heapq.heappush(self.waiting, (priority, self.sequence,
+                       connection))
+        self.sequence += 1
+        admitted = self.admit()
+        self.lock.release()
+        for connection in admitted:
+            connection.startConnect()
+
+    def done(self, connection):
+
+        # the connect has succeeded or failed (or the connection
+        # was closed, maybe before it was even started)
+
+        self.lock.acquire()
+        self.pending.discard(connection)
+        admitted = self.admit()
+        self.lock.release()
+        for connection in admitted:
+            connection.startConnect()
+
+    def admit(self):
+
+        # closed connections are only dropped when it is their turn
+
+        limit = config.getint('client', 'max_pending_connects')
+        admitted = []
+        while self.waiting and (limit <= 0 or len(self.pending)
+                                < limit):
+            connection = heapq.heappop(self.waiting)[2]
+            if connection.running:
+                self.pending.add(connection)
+                admitted.append(connection)
+        return admitted
+
+
+class OutConnection(Connection):
+
+    # the connection is made through the SOCKS4a port of Tor. We do
+    # the SOCKS handshake ourselves (non-blocking) so that connecting
+    # does not need a thread of its own.
 
     def __init__(
         self,
@@ -1643,49 +5935,126 @@ class OutConnection(threading.Thread):
         buddy_list,
         buddy,
         ):
-        threading.Thread.__init__(self)
-        self.bl = buddy_list
+        Connection.__init__(self, buddy_list)
         self.buddy = buddy
         self.address = address
-        self.send_buffer = []
-        self.start()
+        self.state = 'connecting'
+        self.socks_request = ''  # the part not yet sent
+        self.socks_reply = ''
+        self.connect_timer = None
+        self.connect_started = 0
+        self.bl.connects.request(self)
 
-    def run(self):
-        self.running = True
-        try:
-            self.socket = socks.socksocket()
+    def startConnect(self):
 
-            # self.socket.settimeout(60)
+        # called by the ConnectScheduler when it is our turn
 
-            self.socket.setproxy(socks.PROXY_TYPE_SOCKS4,
-                                 config.get(TOR_CONFIG, 'tor_server'),
-                                 config.getint(TOR_CONFIG,
-                                 'tor_server_socks_port'))
-            log.warn("trying to connect '%s'" % self.address)
-            self.socket.connect((str(self.address), TORCHAT_PORT))
-            log.warn('connected to %s' % self.address)
-            self.bl.onConnected(self)
-            self.receiver = Receiver(self)
-            while self.running:
-                if len(self.send_buffer) > 0:
-                    text = self.send_buffer.pop(0)
-                    try:
-                        self.socket.send(text)
-                    except:
-                        log.warn('out-connection send error')
-                        self.bl.onErrorOut(self)
-                        self.close()
+        self.connect_started = time.time()
+        self.connect_timer = callLater(CONNECT_TIMEOUT,
+                self.network.callInLoop, self.onConnectTimeout)
+        self.network.callInLoop(self.connectProxy)
+
+    def onConnectTimeout(self):
+        if self.state != 'connected':
+            self.onConnectError('timeout')
 
-                time.sleep(0.05)
+    def connectProxy(self):
+        if not self.running:
+            return
+        try:
+            self.socket = socket.socket(socket.AF_INET,
+                    socket.SOCK_STREAM)
+            self.socket.setblocking(0)
+            log.warn("trying to connect '%s'" % self.address)
+            err = self.socket.connect_ex((config.get(TOR_CONFIG,
+                    'tor_server'), config.getint(TOR_CONFIG,
+                    'tor_server_socks_port')))
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK,
+                           errno.EALREADY):
+                raise socket.error(err, os.strerror(err))
+            self.network.register(self)
         except:
+            self.onConnectError(sys.exc_info()[1])
 
-            log.warn('out-connection to %s failed: %s' % (self.address,
-                     sys.exc_info()[1]))
-            self.bl.onErrorOut(self)
-            self.close()
+    def writable(self):
+        if self.state in ('connecting', 'socks_request'):
+            return True
+        if self.state == 'socks':
+            return False
+        return Connection.writable(self)
+
+    def handleWrite(self):
+        if self.state == 'connecting':
+
+            # the TCP connection to Tor is established (or has failed),
+            # now we send the SOCKS4a connect request
+
+            err = self.socket.getsockopt(socket.SOL_SOCKET,
+                    socket.SO_ERROR)
+            if err != 0:
+                self.onConnectError(os.strerror(err))
+                return
+            self.socks_request = '\x04\x01' + struct.pack('>H',
+                    PHANTOM_PORT) + '\x00\x00\x00\x01' + '\x00' \
+                + str(self.address) + '\x00'
+            self.state = 'socks_request'
+        if self.state == 'socks_request':
+
+            # the socket is non-blocking, it might not take
+            # the whole request at once
+
+            try:
+                sent = self.socket.send(self.socks_request)
+            except socket.error:
+                if isWouldBlock():
+                    return
+                self.onConnectError(sys.exc_info()[1])
+                return
+            self.socks_request = self.socks_request[sent:]
+            if self.socks_request == '':
+                self.state = 'socks'
+        else:
+            Connection.handleWrite(self)
+
+    def handleRead(self):
+        if self.state in ('socks_request', 'socks'):
+            try:
+                recv = self.socket.recv(8 - len(self.socks_reply))
+            except socket.error:
+                if isWouldBlock():
+                    return
+                self.onConnectError(sys.exc_info()[1])
+                return
+            if recv == '':
+                self.onConnectError('connection closed by proxy')
+                return
+            self.socks_reply += recv
+            if len(self.socks_reply) == 8:
+                if self.socks_reply[1] != '\x5a':
+                    self.onConnectError('SOCKS error %i'
+                            % ord(self.socks_reply[1]))
+                    return
+                log.warn('connected to %s' % self.address)
+                self.state = 'connected'
+                self.connect_timer.cancel()
+                self.bl.connects.done(self)
+                self.bl.onConnected(self)
+        else:
+            Connection.handleRead(self)
+
+    def handleError(self):
+        if self.state == 'connected':
+            self.onReceiverError()
+        else:
+            self.onConnectError(sys.exc_info()[1])
 
-    def send(self, text):
-        self.send_buffer.append(text)
+    def onConnectError(self, reason):
+        if not self.running:
+            return
+        log.warn('out-connection to %s failed: %s' % (self.address,
+                 reason))
+        self.bl.onErrorOut(self)
+        self.close()
 
     def onReceiverError(self):
         log.warn('out-connection receiver error')
@@ -1693,59 +6062,101 @@ class OutConnection(threading.Thread):
         self.close()
 
     def close(self):
-        if not self.running:
+        if not Connection.close(self):
             return
-        self.running = False
-        try:
-            self.socket.shutdown(socket.SHUT_RDWR)
-        except:
-            pass
-        try:
-            self.socket.close()
-        except:
-            pass
+        if self.connect_timer:
+            self.connect_timer.cancel()
+        self.bl.connects.done(self)
         if self.buddy:
             log.warn('out-connection closing (%s)' % self.buddy.address)
         else:
             log.warn('out-connection closing (without buddy)')
 
 
-class Listener(threading.Thread):
+class Listener(object):
 
     def __init__(self, buddy_list, socket=None):
-        threading.Thread.__init__(self)
         self.buddy_list = buddy_list
-        self.conns = []
+        self.network = buddy_list.network
+        self.conns = set()
         self.socket = socket
-        self.start()
-
-    def run(self):
+        self.fd = None
         self.running = True
+        self.network.callInLoop(self.startListening)
+
+    def startListening(self):
         if not self.socket:
             interface = config.get('client', 'listen_interface')
             port = config.getint('client', 'listen_port')
             self.socket = tryBindPort(interface, port)
+        if not self.socket:
+            log.warn('socket listener error!')
+            self.running = False
+            return
         self.socket.listen(5)
-        while self.running:
-            try:
-                (conn, address) = self.socket.accept()
-                self.conns.append(InConnection(conn, self.buddy_list))
-                log.warn('new incoming connection')
-                log.warn('have now %i incoming connections'
-                         % len(self.conns))
-            except:
-                log.warn('socket listener error!')
-                config.tb()
-                self.running = False
+        self.socket.setblocking(0)
+        self.network.register(self)
+
+    def writable(self):
+        return False
+
+    def handleRead(self):
+        try:
+            (conn, address) = self.socket.accept()
+        except socket.error:
+            if isWouldBlock():
+                return
+            raise
+        self.conns.add(InConnection(conn, self.buddy_list))
+        log.warn('new incoming connection')
+        log.warn('have now %i incoming connections' % len(self.conns))
+
+    def handleWrite(self):
+        pass
+
+    def handleError(self):
+        log.warn('socket listener error!')
+        self.close()
 
     def close(self):
         self.running = False
+        self.network.callInLoop(self.closeSocket)
+
+    def closeSocket(self):
+        if self.fd != None:
+            self.network.unregister(self)
         try:
             self.socket.close()
         except:
             pass
 
 
+def isWouldBlock():
+
+    # True if the socket.error currently being handled only means
+    # that a non-blocking socket is not ready yet.
+
+    return sys.exc_info()[1][0] in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+def socketPair():
+
+    # socket.socketpair() does not exist on Windows. There we connect
+    # two TCP sockets over the loopback interface instead.
+
+    try:
+        return socket.socketpair()
+    except AttributeError:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.connect(listener.getsockname())
+        (server, address) = listener.accept()
+        listener.close()
+        return (server, client)
+
+
 def tryBindPort(interface, port):
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -1882,14 +6293,18 @@ def stopPortableTor():
 
 def startPortableTorTimer():
     global tor_timer
-    tor_timer = threading.Timer(10, onPortableTorTimer)
-    tor_timer.start()
+    tor_timer = callLater(10, onPortableTorTimer)
 
 
 def onPortableTorTimer():
+
+    # called in the timer thread. Starting Tor waits up to 20 seconds
+    # for the hostname file, this is done in the worker thread (which
+    # starts the timer again when Tor is running).
+
     if tor_proc.poll() != None:
         log.info('Tor stopped running. Will restart it now')
-        startPortableTor()
+        callInWorker(startPortableTor)
     else:
         startPortableTorTimer()
 
@@ -26,6 +26,9 @@ import os
 import time
 import subprocess
 import textwrap
+import collections
+import bisect
+import re
 import threading
 import version
 import dlg_settings
@@ -42,6 +45,11 @@ ICON_NAMES = {
 
 _icon_images = {}  # this is a cache for getStatusBitmap()
 
+TRANSCRIPT_MAX = 1000  # messages kept in a chat window (the rest is history)
+TRANSCRIPT_MARGIN = 3  # pixels around the text of a message
+
+URL_PATTERN = re.compile(r'(?:https?|ftp)://[^\s<>"]+')
+
 
 def getStatusBitmap(status):
     global _icon_images
@@ -333,11 +341,11 @@ class PopupMenu(wx.Menu):
         title = lang.DFT_FILE_OPEN_TITLE \
             % buddy.getAddressAndDisplayName()
         dialog = wx.FileDialog(self.mw, title, style=wx.OPEN
-                               | wx.FD_PREVIEW)
+                               | wx.FD_PREVIEW | wx.FD_MULTIPLE)
         if dialog.ShowModal() == wx.ID_OK:
-            file_name = dialog.GetPath()
+            file_names = dialog.GetPaths()
             transfer_window = FileTransferWindow(self.mw, buddy,
-                    file_name)
+                    getTransferName(file_names))
 
     def onEdit(self, evt):
         buddy = self.mw.gui_bl.getSelectedBuddy()
@@ -371,10 +379,7 @@ class PopupMenu(wx.Menu):
 
     def onClearOffline(self, evt):
         buddy = self.mw.gui_bl.getSelectedBuddy()
-        try:
-            os.unlink(buddy.getOfflineFileName())
-        except:
-            pass
+        buddy.clearOfflineMessages()
 
     def onAdd(self, evt):
         dialog = DlgEditContact(self.mw, self.mw)
@@ -517,18 +522,11 @@ class DlgEditContact(wx.Dialog):
                 buddy.storeOfflineChatMessage(self.txt_intro.GetValue())
         else:
             address_old = self.buddy.address
-            offline_file_name_old = self.buddy.getOfflineFileName()
-            self.buddy.address = address
-            offline_file_name_new = self.buddy.getOfflineFileName()
             self.buddy.name = self.txt_name.GetValue()
+            self.bl.setBuddyAddress(self.buddy, address)
             self.bl.save()
             if address != address_old:
                 self.buddy.disconnect()
-                try:
-                    os.rename(offline_file_name_old,
-                              offline_file_name_new)
-                except:
-                    pass
 
         self.Close()
 
@@ -538,9 +536,13 @@ class DlgEditContact(wx.Dialog):
 
 class BuddyList(wx.ListCtrl):
 
+    # a virtual list, it only asks for the rows it shows. It follows
+    # the CB_TYPE_BUDDY_* events of tc_client (see onBuddyEvent()),
+    # the buddies are never compared as a whole.
+
     def __init__(self, parent, main_window):
         wx.ListCtrl.__init__(self, parent, -1, style=wx.LC_REPORT
-                             | wx.LC_NO_HEADER)
+                             | wx.LC_NO_HEADER | wx.LC_VIRTUAL)
         self.mw = main_window
         self.bl = self.mw.buddy_list
 
@@ -563,98 +565,119 @@ class BuddyList(wx.ListCtrl):
 
         self.SetImageList(self.il, wx.IMAGE_LIST_SMALL)
         self.blink_phase = False
+        self.blinking = set()  # addresses with unread messages
+
+        # the rows in the order the buddies were added
+        # and the index of each address in it
+
+        self.rows = []
+        self.row_by_address = {}
+        for buddy in self.bl.list:
+            self.addRow(buddy)
+        self.SetItemCount(len(self.rows))
 
         self.timer = wx.Timer(self, -1)
         self.Bind(wx.EVT_TIMER, self.onTimer, self.timer)
-        self.old_sum = ''
         self.timer.Start(milliseconds=500, oneShot=False)
 
+        self.Bind(wx.EVT_SIZE, self.onSize)
         self.Bind(wx.EVT_LEFT_DCLICK, self.onDClick)
         self.Bind(wx.EVT_LIST_ITEM_RIGHT_CLICK, self.onRClick)
         self.Bind(wx.EVT_RIGHT_DOWN, self.onRDown)
 
-    def blinkBuddy(self, buddy, blink=True):
-        name = buddy.getDisplayName()
-        for index in xrange(0, self.GetItemCount()):
-            if name == self.GetItemText(index):
-                if blink:
-                    if self.blink_phase:
-                        self.SetItemImage(index, self.il_idx[100])
-                    else:
-                        self.SetItemImage(index,
-                                self.il_idx[buddy.status])
-                else:
-                    self.SetItemImage(index, self.il_idx[buddy.status])
+    def addRow(self, buddy):
+        self.row_by_address[buddy.address] = len(self.rows)
+        self.rows.append(buddy)
+
+    def indexRows(self):
+        self.row_by_address = {}
+        for (index, buddy) in enumerate(self.rows):
+            self.row_by_address[buddy.address] = index
+
+    def getRow(self, buddy):
+
+        # index of the row of buddy, or -1
+
+        index = self.row_by_address.get(buddy.address, -1)
+        if index != -1 and self.rows[index] is buddy:
+            return index
+
+        # the address has been changed, this is rare enough
+        # to simply build the index again
+
+        self.indexRows()
+        for (index, row_buddy) in enumerate(self.rows):
+            if row_buddy is buddy:
+                return index
+        return -1
+
+    def onBuddyEvent(self, callback_type, buddy):
+
+        # always called in the GUI thread (see MainWindow.callbackMessage)
+
+        if callback_type == tc_client.CB_TYPE_BUDDY_ADDED:
+            if self.getRow(buddy) == -1 and self.bl.isListed(buddy):
+                self.addRow(buddy)
+                self.SetItemCount(len(self.rows))
+        if callback_type == tc_client.CB_TYPE_BUDDY_REMOVED:
+            index = self.getRow(buddy)
+            if index != -1:
+                selected = self.getSelectedBuddy()
+                del self.rows[index]
+                self.indexRows()
+                self.SetItemCount(len(self.rows))
+                self.selectBuddy(selected)
+                if index < len(self.rows):
+                    self.RefreshItems(index, len(self.rows) - 1)
+        if callback_type == tc_client.CB_TYPE_BUDDY_CHANGED:
+            index = self.getRow(buddy)
+            if index != -1:
+                self.RefreshItem(index)
+
+    def OnGetItemText(self, item, column):
+        return self.rows[item].getDisplayName()
+
+    def OnGetItemImage(self, item):
+        buddy = self.rows[item]
+        if self.blink_phase and buddy.address in self.blinking:
+            return self.il_idx[100]
+        return self.il_idx[buddy.status]
 
     def onTimer(self, evt):
 
-        # first check if there have been any changes to the buddy list
-
-        sum = ''
-        for buddy in self.bl.list:
-            sum += buddy.address + buddy.name + str(buddy.status)
-        if sum != self.old_sum:
-
-            # FIXME: This whole method is more than ugly
-            # remove items which are not in list anymore
-
-            for index in xrange(0, self.GetItemCount()):
-                found = False
-                for buddy in self.bl.list:
-                    if buddy.getDisplayName() \
-                        == self.GetItemText(index):
-                        found = True
-                        break
-                if not found:
-                    self.DeleteItem(index)
-                    break
-
-            # add new items to the list or change status icons
-
-            for buddy in self.bl.list:
-                line = buddy.getDisplayName()
-                index = self.FindItem(0, line)
-                if index == -1:
-                    index = self.InsertImageStringItem(sys.maxint,
-                            line, self.il_idx[tc_client.STATUS_OFFLINE])
-                    self.SetColumnWidth(0, wx.LIST_AUTOSIZE)
-                self.SetItemImage(index, self.il_idx[buddy.status])
-
-            self.old_sum = sum
-
-        # always: show unread messages
+        # show unread messages: buddies with hidden chat windows blink
 
         self.blink_phase = not self.blink_phase
-        for buddy in self.bl.list:
-            found = False
-            for window in self.mw.chat_windows:
-                if not window.IsShown() and window.buddy == buddy:
-                    found = True
-                    break
-            if found:
-                self.blinkBuddy(buddy, True)
-            else:
-                self.blinkBuddy(buddy, False)
+        blinking = set()
+        for window in self.mw.chat_windows:
+            if not window.IsShown():
+                blinking.add(window.buddy.address)
+        for address in blinking | self.blinking:
+            index = self.row_by_address.get(address, -1)
+            if index != -1:
+                self.RefreshItem(index)
+        self.blinking = blinking
+
+    def onSize(self, evt):
+        self.SetColumnWidth(0, self.GetClientSize()[0])
+        evt.Skip()
 
     def onDClick(self, evt):
-        i = self.GetFirstSelected()
-        address = self.GetItemText(i)[0:16]
-        for buddy in self.bl.list:
-            if buddy.address == address:
-                found_window = False
-                for window in self.mw.chat_windows:
-                    if window.buddy == buddy:
-                        found_window = True
-                        break
+        buddy = self.getSelectedBuddy()
+        if buddy:
+            found_window = False
+            for window in self.mw.chat_windows:
+                if window.buddy == buddy:
+                    found_window = True
+                    break
 
-                if not found_window:
-                    window = ChatWindow(self.mw, buddy)
+            if not found_window:
+                window = ChatWindow(self.mw, buddy)
 
-                if not window.IsShown():
-                    window.Show()
+            if not window.IsShown():
+                window.Show()
 
-                window.txt_out.SetFocus()
-                break
+            window.txt_out.SetFocus()
 
         evt.Skip()
 
@@ -672,8 +695,23 @@ class BuddyList(wx.ListCtrl):
 
     def getSelectedBuddy(self):
         index = self.GetFirstSelected()
-        addr = self.GetItemText(index)[0:16]
-        return self.bl.getBuddyFromAddress(addr)
+        if index < 0 or index >= len(self.rows):
+            return None
+        return self.rows[index]
+
+    def selectBuddy(self, buddy):
+
+        # a virtual list selects rows, not buddies. After rows
+        # have moved the selection must be moved with them.
+
+        index = self.GetFirstSelected()
+        while index != -1:
+            self.Select(index, False)
+            index = self.GetNextSelected(index)
+        if buddy:
+            index = self.getRow(buddy)
+            if index != -1:
+                self.Select(index)
 
 
 class StatusSwitchList(wx.Menu):
@@ -734,6 +772,169 @@ class StatusSwitch(wx.Button):
         self.SetLabel(status_text)
 
 
+class TranscriptList(wx.VListBox):
+
+    # the messages of a chat window. Only the last TRANSCRIPT_MAX are
+    # kept (in a ring buffer), and only the ones that are visible are
+    # measured and drawn. Messages added in a burst are shown with one
+    # repaint (see add()). Each message is one item:
+    # [stamp, color, name, text, wrap width, wrapped lines]
+
+    def __init__(self, parent):
+        wx.VListBox.__init__(self, parent, -1, style=wx.LB_MULTIPLE
+                             | wx.BORDER_SUNKEN)
+        self.SetBackgroundColour(wx.WHITE)
+        self.messages = collections.deque(maxlen=TRANSCRIPT_MAX)
+        self.added = 0  # messages since the last update()
+        self.update_pending = False
+        self.Bind(wx.EVT_SIZE, self.onSize)
+
+    def add(
+        self,
+        color,
+        name,
+        text,
+        when,
+        ):
+
+        # the list itself is only updated when the GUI thread is idle
+        # again, a bot sending 100 messages causes only one repaint
+
+        stamp = time.strftime(config.get('gui', 'time_stamp_format'),
+                              time.localtime(when))
+        self.messages.append([stamp, color, name, text, None, None])
+        self.added += 1
+        if not self.update_pending:
+            self.update_pending = True
+            wx.CallAfter(self.update)
+
+    def update(self):
+        self.update_pending = False
+        count = self.GetItemCount()
+        at_end = count == 0 or self.GetVisibleEnd() >= count
+        first = self.GetVisibleBegin()
+
+        # messages that fell out of the ring buffer
+
+        dropped = count + self.added - len(self.messages)
+        self.added = 0
+        if dropped:
+            self.DeselectAll()
+        self.SetItemCount(len(self.messages))
+        if at_end:
+            self.ScrollToLine(len(self.messages))
+        else:
+            self.ScrollToLine(max(first - dropped, 0))
+        self.RefreshAll()
+
+    def getText(self, n):
+        (stamp, color, name, text, width, lines) = self.messages[n]
+        return '%s %s: %s' % (stamp, name, text)
+
+    def getSelectedText(self):
+        return '\n'.join(self.getText(n) for n in
+                         range(self.GetItemCount()) if self.IsSelected(n))
+
+    def getLines(self, dc, n):
+
+        # the text of message n wrapped to the current width,
+        # cached until the width changes
+
+        message = self.messages[n]
+        width = self.GetClientSize()[0] - 2 * TRANSCRIPT_MARGIN
+        if message[4] != width:
+            (stamp, color, name, text) = message[:4]
+            indent = dc.GetTextExtent('%s %s: ' % (stamp, name))[0]
+            message[4] = width
+            message[5] = wrapText(dc, text, width, indent)
+        return message[5]
+
+    def OnMeasureItem(self, n):
+        dc = wx.ClientDC(self)
+        dc.SetFont(self.GetFont())
+        lines = self.getLines(dc, n)
+        return len(lines) * dc.GetCharHeight() + 2 * TRANSCRIPT_MARGIN
+
+    def OnDrawItem(
+        self,
+        dc,
+        rect,
+        n,
+        ):
+        dc.SetFont(self.GetFont())
+        (stamp, color, name) = self.messages[n][:3]
+        lines = self.getLines(dc, n)
+        if self.IsSelected(n):
+            highlight = \
+                wx.SystemSettings.GetColour(wx.SYS_COLOUR_HIGHLIGHTTEXT)
+            colors = (highlight, highlight, highlight)
+        else:
+            colors = (wx.Color(128, 128, 128), wx.Color(*color),
+                      wx.Color(0, 0, 0))
+        x = rect.x + TRANSCRIPT_MARGIN
+        y = rect.y + TRANSCRIPT_MARGIN
+        for (text, color) in (('%s ' % stamp, colors[0]), ('%s: '
+                              % name, colors[1])):
+            dc.SetTextForeground(color)
+            dc.DrawText(text, x, y)
+            x += dc.GetTextExtent(text)[0]
+        dc.SetTextForeground(colors[2])
+        for line in lines:
+            dc.DrawText(line, x, y)
+            x = rect.x + TRANSCRIPT_MARGIN
+            y += dc.GetCharHeight()
+
+    def onSize(self, evt):
+
+        # the heights depend on the width, they must all be measured
+        # again (only the visible ones will be)
+
+        self.RefreshAll()
+        evt.Skip()
+
+
+def wrapText(
+    dc,
+    text,
+    width,
+    indent,
+    ):
+
+    # text broken into lines that fit into width pixels, at spaces
+    # where possible. The first line starts indent pixels further right.
+
+    lines = []
+    avail = max(width - indent, 1)
+    for paragraph in text.split('\n'):
+        if paragraph == '':
+            lines.append('')
+            avail = max(width, 1)
+            continue
+
+        # extents[i] is the width of paragraph[:i + 1]
+
+        extents = dc.GetPartialTextExtents(paragraph)
+        start = 0
+        while start < len(paragraph):
+            if start:
+                offset = extents[start - 1]
+            else:
+                offset = 0
+            end = bisect.bisect_right(extents, offset + avail, start)
+            if end < len(paragraph):
+                space = paragraph.rfind(' ', start, end)
+                if space > start:
+                    end = space + 1
+                elif end == start:
+                    end = start + 1
+            lines.append(paragraph[start:end].rstrip())
+            start = end
+            while paragraph[start:start + 1] == ' ':
+                start += 1
+            avail = max(width, 1)
+    return lines
+
+
 class ChatWindow(wx.Frame):
 
     def __init__(
@@ -755,10 +956,7 @@ class ChatWindow(wx.Frame):
         self.panel = wx.Panel(self)
         sizer = wx.BoxSizer(wx.VERTICAL)
 
-        self.txt_in = wx.TextCtrl(self.panel, -1, style=wx.TE_READONLY
-                                  | wx.TE_MULTILINE | wx.TE_AUTO_URL
-                                  | wx.TE_AUTO_SCROLL | wx.TE_RICH2
-                                  | wx.BORDER_SUNKEN)
+        self.txt_in = TranscriptList(self.panel)
 
         sizer.Add(self.txt_in, 1, wx.EXPAND | wx.ALL, 0)
 
@@ -773,6 +971,8 @@ class ChatWindow(wx.Frame):
         self.panel.SetSizer(sizer)
         sizer.FitInside(self)
 
+        self.loadHistory(message)
+
         om = self.buddy.getOfflineMessages()
         if om:
             om = '[%s]\n' % lang.NOTICE_DELAYED_MSG_WAITING + om
@@ -791,7 +991,7 @@ class ChatWindow(wx.Frame):
         self.Bind(wx.EVT_TIMER, self.onTimer)
         self.Bind(wx.EVT_CLOSE, self.onClose)
         self.txt_out.Bind(wx.EVT_KEY_DOWN, self.onKey)
-        self.txt_in.Bind(wx.EVT_TEXT_URL, self.onURL)
+        self.txt_in.Bind(wx.EVT_LISTBOX_DCLICK, self.onURL)
 
         self.Bind(wx.EVT_ACTIVATE, self.onActivate)
         self.txt_in.Bind(wx.EVT_CONTEXT_MENU, self.OnContextMenu)
@@ -824,28 +1024,41 @@ class ChatWindow(wx.Frame):
         t = self.GetTitle()
         return t[:-19]
 
+    def getDisplayName(self):
+        if self.buddy.name != '':
+            return self.buddy.name
+        else:
+            return self.buddy.address
+
+    def loadHistory(self, message):
+
+        # the last messages from the chat history. The message that
+        # made us open this window is already in there, but it will
+        # be shown (and notified) by process()
+
+        rows = self.buddy.bl.history.getRecent(self.buddy.address,
+                config.getint('history', 'load_messages'))
+        if rows and message != '':
+            (id, when, direction, text) = rows[-1]
+            if direction == tc_client.HISTORY_IN and text == message:
+                rows.pop()
+        for (id, when, direction, text) in rows:
+            if direction == tc_client.HISTORY_OUT:
+                self.writeColored((96, 96, 192), 'myself', text, when)
+            else:
+                self.writeColored((192, 96, 96), self.getDisplayName(),
+                                  text, when)
+
     def writeColored(
         self,
         color,
         name,
         text,
+        when=None,
         ):
-        self.txt_in.SetDefaultStyle(wx.TextAttr(wx.Color(128, 128,
-                                    128)))
-        self.txt_in.write('%s ' % time.strftime(config.get('gui',
-                          'time_stamp_format')))
-        (red, green, blue) = color
-        self.txt_in.SetDefaultStyle(wx.TextAttr(wx.Color(red, green,
-                                    blue)))
-        self.txt_in.write('%s: ' % name)
-        self.txt_in.SetDefaultStyle(wx.TextAttr(wx.Color(0, 0, 0)))
-        self.txt_in.write('%s\n' % text)
-
-        # workaround scroll bug on windows
-        # https://sourceforge.net/tracker/?func=detail&atid=109863&aid=665381&group_id=9863
-
-        self.txt_in.ScrollLines(-1)
-        self.txt_in.ShowPosition(self.txt_in.GetLastPosition())
+        if when == None:
+            when = time.time()
+        self.txt_in.add(color, name, text, when)
 
     def notify(self, name, message):
 
@@ -883,10 +1096,7 @@ class ChatWindow(wx.Frame):
 
         # message must be unicode
 
-        if self.buddy.name != '':
-            name = self.buddy.name
-        else:
-            name = self.buddy.address
+        name = self.getDisplayName()
         self.writeColored((192, 0, 0), name, message)
         self.notify(name, message)
 
@@ -925,15 +1135,12 @@ class ChatWindow(wx.Frame):
 
     def onURL(self, evt):
 
-        # all URL mouse events trigger this
-
-        if evt.GetMouseEvent().GetEventType() == wx.wxEVT_LEFT_DOWN:
-
-            # left button down, now we need the URL
+        # a double click on a message opens the first URL in it
 
-            start = evt.GetURLStart()
-            end = evt.GetURLEnd()
-            url = self.txt_in.GetRange(start, end)
+        text = self.txt_in.getText(evt.GetSelection())
+        match = URL_PATTERN.search(text)
+        if match:
+            url = match.group(0)
             if config.isWindows():
 
                 # this works very reliable
@@ -956,9 +1163,7 @@ class ChatWindow(wx.Frame):
         item = wx.MenuItem(menu, id, lang.CPOP_COPY)
         self.Bind(wx.EVT_MENU, self.onCopy, id=id)
         menu.AppendItem(item)
-        (sel_from, sel_to) = self.txt_in.GetSelection()
-        empty = sel_from == sel_to
-        if empty:
+        if self.txt_in.GetSelectedCount() == 0:
             item.Enable(False)
 
         id = wx.NewId()
@@ -971,14 +1176,18 @@ class ChatWindow(wx.Frame):
         self.Bind(wx.EVT_MENU, self.onEditBuddy, id=id)
         menu.AppendItem(item)
 
+        id = wx.NewId()
+        item = wx.MenuItem(menu, id, lang.CPOP_SEARCH_HISTORY)
+        self.Bind(wx.EVT_MENU, self.onSearchHistory, id=id)
+        menu.AppendItem(item)
+
         self.PopupMenu(menu)
         menu.Destroy()
 
     def onCopy(self, evt):
-        (sel_from, sel_to) = self.txt_in.GetSelection()
-        if sel_from == sel_to:
+        text = self.txt_in.getSelectedText()
+        if text == '':
             return
-        text = self.txt_in.GetRange(sel_from, sel_to)
         clipdata = wx.TextDataObject()
         clipdata.SetText(text)
         wx.TheClipboard.Open()
@@ -989,16 +1198,103 @@ class ChatWindow(wx.Frame):
         title = lang.DFT_FILE_OPEN_TITLE \
             % self.buddy.getAddressAndDisplayName()
         dialog = wx.FileDialog(self, title, style=wx.OPEN
-                               | wx.FD_PREVIEW)
+                               | wx.FD_PREVIEW | wx.FD_MULTIPLE)
         if dialog.ShowModal() == wx.ID_OK:
-            file_name = dialog.GetPath()
+            file_names = dialog.GetPaths()
             transfer_window = FileTransferWindow(self.mw, self.buddy,
-                    file_name)
+                    getTransferName(file_names))
 
     def onEditBuddy(self, evt):
         dialog = DlgEditContact(self, self.mw, self.buddy)
         dialog.ShowModal()
 
+    def onSearchHistory(self, evt):
+        dialog = wx.TextEntryDialog(self, lang.D_SEARCH_HISTORY_MESSAGE,
+                                    lang.D_SEARCH_HISTORY_TITLE)
+        if dialog.ShowModal() == wx.ID_OK:
+            text = dialog.GetValue().strip()
+            if text:
+                HistorySearchWindow(self.mw, text)
+        dialog.Destroy()
+
+
+class HistorySearchWindow(wx.Frame):
+
+    # the messages of all buddies that contain all the words of
+    # text (see ChatHistory.search()), the newest first
+
+    def __init__(self, main_window, text):
+        wx.Frame.__init__(self, main_window, -1, size=(500, 400))
+        self.SetTitle('%s - %s' % (text, config.getProfileLongName()))
+        self.txt = wx.TextCtrl(self, -1, style=wx.TE_READONLY
+                               | wx.TE_MULTILINE | wx.TE_RICH2
+                               | wx.BORDER_SUNKEN)
+        results = main_window.buddy_list.searchHistory(text)
+        lines = []
+        for (address, when, direction, message) in results:
+            if direction == tc_client.HISTORY_OUT:
+                address = 'myself -> %s' % address
+            lines.append('%s %s: %s' % (time.strftime('%Y-%m-%d %H:%M',
+                         time.localtime(when)), address, message))
+        self.txt.SetValue('\n'.join(lines))
+        self.Show()
+
+
+def getTransferName(file_names):
+
+    # the file_name argument for FileTransferWindow: a single file
+    # stays a single file, everything else is sent as an archive
+
+    if len(file_names) == 1 and not os.path.isdir(file_names[0]):
+        return file_names[0]
+    return file_names
+
+
+def formatRate(rate, eta):
+
+    # transfer rate and remaining time for the progress display,
+    # only numbers and units, so they need no translation
+
+    text = '%.1f KiB/s' % (rate / 1024.0)
+    if rate >= 1048576:
+        text = '%.1f MiB/s' % (rate / 1048576.0)
+    if eta != None:
+        eta = int(eta)
+        text += ' - %i:%02i:%02i' % (eta / 3600, eta / 60 % 60, eta % 60)
+    return text
+
+
+def getHistoryPassphrase():
+
+    # the passphrase of an encrypted chat history is not saved
+    # anywhere, it comes from the environment (removed from it, so
+    # Tor does not inherit it) or the user is asked for it
+
+    passphrase = os.environ.pop(tc_client.HISTORY_PASSPHRASE_ENV, '')
+
+    # older versions kept it in the config file, take it out of there
+    # one last time
+
+    if config.config.get('history', {}).has_key('passphrase'):
+        passphrase_old = unicode(config.config['history'].pop('passphrase'
+                                 )).encode('utf-8')
+        passphrase = passphrase or passphrase_old
+        if passphrase_old:
+            config.set('history', 'encrypt', 1)
+        else:
+            config.writeConfig()
+
+    if passphrase or not config.getint('history', 'enabled') \
+        or not config.getint('history', 'encrypt'):
+        return passphrase
+    dialog = wx.PasswordEntryDialog(None, lang.D_HISTORY_PASSPHRASE_MESSAGE,
+                                    lang.D_HISTORY_PASSPHRASE_TITLE
+                                    % config.getProfileLongName())
+    if dialog.ShowModal() == wx.ID_OK:
+        passphrase = dialog.GetValue().encode('utf-8')
+    dialog.Destroy()
+    return passphrase
+
 
 class FileDropTarget(wx.FileDropTarget):
 
@@ -1012,35 +1308,35 @@ class FileDropTarget(wx.FileDropTarget):
         y,
         filenames,
         ):
-        if len(filenames) != 1:
-            wx.MessageBox(lang.D_WARN_FILE_ONLY_ONE_MESSAGE,
-                          lang.D_WARN_FILE_ONLY_ONE_TITLE)
-            return
 
-        file_name = filenames[0]
+        # several files or directories are sent together as one transfer
 
-        # --- begin evel hack
+        file_names = []
+        for file_name in filenames:
 
-        if not os.path.exists(file_name):
+            # --- begin evel hack
 
-            # sometimes the file name is in utf8
-            # but inside a unicode object!
-            # FIXME: must report this bug to wx
+            if not os.path.exists(file_name):
 
-            try:
-                file_name_utf8 = ''
-                for c in file_name:
-                    file_name_utf8 += chr(ord(c))
-                file_name = file_name_utf8.decode('utf-8')
-            except:
-                config.tb()
-                wx.MessageBox('there is a strange bug in wx for your platform with wx.FileDropTarget and non-ascii characters in file names'
-                              )
-                return
+                # sometimes the file name is in utf8
+                # but inside a unicode object!
+                # FIXME: must report this bug to wx
+
+                try:
+                    file_name_utf8 = ''
+                    for c in file_name:
+                        file_name_utf8 += chr(ord(c))
+                    file_name = file_name_utf8.decode('utf-8')
+                except:
+                    config.tb()
+                    wx.MessageBox('there is a strange bug in wx for your platform with wx.FileDropTarget and non-ascii characters in file names'
+                                  )
+                    return
 
-        # --- end evel hack
+            # --- end evel hack
 
-        log.warn('file dropped: %s' % file_name)
+            log.warn('file dropped: %s' % file_name)
+            file_names.append(file_name)
 
         if not self.window.buddy.conn_in:
             wx.MessageBox(lang.D_WARN_BUDDY_OFFLINE_MESSAGE,
@@ -1048,7 +1344,7 @@ class FileDropTarget(wx.FileDropTarget):
             return
 
         transfer_window = FileTransferWindow(self.window.mw,
-                self.window.buddy, file_name)
+                self.window.buddy, getTransferName(file_names))
 
 
 class FileTransferWindow(wx.Frame):
@@ -1059,11 +1355,14 @@ class FileTransferWindow(wx.Frame):
         buddy,
         file_name,
         receiver=None,
+        sender=None,
         ):
 
         # if receiver is given (a FileReceiver instance) we initialize
         # a Receiver Window, else we initialize a sender window and
         # let the client library create us a FileSender instance
+        # (or use the given one, if it is a resumed transfer).
+        # file_name can also be a list of files and directories.
 
         wx.Frame.__init__(self, main_window, -1)
         self.mw = main_window
@@ -1075,8 +1374,19 @@ class FileTransferWindow(wx.Frame):
         self.file_name_save = ''
         self.completed = False
         self.error = False
+        self.update_pending = False  # see onDataChange()
 
-        if not receiver:
+        if sender:
+            self.is_receiver = False
+            sender.setCallbackFunction(self.onDataChange)
+            self.transfer_object = sender
+            self.bytes_total = max(sender.file_size, 1)
+        elif type(file_name) == list:
+            self.is_receiver = False
+            self.transfer_object = self.buddy.sendFiles(file_name,
+                    self.onDataChange)
+            self.file_name = self.transfer_object.file_name
+        elif not receiver:
             self.is_receiver = False
             self.transfer_object = self.buddy.sendFile(self.file_name,
                     self.onDataChange)
@@ -1121,6 +1431,7 @@ class FileTransferWindow(wx.Frame):
         self.Show()
 
     def updateOutput(self):
+        self.update_pending = False
         if self.bytes_complete == -1:
             self.error = True
             self.completed = True
@@ -1145,6 +1456,11 @@ class FileTransferWindow(wx.Frame):
                                     self.bytes_complete,
                                     self.bytes_total)
 
+        progress = self.transfer_object.progress
+        if not self.completed and progress.getRate() > 0:
+            text += '\n' + formatRate(progress.getRate(),
+                                      progress.getETA())
+
         if self.error:
             text = self.error_msg
             self.btn_cancel.SetLabel(lang.BTN_CLOSE)
@@ -1171,16 +1487,20 @@ class FileTransferWindow(wx.Frame):
         ):
 
         # will be called from the FileSender/FileReceiver-object in the
-        # protocol module to update gui
+        # protocol module to update gui (see tc_client.TransferProgress)
 
         self.bytes_total = total
         self.bytes_complete = complete
         self.error_msg = error_msg
 
         # we must use wx.Callafter to make calls into wx
-        # because we are *NOT* in the context of the GUI thread here
+        # because we are *NOT* in the context of the GUI thread here.
+        # If the GUI thread has not yet come to the last one, that one
+        # will show these values, they are all that matters.
 
-        wx.CallAfter(self.updateOutput)
+        if not self.update_pending:
+            self.update_pending = True
+            wx.CallAfter(self.updateOutput)
 
     def onCancel(self, evt):
         try:
@@ -1213,7 +1533,7 @@ class FileTransferWindow(wx.Frame):
                     return
 
             self.transfer_object.setFileNameSave(self.file_name_save)
-            if not self.transfer_object.file_handle_save:
+            if not self.transfer_object.file_name_save:
                 error = self.transfer_object.file_save_error
                 wx.MessageBox(lang.D_WARN_FILE_SAVE_ERROR_MESSAGE
                               % (self.file_name_save, error),
@@ -1236,7 +1556,7 @@ class MainWindow(wx.Frame):
         self.chat_windows = []
         self.notification_window = None
         self.buddy_list = tc_client.BuddyList(self.callbackMessage,
-                socket)
+                socket, getHistoryPassphrase())
 
         self.SetTitle('TorChat: %s' % config.getProfileLongName())
 
@@ -1280,30 +1600,17 @@ class MainWindow(wx.Frame):
 
         # we must always use wx.CallAfter() to interact with
         # the GUI-Thread because this method will be called
-        # in the context of one of the connection threads
+        # in the context of the network thread. We must never
+        # block here, this would stall all connections.
 
         if callback_type == tc_client.CB_TYPE_CHAT:
             (buddy, message) = callback_data
-            for window in self.chat_windows:
-                if window.buddy == buddy:
-                    wx.CallAfter(window.process, message)
-                    return
-
-            # no window found, so we create a new one
-
-            hidden = config.getint('gui', 'open_chat_window_hidden')
-            wx.CallAfter(ChatWindow, self, buddy, message, hidden)
-
-            # we let this thread block until the window
-            # shows up in our chat window list
+            wx.CallAfter(self.onChatMessage, buddy, message)
 
-            found = False
-            while not found:
-                time.sleep(1)
-                for window in self.chat_windows:
-                    if window.buddy == buddy:
-                        found = True
-                        break
+        if callback_type in (tc_client.CB_TYPE_BUDDY_ADDED,
+                             tc_client.CB_TYPE_BUDDY_REMOVED,
+                             tc_client.CB_TYPE_BUDDY_CHANGED):
+            wx.CallAfter(self.onBuddyEvent, callback_type, callback_data)
 
         if callback_type == tc_client.CB_TYPE_OFFLINE_SENT:
             buddy = callback_data
@@ -1339,6 +1646,37 @@ class MainWindow(wx.Frame):
             wx.CallAfter(FileTransferWindow, self, buddy, file_name,
                          receiver)
 
+        if callback_type == tc_client.CB_TYPE_FILE_RESUME:
+
+            # an outgoing transfer from the last session is resumed
+
+            sender = callback_data
+            wx.CallAfter(FileTransferWindow, self, sender.buddy,
+                         sender.file_name, sender=sender)
+
+    def onBuddyEvent(self, callback_type, buddy):
+
+        # events can come while tc_client.BuddyList is still loading,
+        # before there is a gui_bl. It will find those buddies itself.
+
+        if hasattr(self, 'gui_bl'):
+            self.gui_bl.onBuddyEvent(callback_type, buddy)
+
+    def onChatMessage(self, buddy, message):
+
+        # this runs in the GUI thread, so two messages arriving
+        # quickly one after the other cannot open two windows
+
+        for window in self.chat_windows:
+            if window.buddy == buddy:
+                window.process(message)
+                return
+
+        # no window found, so we create a new one
+
+        hidden = config.getint('gui', 'open_chat_window_hidden')
+        ChatWindow(self, buddy, message, hidden)
+
     def onClose(self, evt):
         self.Show(False)
 
@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import config
+import tc_client
+
+
+class BuddyListFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.getDataDir = config.getDataDir
+        config.getDataDir = lambda : self.dir
+        self.list_file = tc_client.BuddyListFile()
+
+    def tearDown(self):
+        config.getDataDir = self.getDataDir
+        shutil.rmtree(self.dir)
+
+    def write(self, name, text):
+        f = open(os.path.join(self.dir, name), 'w')
+        f.write(text)
+        f.close()
+
+    def read(self, name):
+        f = open(os.path.join(self.dir, name))
+        text = f.read()
+        f.close()
+        return text
+
+    def load(self):
+        return tc_client.BuddyListFile().load()
+
+    def testEmpty(self):
+        self.assertEqual(self.load(), [])
+
+    def testOldFormat(self):
+        self.write('buddy-list.txt',
+                   'aaaaaaaaaaaaaaaa alice\r\nbbbbbbbbbbbbbbbb\r\n')
+        self.assertEqual(self.load(), [('aaaaaaaaaaaaaaaa', u'alice'),
+                         ('bbbbbbbbbbbbbbbb', u'')])
+
+    def testReplay(self):
+        self.write('buddy-list.txt', 'aaaaaaaaaaaaaaaa alice\r\n')
+        self.list_file.logAdd('bbbbbbbbbbbbbbbb', u'b\xf6b')
+        self.list_file.logRemove('aaaaaaaaaaaaaaaa')
+        self.list_file.logAdd('cccccccccccccccc', u'')
+        self.assertEqual(self.load(), [('bbbbbbbbbbbbbbbb', u'b\xf6b'),
+                         ('cccccccccccccccc', u'')])
+
+    def testReplayTwice(self):
+
+        # a crash after compact() wrote the list but before
+        # the log was removed
+
+        self.list_file.logAdd('aaaaaaaaaaaaaaaa', u'alice')
+        self.list_file.logRemove('bbbbbbbbbbbbbbbb')
+        self.list_file.compact([('aaaaaaaaaaaaaaaa', u'alice')])
+        self.list_file.logAdd('aaaaaaaaaaaaaaaa', u'alice')
+        self.list_file.logRemove('bbbbbbbbbbbbbbbb')
+        self.assertEqual(self.load(), [('aaaaaaaaaaaaaaaa', u'alice')])
+
+    def testTornRecord(self):
+        self.write('buddy-list.log', 'add aaaaaaaaaaaaaaaa alice\nadd bbb')
+        self.assertEqual(self.load(), [('aaaaaaaaaaaaaaaa', u'alice')])
+
+    def testAppendAfterTornRecord(self):
+        self.write('buddy-list.log', 'add abc')
+        self.list_file.logAdd('aaaaaaaaaaaaaaaa', u'alice')
+        self.assertEqual(self.load(), [('aaaaaaaaaaaaaaaa', u'alice')])
+
+    def testCompact(self):
+        self.list_file.logAdd('aaaaaaaaaaaaaaaa', u'alice')
+        self.assertTrue(self.list_file.hasLog())
+        self.list_file.compact([('aaaaaaaaaaaaaaaa', u'alice'),
+                               ('bbbbbbbbbbbbbbbb', u'')])
+        self.assertFalse(self.list_file.hasLog())
+        self.assertEqual(self.list_file.log_count, 0)
+        self.assertEqual(self.read('buddy-list.txt'),
+                         'aaaaaaaaaaaaaaaa alice\r\nbbbbbbbbbbbbbbbb\r\n')
+
+    def testNeedsCompact(self):
+        for i in range(tc_client.BUDDY_LOG_MAX):
+            self.assertFalse(self.list_file.needsCompact())
+            self.list_file.logRemove('aaaaaaaaaaaaaaaa')
+        self.assertTrue(self.list_file.needsCompact())
+
+    def testTemporaryFileOnly(self):
+        self.write('buddy-list.txt.tmp', 'aaaaaaaaaaaaaaaa alice\r\n')
+        self.assertEqual(self.load(), [('aaaaaaaaaaaaaaaa', u'alice')])
+
+    def testNameWithNewline(self):
+        self.list_file.logAdd('aaaaaaaaaaaaaaaa', u'two\nlines')
+        self.assertEqual(self.load(), [('aaaaaaaaaaaaaaaa',
+                         u'two lines')])
+
+
+if __name__ == '__main__':
+    unittest.main()
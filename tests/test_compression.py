@@ -0,0 +1,48 @@
+import unittest
+import zlib
+
+import tc_client
+
+
+class DecompressTest(unittest.TestCase):
+
+    def testZlib(self):
+        data = 'hello world ' * 1000
+        compressed = tc_client.compress('zlib', data)
+        self.assertTrue(len(compressed) < len(data))
+        self.assertEqual(tc_client.decompress('zlib', compressed,
+                         len(data)), data)
+
+    def testZlibTooBig(self):
+        compressed = zlib.compress('\x00' * 1000000)
+        self.assertRaises(ValueError, tc_client.decompress, 'zlib',
+                          compressed, 999999)
+
+    def testUnknown(self):
+        self.assertRaises(ValueError, tc_client.decompress, 'rar', 'x',
+                          100)
+
+    @unittest.skipUnless(tc_client.lzma, 'no lzma module')
+    def testLzma(self):
+        data = 'hello world ' * 1000
+        compressed = tc_client.compress('lzma', data)
+        self.assertEqual(tc_client.decompress('lzma', compressed,
+                         len(data)), data)
+
+    @unittest.skipUnless(tc_client.lzma, 'no lzma module')
+    def testLzmaTooBig(self):
+
+        # about 15 KB that would become 100 MB
+
+        compressed = tc_client.lzma.compress('\x00' * 100000000)
+        self.assertRaises(ValueError, tc_client.decompress, 'lzma',
+                          compressed, 1000000)
+
+    def testAvailable(self):
+        available = tc_client.getAvailableCompressions()
+        self.assertTrue('zlib' in available)
+        self.assertEqual('lzma' in available, tc_client.lzma != None)
+
+
+if __name__ == '__main__':
+    unittest.main()
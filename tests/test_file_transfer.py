@@ -0,0 +1,545 @@
+import collections
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import config
+import tc_client
+
+BLOCK_SIZE = 1024
+
+# no repetitions, delta sync would find blocks in the wrong places
+
+DATA = ''.join(hashlib.md5(str(i)).digest() for i in
+               range(600))[:9 * BLOCK_SIZE + 100]
+DATA_MD5 = hashlib.md5(DATA).hexdigest()
+ID = '\x01\x02\x03\x04'
+
+
+class FakeNetwork(object):
+
+    def __init__(self):
+        self.called = threading.Event()
+
+    def callInLoop(self, function, *args):
+        function(*args)
+        self.called.set()
+
+
+class FakeBuddyList(object):
+
+    def __init__(self):
+        self.transfers = tc_client.TransferScheduler()
+        self.network = FakeNetwork()
+
+    def onFileReceive(self, receiver):
+        pass
+
+
+class FakeBuddy(object):
+
+    def __init__(self, capabilities):
+        self.address = 'aaaaaaaaaaaaaaaa'
+        self.bl = FakeBuddyList()
+        self.capabilities = capabilities
+        self.sent = []
+
+    def supports(self, capability):
+        return capability in self.capabilities
+
+    def sendMsg(self, msg, conn=0):
+        self.sent.append((msg.command, msg.text, msg.payload))
+
+    def messages(self, command):
+        return [text.split(' ', 1)[1] for (sent_command, text, payload) in
+                self.sent if sent_command == command]
+
+
+def block(index, data=DATA):
+    return data[index * BLOCK_SIZE:(index + 1) * BLOCK_SIZE]
+
+
+class ReceiverTestCase(unittest.TestCase):
+
+    # a FileReceiver in a temporary data dir, it talks to a
+    # FakeBuddy which records all messages sent to it
+
+    capabilities = ['selective_ack']
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.getDataDir = config.getDataDir
+        config.getDataDir = lambda : self.dir
+        tc_client.received_files = None
+        self.buddy = FakeBuddy(self.capabilities)
+        self.receiver = self.createReceiver()
+
+    def tearDown(self):
+        if not self.receiver.closed:
+            self.receiver.closeForced()
+        config.getDataDir = self.getDataDir
+        tc_client.received_files = None
+        shutil.rmtree(self.dir)
+
+    def createReceiver(self, resume_state=None):
+        return tc_client.FileReceiver(self.buddy, ID, BLOCK_SIZE,
+                len(DATA), 'file', resume_state=resume_state)
+
+    def send(
+        self,
+        index,
+        data=None,
+        algorithm='crc32',
+        ):
+        if data == None:
+            data = block(index)
+        self.receiver.data(index * BLOCK_SIZE, tc_client.getChecksum(algorithm,
+                           block(index)), data)
+
+    def receive(self, digest=None):
+
+        # save the file and close the receiver, returns the md5 of
+        # the saved data (short messages when a test fails) or None
+        # if it was not saved
+
+        file_name = os.path.join(self.dir, 'saved')
+        self.receiver.setFileNameSave(file_name)
+        self.buddy.bl.network.called.clear()
+        if digest:
+            self.receiver.setDigest('sha256', digest)
+        self.receiver.close()
+        if digest:
+            self.buddy.bl.network.called.wait(5)
+        if not os.path.exists(file_name):
+            return None
+        f = open(file_name, 'rb')
+        data = f.read()
+        f.close()
+        return hashlib.md5(data).hexdigest()
+
+
+class ChecksumTest(unittest.TestCase):
+
+    def testLegacyMd5(self):
+        self.assertEqual(tc_client.getChecksum('md5', 'abc'),
+                         hashlib.md5('abc').hexdigest())
+        self.assertTrue(tc_client.checkChecksum(hashlib.md5('abc'
+                        ).hexdigest(), 'abc'))
+
+    def testAlgorithms(self):
+        for algorithm in tc_client.getAvailableChecksums():
+            hash = tc_client.getChecksum(algorithm, 'abc')
+            self.assertTrue(tc_client.checkChecksum(hash, 'abc'))
+            self.assertFalse(tc_client.checkChecksum(hash, 'abd'))
+        self.assertEqual(tc_client.getChecksum('crc32', 'abc'),
+                         'crc32:352441c2')
+
+    def testUnknownAlgorithm(self):
+        self.assertFalse(tc_client.checkChecksum('foo:1234', 'abc'))
+
+
+class ReceiverChecksumTest(ReceiverTestCase):
+
+    def testCorruptBlock(self):
+
+        # only this block is asked for again
+
+        self.send(0)
+        self.send(1, 'x' + block(1)[1:])
+        self.assertEqual(self.buddy.messages('filedata_error'),
+                         [str(BLOCK_SIZE)])
+        self.assertFalse(self.receiver.received.isSet(1))
+        for index in range(1, 10):
+            self.send(index)
+        self.assertEqual(self.buddy.messages('filedata_missing'), [])
+        self.assertEqual(self.receive(), DATA_MD5)
+
+    def testCorruptBlockLegacy(self):
+
+        # an old sender goes back to the broken block
+
+        self.buddy.capabilities = []
+        self.send(0, algorithm='md5')
+        self.send(1, 'x' + block(1)[1:], 'md5')
+        self.send(2, algorithm='md5')
+        self.assertEqual(self.buddy.messages('filedata_error'),
+                         [str(BLOCK_SIZE)])
+        for index in range(1, 10):
+            self.send(index, algorithm='md5')
+        self.assertEqual(self.receive(), DATA_MD5)
+
+    def testDigest(self):
+        for index in range(10):
+            self.send(index)
+        self.assertEqual(self.receive(hashlib.sha256(DATA).hexdigest()),
+                         DATA_MD5)
+
+    def testWrongDigest(self):
+        for index in range(10):
+            self.send(index)
+        self.assertEqual(self.receive(hashlib.sha256('x').hexdigest()),
+                         None)
+
+
+class ReceiverResumeTest(ReceiverTestCase):
+
+    def restart(self):
+
+        # what survives a restart of the client is the temporary
+        # file and the saved state, the new receiver belongs to
+        # a fresh buddy list
+
+        self.receiver.checkpoint(True)
+        self.receiver.file_handle_tmp.close()
+        self.receiver.closed = True
+        states = tc_client.loadTransferStates()
+        self.assertEqual([name for (name, state) in states],
+                         ['receive_%s_01020304' % self.buddy.address])
+        self.buddy = FakeBuddy(self.capabilities + ['resume'])
+        self.receiver = self.createReceiver(states[0][1])
+
+    def testResume(self):
+        for index in [0, 1, 2, 4]:
+            self.send(index)
+        self.restart()
+        self.assertEqual(self.receiver.next_start, 3 * BLOCK_SIZE)
+        self.assertTrue(self.receiver.received.isSet(4))
+        self.assertFalse(self.receiver.received.isSet(5))
+        self.receiver.sendResume()
+        self.assertEqual(self.buddy.messages('file_resume'),
+                         [str(3 * BLOCK_SIZE)])
+        for index in [3] + range(5, 10):
+            self.send(index)
+        self.assertEqual(self.buddy.messages('filedata_error'), [])
+        self.assertEqual(self.receive(), DATA_MD5)
+        self.assertEqual(tc_client.loadTransferStates(), [])
+
+    def testResumeComplete(self):
+
+        # only the last filedata_ok was lost
+
+        for index in range(10):
+            self.send(index)
+        self.restart()
+        self.receiver.sendResume()
+        self.assertEqual(self.buddy.messages('filedata_ok'),
+                         [str(9 * BLOCK_SIZE)])
+        self.assertEqual(self.receive(), DATA_MD5)
+
+    def testBitmapString(self):
+        bitmap = tc_client.BlockBitmap(20)
+        for index in [0, 3, 19]:
+            bitmap.set(index)
+        copy = tc_client.BlockBitmap(20, bitmap.toString())
+        self.assertEqual([index for index in range(20)
+                         if copy.isSet(index)], [0, 3, 19])
+        self.assertEqual(copy.set_count, 3)
+        self.assertEqual(copy.getFirstMissing(), 1)
+
+
+class BlockBitmapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bitmap = tc_client.BlockBitmap(10)
+
+    def testSet(self):
+        self.assertTrue(self.bitmap.set(2))
+        self.assertFalse(self.bitmap.set(2))
+        self.assertEqual(self.bitmap.getFirstMissing(), 0)
+        self.bitmap.set(0)
+        self.bitmap.set(1)
+        self.assertEqual(self.bitmap.getFirstMissing(), 3)
+        self.assertFalse(self.bitmap.isComplete())
+        for index in range(10):
+            self.bitmap.set(index)
+        self.assertTrue(self.bitmap.isComplete())
+        self.assertEqual(self.bitmap.getFirstMissing(), 10)
+
+    def testClear(self):
+        for index in range(10):
+            self.bitmap.set(index)
+        self.bitmap.clear(7)
+        self.bitmap.clear(7)
+        self.assertEqual(self.bitmap.set_count, 9)
+        self.assertEqual(self.bitmap.getFirstMissing(), 7)
+        self.bitmap.clearFrom(4)
+        self.assertEqual(self.bitmap.set_count, 4)
+        self.assertEqual(self.bitmap.getFirstMissing(), 4)
+
+    def testMissingRanges(self):
+        for index in [0, 3, 4, 8]:
+            self.bitmap.set(index)
+        self.assertEqual(self.bitmap.getMissingRanges(0, 10), [(1, 3),
+                         (5, 8), (9, 10)])
+        self.assertEqual(self.bitmap.getMissingRanges(3, 5), [])
+
+    def testBytes(self):
+        self.bitmap.set(9)
+        self.assertEqual(self.bitmap.getBytes(100, 950), 100)
+        for index in range(10):
+            self.bitmap.set(index)
+        self.assertEqual(self.bitmap.getBytes(100, 950), 950)
+
+
+class ReceiverSelectiveTest(ReceiverTestCase):
+
+    def testOutOfOrder(self):
+
+        # each gap is reported once, the blocks are written
+        # where they belong
+
+        for index in [0, 3, 1, 6, 2, 9]:
+            self.send(index)
+        self.assertEqual(self.buddy.messages('filedata_missing'),
+                         ['1024-3072', '4096-6144', '7168-9216'])
+        self.assertEqual(self.receiver.next_start, 4 * BLOCK_SIZE)
+        for index in [8, 7, 5, 4]:
+            self.send(index)
+        self.assertEqual(len(self.buddy.messages('filedata_missing')), 3)
+        self.assertEqual(self.buddy.messages('filedata_error'), [])
+        self.assertEqual(self.receiver.next_start, len(DATA))
+        self.assertEqual(self.receive(), DATA_MD5)
+
+    def testDuplicate(self):
+
+        # the first filedata_ok might be lost
+
+        self.send(0)
+        self.send(0)
+        self.assertEqual(self.buddy.messages('filedata_ok'), ['0', '0'])
+        self.assertEqual(self.receiver.received.set_count, 1)
+
+    def testInvalidBlock(self):
+        self.send(1, block(1)[:10])
+        self.assertEqual(self.buddy.sent, [])
+        self.assertFalse(self.receiver.received.isSet(1))
+
+
+def makeResendSender(capabilities):
+
+    # a FileSender with 10 blocks of which 8 have been sent,
+    # only the parts used by resendBlocks() and receivedError()
+
+    sender = tc_client.FileSender.__new__(tc_client.FileSender)
+    sender.buddy = FakeBuddy(capabilities)
+    sender.bl = sender.buddy.bl
+    sender.file_name_short = 'file'
+    sender.block_size = BLOCK_SIZE
+    sender.confirmed = tc_client.BlockBitmap(10)
+    for index in range(8):
+        sender.confirmed.set(index)
+    sender.next_block = 8
+    sender.cond = threading.Condition()
+    sender.resend = collections.deque()
+    sender.resend_set = set()
+    sender.send_times = dict((index * BLOCK_SIZE, 0) for index in
+                             range(8))
+    sender.delta = {}
+    sender.window = 64.0
+    sender.ssthresh = 64.0
+    sender.srtt = 0
+    sender.last_decrease = 0
+    sender.last_activity = 0
+    sender.restart_flag = False
+    return sender
+
+
+class SenderResendTest(unittest.TestCase):
+
+    def testResendBlocks(self):
+        sender = makeResendSender(['selective_ack'])
+        sender.resendBlocks([(BLOCK_SIZE, 3 * BLOCK_SIZE), (5
+                            * BLOCK_SIZE, 20 * BLOCK_SIZE)])
+
+        # blocks that have not been sent yet come later anyway
+
+        self.assertEqual(list(sender.resend), [1, 2, 5, 6, 7])
+        self.assertFalse(sender.confirmed.isSet(1))
+        self.assertTrue(sender.confirmed.isSet(3))
+        self.assertFalse(BLOCK_SIZE in sender.send_times)
+        self.assertEqual(sender.window, 32)
+
+        # reported twice, sent once
+
+        sender.resendBlocks([(BLOCK_SIZE, 2 * BLOCK_SIZE)])
+        self.assertEqual(list(sender.resend), [1, 2, 5, 6, 7])
+        sender.confirmed.set(1)
+        self.assertEqual(sender.nextResend(), 2)
+
+    def testCorruptBlock(self):
+
+        # a receiver with selective_ack only wants the broken block
+
+        sender = makeResendSender(['selective_ack'])
+        sender.receivedError(2 * BLOCK_SIZE)
+        self.assertEqual(list(sender.resend), [2])
+        self.assertEqual(sender.confirmed.set_count, 7)
+        self.assertFalse(sender.restart_flag)
+
+    def testCorruptBlockLegacy(self):
+
+        # an old receiver wants everything from there on again
+
+        sender = makeResendSender([])
+        sender.receivedError(2 * BLOCK_SIZE)
+        self.assertEqual(list(sender.resend), [])
+        self.assertEqual(sender.confirmed.set_count, 2)
+        self.assertTrue(sender.restart_flag)
+        self.assertEqual(sender.restart_at, 2 * BLOCK_SIZE)
+
+
+def makeSender(file_name):
+
+    # a FileSender that has opened its file but whose thread has not
+    # been started (FileSender.__init__() starts it)
+
+    sender = tc_client.FileSender.__new__(tc_client.FileSender)
+    sender.file_name = file_name
+    sender.files = None
+    sender.source = None
+    sender.file_handle = open(file_name, 'rb')
+    sender.file_handle.seek(0, 2)
+    sender.file_size = sender.file_handle.tell()
+    sender.mapFile()
+    return sender
+
+
+class FileSenderReadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.dir, 'file')
+        self.write('0123456789' * 1000)
+        self.sender = makeSender(self.file_name)
+
+    def tearDown(self):
+        self.sender.closeFile()
+        shutil.rmtree(self.dir)
+
+    def write(self, data):
+        f = open(self.file_name, 'wb')
+        f.write(data)
+        f.close()
+
+    def testMapped(self):
+        data = self.sender.readBlock(4096, 20)
+        self.assertTrue(isinstance(data, buffer))
+        self.assertEqual(str(data), '67890123456789012345')
+
+    def testShrunk(self):
+
+        # must not touch the map behind the new end (SIGBUS)
+
+        self.write('0123456789' * 500)
+        data = self.sender.readBlock(4995, 10)
+        self.assertEqual(self.sender.map, None)
+        self.assertEqual(data, '56789' + '\0' * 5)
+        self.assertEqual(self.sender.readBlock(8192, 4), '\0' * 4)
+
+
+class DeltaTest(ReceiverTestCase):
+
+    # we have saved an older version of the file, 500 bytes in the
+    # middle of it have been inserted since then
+
+    capabilities = ['selective_ack', 'delta']
+
+    def createReceiver(self, resume_state=None):
+        old = os.path.join(self.dir, 'old')
+        f = open(old, 'wb')
+        f.write(DATA[:3000] + DATA[3500:])
+        f.close()
+        tc_client.addReceivedFile(self.buddy.address, 'file', old)
+        receiver = ReceiverTestCase.createReceiver(self, resume_state)
+
+        # offerDelta() runs in the worker thread
+
+        timeout = time.time() + 5
+        while not self.buddy.sent and time.time() < timeout:
+            time.sleep(0.01)
+        return receiver
+
+    def testSignatures(self):
+        (command, text, signatures) = self.buddy.sent[0]
+        self.assertEqual(command, 'delta_signatures')
+        self.assertEqual(text.split(' ')[1], '2048')
+        self.assertEqual(len(signatures), 4 * 12)
+        self.assertEqual(signatures[:12],
+                         tc_client.getDeltaSignature(DATA[:2048]))
+
+    def testNoBase(self):
+
+        # the old file has been changed after it was saved
+
+        self.receiver.closeForced()
+        f = open(os.path.join(self.dir, 'old'), 'ab')
+        f.write('x')
+        f.close()
+        self.buddy = FakeBuddy(self.capabilities)
+        self.receiver = ReceiverTestCase.createReceiver(self)
+        timeout = time.time() + 5
+        while not self.buddy.sent and time.time() < timeout:
+            time.sleep(0.01)
+        self.assertEqual([command for (command, text, payload) in
+                         self.buddy.sent], ['delta_none'])
+
+    def testDeltaCopy(self):
+        file_name = os.path.join(self.dir, 'new')
+        f = open(file_name, 'wb')
+        f.write(DATA)
+        f.close()
+        sender = makeSender(file_name)
+        sender.block_size = BLOCK_SIZE
+        matches = sender.findDeltaMatches(2048, self.buddy.sent[0][2])
+        self.assertEqual(matches, [(0, 0, 2048), (4596, 4096, 2048),
+                         (6644, 6144, 2048)])
+        sender.delta = sender.getDeltaCopies(matches)
+        self.assertEqual(sorted(sender.delta), [0, 1, 4, 5, 6, 7, 8])
+        self.assertEqual(sender.delta[4], [(None, 500), (4096, 524)])
+
+        # the blocks as createDataMsg() sends them, the receiver puts
+        # them together from the old file and the literal data
+
+        sender.bl = self.buddy.bl
+        sender.id = ID
+        sender.raw_bytes = 0
+        sender.wire_bytes = 0
+        sender.compression = None
+        literal_size = 0
+        for index in range(10):
+            start = index * BLOCK_SIZE
+            hash = tc_client.getChecksum('crc32', block(index))
+            msg = sender.createDataMsg(start, hash, block(index))
+            if index in sender.delta:
+                self.assertEqual(msg.command, 'delta_copy')
+                (copies, literal) = msg.payload.split(' ', 1)
+                literal_size += len(literal)
+                data = self.receiver.readDelta(start, copies, literal)
+            else:
+                data = block(index)
+            self.receiver.data(start, hash, data)
+        sender.closeFile()
+
+        # only the inserted part and the end of block 8 (not a whole
+        # signature block) were sent with the copies
+
+        self.assertEqual(literal_size, 500 + 524)
+        self.assertEqual(self.buddy.messages('filedata_error'), [])
+        self.assertEqual(self.receive(), DATA_MD5)
+
+    def testBrokenCopies(self):
+        self.assertEqual(self.receiver.readDelta(0, '0:2000', ''), None)
+        self.assertEqual(self.receiver.readDelta(0, '8000:1024', ''),
+                         None)
+        self.assertEqual(self.receiver.readDelta(0, '0:24,1000', 'x'),
+                         None)
+        self.assertEqual(self.receiver.readDelta(0, '0:1000,24', 'x'
+                         * 24), DATA[:1000] + 'x' * 24)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import struct
+import unittest
+
+import tc_client
+
+received = []
+
+
+class ProtocolMsg_test_record(tc_client.ProtocolMsg):
+
+    command = 'test_record'
+
+    def execute(self):
+        received.append(self.text)
+
+
+class ProtocolMsg_test_binary(tc_client.ProtocolMsg):
+
+    command = 'test_binary'
+
+    def execute(self):
+        self.connection.receiver.setBinary()
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.bl = None
+        self.buddy = None
+        self.errors = 0
+        self.receiver = tc_client.Receiver(self)
+        self.receiver.max_size = 1000
+
+    def onReceiverError(self):
+        self.errors += 1
+
+
+def message(text, payload=None):
+    return ProtocolMsg_test_record(None, None, 'test_record', text,
+                                   payload)
+
+
+def frame(text, payload=None):
+    return ''.join(str(part) for part in message(text,
+                   payload).getFrame())
+
+
+class FramingTest(unittest.TestCase):
+
+    def setUp(self):
+        del received[:]
+        self.conn = FakeConnection()
+
+    def feed(self, data, chunk=None):
+        chunk = chunk or len(data)
+        for i in range(0, len(data), chunk):
+            self.conn.receiver.onData(data[i:i + chunk])
+
+    def testGetLine(self):
+        self.assertEqual(message('a\nb\\c').getLine(),
+                         'test_record a\\nb\\/c')
+        self.assertEqual(message(['x', 1], buffer('\n')).getLine(),
+                         'test_record x 1 \\n')
+
+    def testGetFrame(self):
+        self.assertEqual(message('a\nb').getFrame(),
+                         [struct.pack('>BI', 11, 3) + 'test_recorda\nb'])
+        parts = message('x', buffer('\x00\n')).getFrame()
+        self.assertEqual(parts[0], struct.pack('>BI', 11, 4)
+                         + 'test_recordx ')
+        self.assertEqual(str(parts[1]), '\x00\n')
+
+    def testLines(self):
+        self.feed(message('one\ntwo').getLine() + '\n'
+                  + message('three').getLine() + '\n', 3)
+        self.assertEqual(received, ['one\ntwo', 'three'])
+
+    def testFrames(self):
+        self.conn.receiver.setBinary()
+        self.feed(frame('one\ntwo') + frame('', 'x') + frame('\xff' * 50),
+                  7)
+        self.assertEqual(received, ['one\ntwo', ' x', '\xff' * 50])
+
+    def testIncompleteFrame(self):
+        self.conn.receiver.setBinary()
+        data = frame('one')
+        self.feed(data[:-1])
+        self.assertEqual(received, [])
+        self.feed(data[-1:])
+        self.assertEqual(received, ['one'])
+
+    def testSwitchInSameChunk(self):
+
+        # the frames after the switch can arrive together with it
+
+        switch = tc_client.ProtocolMsg(None, None, 'test_binary', '')
+        self.feed(message('line').getLine() + '\n' + switch.getLine()
+                  + '\n' + frame('framed\n'))
+        self.assertEqual(received, ['line', 'framed\n'])
+
+    def testFrameTooBig(self):
+        self.conn.receiver.setBinary()
+        self.feed(struct.pack('>BI', 11, 2000) + 'test_record')
+        self.assertEqual(received, [])
+        self.assertEqual(self.conn.errors, 1)
+        self.feed(frame('more'))
+        self.assertEqual(received, [])
+
+    def testLineTooLong(self):
+        self.feed('x' * 600)
+        self.assertEqual(self.conn.errors, 0)
+        self.feed('x' * 600)
+        self.assertEqual(self.conn.errors, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
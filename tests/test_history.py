@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import config
+import tc_client
+
+A = 'aaaaaaaaaaaaaaaa'
+B = 'bbbbbbbbbbbbbbbb'
+
+
+class LockedDatabase(object):
+
+    def execute(self, *args):
+        raise sqlite3.OperationalError('database is locked')
+
+    def rollback(self):
+        pass
+
+
+class ChatHistoryTest(unittest.TestCase):
+
+    passphrase = ''
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.getDataDir = config.getDataDir
+        config.getDataDir = lambda : self.dir
+        self.history = self.open()
+
+    def tearDown(self):
+        config.getDataDir = self.getDataDir
+        shutil.rmtree(self.dir)
+
+    def open(self, passphrase=None):
+        if passphrase == None:
+            passphrase = self.passphrase
+        return tc_client.ChatHistory(passphrase)
+
+    def texts(self, rows):
+        return [row[-1] for row in rows]
+
+    def testGetRecent(self):
+        for i in range(5):
+            self.history.add(A, tc_client.HISTORY_IN, u'message %i' % i,
+                             1000 + i)
+        self.history.add(B, tc_client.HISTORY_OUT, u'other')
+        rows = self.history.getRecent(A, 3)
+        self.assertEqual(self.texts(rows), [u'message 2', u'message 3',
+                         u'message 4'])
+        self.assertEqual(rows[0][1:3], (1002, tc_client.HISTORY_IN))
+        rows = self.history.getRecent(A, 10, rows[0][0])
+        self.assertEqual(self.texts(rows), [u'message 0', u'message 1'])
+
+    def testSearch(self):
+        self.history.add(A, tc_client.HISTORY_IN, u'Hello wörld')
+        self.history.add(B, tc_client.HISTORY_OUT, u'hello there')
+        self.history.add(A, tc_client.HISTORY_OUT, u'the world, hello!')
+        rows = self.history.search(u'WORLD hello', [A, B])
+        self.assertEqual(rows[0][0], A)
+        self.assertEqual(self.texts(rows), [u'the world, hello!'])
+        rows = self.history.search(u'hello', [A, B])
+        self.assertEqual([row[0] for row in rows], [A, B, A])
+        self.assertEqual(self.texts(self.history.search(u'wörld', [A])),
+                         [u'Hello wörld'])
+        self.assertEqual(self.history.search(u'hell', [A, B]), [])
+        self.assertEqual(self.history.search(u'...', [A, B]), [])
+        self.assertEqual(len(self.history.search(u'hello', [A, B], 1)), 1)
+
+    def testRename(self):
+        self.history.add(A, tc_client.HISTORY_IN, u'hi')
+        self.history.rename(A, B)
+        self.assertEqual(self.history.getRecent(A, 10), [])
+        self.assertEqual(self.texts(self.history.getRecent(B, 10)), [u'hi'])
+
+    def testDatabaseErrors(self):
+
+        # errors are logged, they never reach the caller
+
+        self.history.db.close()
+        self.history.db = LockedDatabase()
+        self.history.add(A, tc_client.HISTORY_IN, u'hi')
+        self.history.rename(A, B)
+        self.assertEqual(self.history.getRecent(A, 10), [])
+        self.assertEqual(self.history.search(u'hi', [A]), [])
+
+    def testReopen(self):
+        self.history.add(A, tc_client.HISTORY_IN, u'hi')
+        self.history = self.open()
+        self.assertEqual(self.texts(self.history.getRecent(A, 10)), [u'hi'])
+
+    def testEncryptWithoutPassphrase(self):
+        self.history.add(A, tc_client.HISTORY_IN, u'hi')
+        section = config.config.get('history')
+        config.config['history'] = {'encrypt': 1}
+        try:
+            history = self.open('')
+        finally:
+            config.config.pop('history')
+            if section != None:
+                config.config['history'] = section
+        self.assertEqual(history.db, None)
+        self.assertEqual(history.getRecent(A, 10), [])
+
+
+@unittest.skipUnless(tc_client.AES, 'needs PyCrypto')
+class EncryptedChatHistoryTest(ChatHistoryTest):
+
+    passphrase = 'secret'
+
+    def testEncrypted(self):
+        self.history.add(A, tc_client.HISTORY_IN, u'plain words')
+        data = self.history.db.execute('SELECT buddy, text FROM messages'
+                                       ).fetchall()
+        self.assertFalse(A in str(data[0][0]))
+        self.assertFalse('plain' in str(data[0][1]))
+
+    def testWrongPassphrase(self):
+        self.history.add(A, tc_client.HISTORY_IN, u'hi')
+        self.assertEqual(self.open('wrong').db, None)
+        self.assertEqual(self.open('').db, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import threading
+import unittest
+
+import tc_client
+
+
+class BrokenHandler(object):
+
+    def __init__(self, sock):
+        self.socket = sock
+        self.errors = 0
+
+    def writable(self):
+        return False
+
+    def handleRead(self):
+        raise Exception('read failed')
+
+    def handleError(self):
+        self.errors += 1
+        raise Exception('error handling failed')
+
+
+class NetworkLoopTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = tc_client.NetworkLoop()
+
+    def tearDown(self):
+        self.loop.close()
+        self.loop.join(5)
+
+    def runInLoop(self, func, *args):
+        done = threading.Event()
+
+        def call():
+            func(*args)
+            done.set()
+
+        self.loop.callInLoop(call)
+        done.wait(5)
+        self.assertTrue(done.isSet())
+
+    def testFailingErrorHandler(self):
+        (a, b) = tc_client.socketPair()
+        handler = BrokenHandler(a)
+        self.runInLoop(self.loop.register, handler)
+        b.send('x')
+
+        # the loop must survive and drop the handler
+
+        for i in range(50):
+            self.runInLoop(lambda : None)
+            if handler.errors:
+                break
+        self.runInLoop(lambda : None)
+        self.assertEqual(handler.errors, 1)
+        self.assertFalse(handler in self.loop.handlers.values())
+        self.assertTrue(self.loop.isAlive())
+        b.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import config
+import tc_client
+
+A = 'aaaaaaaaaaaaaaaa'
+B = 'bbbbbbbbbbbbbbbb'
+
+
+class OfflineMessageStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.getDataDir = config.getDataDir
+        config.getDataDir = lambda : self.dir
+        self.store = tc_client.OfflineMessageStore()
+
+    def tearDown(self):
+        self.store.db.close()
+        config.getDataDir = self.getDataDir
+        shutil.rmtree(self.dir)
+
+    def texts(self, address, after=0, limit=-1):
+        return [text for (id, when, text) in
+                self.store.getMessages(address, after, limit)]
+
+    def testAddAndGet(self):
+        self.assertFalse(self.store.has(A))
+        id = self.store.add(A, u'first', 1000)
+        self.store.add(B, u'other')
+        self.store.add(A, u'sec\xf6nd\nline')
+        self.assertTrue(self.store.has(A))
+        self.assertEqual(self.store.getMessages(A)[0], (id, 1000,
+                         u'first'))
+        self.assertEqual(self.texts(A), [u'first', u'sec\xf6nd\nline'])
+        self.assertEqual(self.texts(A, id), [u'sec\xf6nd\nline'])
+        self.assertEqual(self.texts(A, 0, 1), [u'first'])
+
+    def testRemove(self):
+        id = self.store.add(A, u'first')
+        self.store.add(A, u'second')
+        self.store.remove(B, id)
+        self.assertEqual(self.texts(A), [u'first', u'second'])
+        self.store.remove(A, id)
+        self.assertEqual(self.texts(A), [u'second'])
+        self.store.removeAll(A)
+        self.assertFalse(self.store.has(A))
+
+    def testRename(self):
+        self.store.add(A, u'first')
+        self.store.rename(A, B)
+        self.assertFalse(self.store.has(A))
+        self.assertEqual(self.texts(B), [u'first'])
+
+    def testPersistent(self):
+        self.store.add(A, u'first')
+        self.store.db.close()
+        self.store = tc_client.OfflineMessageStore()
+        self.assertEqual(self.texts(A), [u'first'])
+
+    def testImportTextFiles(self):
+        path = os.path.join(self.dir, A + '_offline.txt')
+        f = open(path, 'w')
+        f.write('[delayed] hello\n[delayed] two\nlines\n[delayed] '
+                'w\xc3\xb6rld\n')
+        f.close()
+        self.store.db.close()
+        self.store = tc_client.OfflineMessageStore()
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.texts(A), [u'hello', u'two\nlines',
+                         u'w\xf6rld'])
+
+
+if __name__ == '__main__':
+    unittest.main()
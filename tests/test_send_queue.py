@@ -0,0 +1,76 @@
+import unittest
+
+import tc_client
+
+
+class SendQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = tc_client.SendQueue(1000)
+
+    def takeAll(self):
+        data = ''
+        while True:
+            batch = self.queue.take(4)
+            if not batch:
+                return data
+            data += str(batch)
+
+    def testEmpty(self):
+        self.assertTrue(self.queue.isEmpty())
+        self.assertEqual(self.queue.take(100), '')
+
+    def testPutReturnsWasEmpty(self):
+        self.assertTrue(self.queue.put(['a']))
+        self.assertFalse(self.queue.put(['b']))
+
+    def testPriorityOvertakesBulk(self):
+        self.queue.put(['bulk1\n'], bulk=True)
+        self.queue.put(['bulk2\n'], bulk=True)
+        self.queue.put(['chat\n'])
+        self.assertEqual(self.takeAll(), 'chat\nbulk1\nbulk2\n')
+
+    def testStartedMessageIsFinished(self):
+        self.queue.put(['bu', 'lk\n'], bulk=True)
+        self.assertEqual(self.queue.take(2), 'bu')
+        self.queue.put(['chat\n'])
+        self.assertEqual(self.takeAll(), 'lk\nchat\n')
+
+    def testBarrierStaysBehindBulk(self):
+        self.queue.put(['line1\n'], bulk=True)
+        self.queue.put(['line2\n'], bulk=True)
+        self.queue.put(['switch\n'], barrier=True)
+        self.queue.put(['frame'], bulk=True)
+        self.queue.put(['chat'])
+        self.assertEqual(self.takeAll(),
+                         'line1\nline2\nswitch\nchatframe')
+
+    def testBufferIsNotJoined(self):
+        data = buffer('0123456789')
+        self.queue.put(['head'])
+        self.queue.put([data], bulk=True)
+        self.assertEqual(self.queue.take(100), 'head')
+        self.assertTrue(self.queue.take(100) is data)
+
+    def testPutBack(self):
+        self.queue.put(['abcdef'])
+        batch = self.queue.take(100)
+        self.queue.putBack(buffer(batch, 2))
+        self.assertEqual(str(self.queue.take(100)), 'cdef')
+        self.assertTrue(self.queue.isEmpty())
+
+    def testWaitSpace(self):
+        self.queue.put(['x' * 1000], bulk=True)
+        self.assertFalse(self.queue.waitSpace(0.01))
+        self.queue.take(2000)
+        self.assertTrue(self.queue.waitSpace(0.01))
+
+    def testClose(self):
+        self.queue.put(['x' * 1000])
+        self.queue.close()
+        self.assertTrue(self.queue.isEmpty())
+        self.assertTrue(self.queue.waitSpace(0.01))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import threading
+import time
+import unittest
+
+import tc_client
+
+
+class TimerTest(unittest.TestCase):
+
+    def testCallLaterOrder(self):
+        calls = []
+        done = threading.Event()
+        tc_client.callLater(0.2, done.set)
+        tc_client.callLater(0.1, calls.append, 2)
+        tc_client.callLater(0.05, calls.append, 1)
+        tc_client.callLater(0.05, calls.append, 'cancelled').cancel()
+        done.wait(5)
+        self.assertEqual(calls, [1, 2])
+
+    def testWaitConditionTimeout(self):
+        cond = threading.Condition()
+        cond.acquire()
+        start = time.time()
+        tc_client.waitCondition(cond, 0.2)
+        cond.release()
+        self.assertTrue(0.15 < time.time() - start < 1)
+
+    def testWaitConditionNotify(self):
+        cond = threading.Condition()
+        cond.acquire()
+        threading.Thread(target=tc_client.notifyCondition,
+                         args=(cond, )).start()
+        start = time.time()
+        tc_client.waitCondition(cond, 5)
+        cond.release()
+        self.assertTrue(time.time() - start < 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import threading
+import time
+import unittest
+
+import tc_client
+
+
+class FakeBuddy(object):
+
+    def __init__(self, address):
+        self.address = address
+
+
+class FakeSender(object):
+
+    def __init__(self, address, weight=1):
+        self.buddy = FakeBuddy(address)
+        self.id = address
+        self.weight = weight
+        self.deficit = 0
+        self.running = True
+        self.restart_flag = False
+        self.sent = 0
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def testUnlimited(self):
+        bucket = tc_client.TokenBucket(0)
+        bucket.consume(10 ** 9)
+        self.assertEqual(bucket.getDelay(10 ** 9), 0)
+
+    def testDelay(self):
+        bucket = tc_client.TokenBucket(1000)
+        self.assertEqual(bucket.getDelay(600), 0)
+        bucket.consume(600)
+        self.assertAlmostEqual(bucket.getDelay(600), 0.2, 2)
+
+    def testBigBlock(self):
+
+        # a block bigger than the bucket waits until it is full
+
+        bucket = tc_client.TokenBucket(1000)
+        self.assertEqual(bucket.getDelay(5000), 0)
+        bucket.consume(5000)
+        self.assertAlmostEqual(bucket.getDelay(5000), 5.0, 2)
+
+    def testRefill(self):
+        bucket = tc_client.TokenBucket(1000)
+        bucket.consume(1000)
+        bucket.last -= 0.5
+        self.assertAlmostEqual(bucket.getDelay(1000), 0.5, 2)
+        bucket.last -= 10
+        self.assertEqual(bucket.getDelay(1000), 0)
+        self.assertEqual(bucket.tokens, 1000)
+
+
+class TransferSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = tc_client.TransferScheduler()
+        self.lock = threading.Lock()
+        self.total = 0
+
+    def testStopped(self):
+        sender = FakeSender('a')
+        sender.running = False
+        self.assertFalse(self.scheduler.acquire(sender, 1000))
+        self.assertEqual(len(self.scheduler.waiting), 0)
+
+    def testCredit(self):
+        sender = FakeSender('a')
+        self.assertTrue(self.scheduler.acquire(sender, 1000))
+        self.assertEqual(sender.deficit, tc_client.TRANSFER_QUANTUM
+                         - 1000)
+        self.assertEqual(self.scheduler.current, sender)
+
+    def run_sender(self, sender, size, limit):
+        while self.scheduler.acquire(sender, size):
+            self.lock.acquire()
+            sender.sent += size
+            self.total += size
+            done = self.total >= limit
+            self.lock.release()
+            if done:
+                break
+
+    def testWeights(self):
+
+        # the weights only matter when the senders have to wait for
+        # the rate limit, so this takes about 0.6 seconds
+
+        size = tc_client.TRANSFER_QUANTUM / 8
+        limit = tc_client.TRANSFER_QUANTUM * 16
+        self.scheduler.global_bucket = tc_client.TokenBucket(size * 200)
+        self.scheduler.global_bucket.tokens = 0
+        senders = [FakeSender('a', 1), FakeSender('b', 3)]
+        threads = [threading.Thread(target=self.run_sender, args=(sender,
+                   size, limit)) for sender in senders]
+        for thread in threads:
+            thread.start()
+        while self.total < limit:
+            time.sleep(0.01)
+        for sender in senders:
+            sender.running = False
+        self.scheduler.wakeUp()
+        for thread in threads:
+            thread.join()
+        ratio = float(senders[1].sent) / senders[0].sent
+        self.assertTrue(2.5 < ratio < 3.5, ratio)
+
+
+if __name__ == '__main__':
+    unittest.main()